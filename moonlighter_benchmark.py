@@ -0,0 +1,304 @@
+from contextlib import contextmanager
+from functools import wraps
+from itertools import product
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+import moonlighter_pricing
+from moonlighter_engine import MoonlighterEngine
+from moonlighter_shops import MoonlighterShops
+from moonlighter_pricing import (
+    DEFAULT_SEED,
+    initialize_simulation,
+    moonlighter_session,
+    run_simulation_ticks)
+
+TIMED_FUNCTIONS = {
+    'sql': (
+        moonlighter_pricing,
+        [
+            'fill_shelf_w_priced_item', 'get_random_shelf_reaction',
+            'update_price_bound_history', 'update_inventory',
+            'fill_empty_shelves_w_priced_items']),
+    'engine': (
+        MoonlighterEngine,
+        [
+            'run_thompson_competition', 'get_random_shelf_reaction',
+            'update_price_bounds', 'flush',
+            'fill_empty_shelves_w_priced_items']),
+    'shops': (
+        MoonlighterShops,
+        [
+            'run_thompson_competitions', 'record_reactions', 'flush',
+            'fill_empty_shelves_w_priced_items'])}
+STARTUP_MODULES = ['moonlighter_pricing', 'moonlighter_engine', 'moonlighter_monte_carlo']
+
+def get_benchmark_config(shelf_count, item_count, stock):
+    items = [f'item_{i:05d}' for i in range(item_count)]
+    rng = np.random.default_rng(item_count)
+    cheap_uppers = rng.integers(2, 200, size=item_count)
+    perfect_uppers = cheap_uppers + rng.integers(1, 30, size=item_count)
+    expensive_uppers = perfect_uppers + rng.integers(1, 10, size=item_count)
+    return {
+        'shelf_count': shelf_count,
+        'item_counts': {item: stock for item in items},
+        'price_bounds': {'2|275': items},
+        'price_reaction_bounds': [
+            {
+                'item': item,
+                'cheap_upper': int(cheap_upper),
+                'perfect_upper': int(perfect_upper),
+                'expensive_upper': int(expensive_upper)}
+            for item, cheap_upper, perfect_upper, expensive_upper in zip(
+                items, cheap_uppers, perfect_uppers, expensive_uppers)]}
+@contextmanager
+def timed_functions(owner, function_names):
+    timings = {name: [] for name in function_names}
+    originals = {name: getattr(owner, name) for name in function_names}
+    def get_timed_function(name, f):
+        @wraps(f)
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                timings[name].append(time.perf_counter() - start)
+        return timed_function
+    for name, f in originals.items():
+        setattr(owner, name, get_timed_function(name, f))
+    try:
+        yield timings
+    finally:
+        for name, f in originals.items():
+            setattr(owner, name, f)
+def summarize_timings(timings):
+    return {
+        name: {
+            'calls': len(durations),
+            'total_seconds': float(np.sum(durations)),
+            'mean_seconds': float(np.mean(durations)) if durations else None}
+        for name, durations in timings.items()}
+def run_backend(
+        backend, rng, max_ticks, tick_transactions, competition_storage,
+        shop_count):
+    # Returns the ticks run and the ticks summed over every simulated shop
+    if backend == 'sql':
+        ticks = run_simulation_ticks(
+            rng,
+            tick_transactions=tick_transactions,
+            max_ticks=max_ticks,
+            competition_storage=competition_storage)
+        return ticks, ticks
+    if backend == 'shops':
+        shops = MoonlighterShops.from_database(shop_count=shop_count)
+        ticks = shops.run_simulation_ticks(rng, max_ticks=max_ticks)
+        return ticks, sum(shops.get_summary()['ticks'])
+    ticks = (
+        MoonlighterEngine
+        .from_database(competition_storage=competition_storage)
+        .run_simulation_ticks(rng, max_ticks=max_ticks))
+    return ticks, ticks
+def run_benchmark_case(
+        backend, shelf_count, item_count, stock, max_ticks=None,
+        tick_transactions=False, competition_storage='full', shop_count=1,
+        seed=DEFAULT_SEED):
+    config = get_benchmark_config(shelf_count, item_count, stock)
+    with TemporaryDirectory() as directory:
+        with moonlighter_session(Path(directory) / 'benchmark.sqlite'):
+            initialize_simulation(**config)
+            with timed_functions(*TIMED_FUNCTIONS[backend]) as timings:
+                start = time.perf_counter()
+                ticks, shop_ticks = run_backend(
+                    backend=backend,
+                    rng=np.random.default_rng(seed),
+                    max_ticks=max_ticks,
+                    tick_transactions=tick_transactions,
+                    competition_storage=competition_storage,
+                    shop_count=shop_count)
+                seconds = time.perf_counter() - start
+    return {
+        'backend': backend,
+        'shelf_count': shelf_count,
+        'item_count': item_count,
+        'stock': stock,
+        'max_ticks': max_ticks,
+        'tick_transactions': tick_transactions,
+        'competition_storage': competition_storage,
+        'shop_count': shop_count,
+        'ticks': ticks,
+        'shop_ticks': shop_ticks,
+        'seconds': seconds,
+        'ticks_per_second': ticks / seconds if seconds else None,
+        'shop_ticks_per_second': shop_ticks / seconds if seconds else None,
+        'function_timings': summarize_timings(timings)}
+def run_benchmarks(
+        backends, shelf_counts, item_counts, stock_levels, max_ticks=None,
+        tick_transactions=False, competition_storage='full', shop_counts=[1]):
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'results': [
+            run_benchmark_case(
+                backend=backend,
+                shelf_count=shelf_count,
+                item_count=item_count,
+                stock=stock,
+                max_ticks=max_ticks,
+                tick_transactions=tick_transactions,
+                competition_storage=competition_storage,
+                shop_count=shop_count)
+            for backend, shelf_count, item_count, stock in product(
+                backends, shelf_counts, item_counts, stock_levels)
+            # Only the shops backend simulates more than one shop
+            for shop_count in (shop_counts if backend == 'shops' else [1])]}
+def get_startup_timing(module, repeats=5):
+    # Fresh interpreters, so nothing is cached from this process's imports
+    script = (
+        'import sys, time\n'
+        'start = time.perf_counter()\n'
+        f'import {module}\n'
+        'print(time.perf_counter() - start, "pandas" in sys.modules)')
+    timings = [
+        subprocess.run(
+            [sys.executable, '-c', script],
+            cwd=Path(__file__).resolve().parent,
+            capture_output=True,
+            text=True,
+            check=True)
+        .stdout
+        .split()
+        for _ in range(repeats)]
+    seconds = [float(x[0]) for x in timings]
+    return {
+        'min_seconds': min(seconds),
+        'mean_seconds': float(np.mean(seconds)),
+        'imports_pandas': timings[0][1] == 'True'}
+def run_startup_benchmarks(modules=STARTUP_MODULES, repeats=5):
+    return {
+        module: get_startup_timing(module, repeats=repeats)
+        for module in modules}
+def get_case_key(result):
+    return (
+        result['backend'], result['shelf_count'], result['item_count'],
+        result['stock'], result['max_ticks'], result['tick_transactions'],
+        result.get('competition_storage', 'full'), result.get('shop_count', 1))
+def get_regressions(baseline, current, threshold):
+    baseline_results = {
+        get_case_key(result): result
+        for result in baseline['results']}
+    regressions = []
+    for module, timing in current.get('startup', {}).items():
+        baseline_timing = baseline.get('startup', {}).get(module)
+        if baseline_timing is None:
+            continue
+        if timing['min_seconds'] > baseline_timing['min_seconds'] * (1 + threshold):
+            regressions.append({
+                'case': ('startup', module),
+                'metric': 'import min_seconds',
+                'baseline': baseline_timing['min_seconds'],
+                'current': timing['min_seconds']})
+    for result in current['results']:
+        baseline_result = baseline_results.get(get_case_key(result))
+        if baseline_result is None:
+            continue
+        if result['ticks_per_second'] < baseline_result['ticks_per_second'] * (1 - threshold):
+            regressions.append({
+                'case': get_case_key(result),
+                'metric': 'ticks_per_second',
+                'baseline': baseline_result['ticks_per_second'],
+                'current': result['ticks_per_second']})
+        for name, timing in result['function_timings'].items():
+            baseline_timing = baseline_result['function_timings'].get(name)
+            if (
+                    baseline_timing is None
+                    or baseline_timing['mean_seconds'] is None
+                    or timing['mean_seconds'] is None):
+                continue
+            if timing['mean_seconds'] > baseline_timing['mean_seconds'] * (1 + threshold):
+                regressions.append({
+                    'case': get_case_key(result),
+                    'metric': f'{name} mean_seconds',
+                    'baseline': baseline_timing['mean_seconds'],
+                    'current': timing['mean_seconds']})
+    return regressions
+def print_benchmark_report(benchmark):
+    for module, timing in benchmark.get('startup', {}).items():
+        print(
+            f"import {module}: {timing['min_seconds'] * 1e3:.1f} ms min"
+            + (' (imports pandas)' if timing['imports_pandas'] else ''))
+    for result in benchmark['results']:
+        print(
+            f"{result['backend']:>6} shelves={result['shelf_count']} "
+            f"items={result['item_count']} stock={result['stock']} "
+            f"shops={result['shop_count']}: {result['ticks']} ticks, "
+            f"{result['shop_ticks_per_second']:.1f} shop ticks/sec")
+        for name, timing in result['function_timings'].items():
+            if timing['calls']:
+                print(
+                    f"        {name}: {timing['calls']} calls, "
+                    f"{timing['mean_seconds'] * 1e3:.3f} ms mean")
+def get_argument_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pricing simulation hot path.')
+    parser.add_argument('--backends', nargs='+', choices=list(TIMED_FUNCTIONS), default=['sql', 'engine'])
+    parser.add_argument('--shelf-counts', nargs='+', type=int, default=[4])
+    parser.add_argument('--item-counts', nargs='+', type=int, default=[10])
+    parser.add_argument('--stock-levels', nargs='+', type=int, default=[20])
+    parser.add_argument(
+        '--shop-counts',
+        nargs='+',
+        type=int,
+        default=[1],
+        help='Shop counts to run the shops backend with.')
+    parser.add_argument('--max-ticks', type=int, default=200)
+    parser.add_argument('--tick-transactions', action='store_true')
+    parser.add_argument('--competition-storage', choices=['full', 'winners', 'pruned'], default='full')
+    parser.add_argument(
+        '--startup-repeats',
+        type=int,
+        default=5,
+        help='Fresh interpreters to time each module import in; 0 skips startup timing.')
+    parser.add_argument('--output', help='JSON file to write the results to.')
+    parser.add_argument(
+        '--compare',
+        help='JSON file from an earlier run to check for regressions against.')
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.1,
+        help='Relative slowdown beyond which a metric counts as a regression.')
+    return parser
+
+if __name__ == '__main__':
+    args = get_argument_parser().parse_args()
+    benchmark = run_benchmarks(
+        backends=args.backends,
+        shelf_counts=args.shelf_counts,
+        item_counts=args.item_counts,
+        stock_levels=args.stock_levels,
+        max_ticks=args.max_ticks,
+        tick_transactions=args.tick_transactions,
+        competition_storage=args.competition_storage,
+        shop_counts=args.shop_counts)
+    if args.startup_repeats:
+        benchmark['startup'] = run_startup_benchmarks(repeats=args.startup_repeats)
+    print_benchmark_report(benchmark)
+    if args.output is not None:
+        Path(args.output).write_text(json.dumps(benchmark, indent=2))
+    if args.compare is not None:
+        regressions = get_regressions(
+            baseline=json.loads(Path(args.compare).read_text()),
+            current=benchmark,
+            threshold=args.threshold)
+        for regression in regressions:
+            print(
+                f"REGRESSION {regression['case']} {regression['metric']}: "
+                f"{regression['baseline']:.6g} -> {regression['current']:.6g}")
+        raise SystemExit(1 if regressions else 0)
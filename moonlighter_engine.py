@@ -0,0 +1,657 @@
+from collections import Counter
+from contextlib import nullcontext
+import json
+import numpy as np
+from moonlighter_pricing import (
+    DEFAULT_RETAIN_ROWS,
+    MOODS,
+    compact_history,
+    database_transaction,
+    execute_many_queries,
+    get_batch_thompson_competitions,
+    get_history_rowid_watermarks,
+    get_next_competition_index,
+    get_next_reaction_id,
+    get_pruned_thompson_competition,
+    get_price_bound_records,
+    get_query_profile_summary,
+    get_reaction_mood_indices,
+    get_simulation_argument_parser,
+    get_thompson_winner_index,
+    get_updated_price_bounds,
+    initialize_simulation,
+    moonlighter_session,
+    print_convergence_ticks,
+    profile_queries,
+    profiled_helper,
+    query_rows,
+    update_inventory)
+
+EMPTY = -1
+DEFAULT_PRICE_BIN_COUNT = 16
+HISTORY_TABLE_COLUMNS = {
+    'reactions': ['shelf_id', 'item', 'price', 'mood'],
+    'thompson_competitions': [
+        'competition_ind', 'item', 'price_lower_bound', 'price_upper_bound',
+        'sampled_price'],
+    'price_bound_history': ['reaction_id', 'item', 'low', 'high'],
+    'inventory_changes': ['item', 'change'],
+    'shelf_history': ['shelf_id', 'item', 'price'],
+    'thompson_competition_winners': [
+        'competition_ind', 'item', 'sampled_price', 'competitor_count',
+        'rng_state', 'price_bound_history_rowid', 'inventory_changes_rowid']}
+
+@profiled_helper
+def get_database_items():
+    return [
+        x[0]
+        for x in query_rows("""
+            select item from price_bound_history
+            union
+            select item from inventory_changes
+            union
+            select item from inventory
+            union
+            select item from price_reaction_bounds
+            union
+            select item from shelves where item is not null
+            order by
+                item""")]
+@profiled_helper
+def get_latest_price_bounds():
+    return (
+        query_rows("""
+            select
+                item,
+                low,
+                high
+            from current_price_bounds"""))
+@profiled_helper
+def get_inventory_totals():
+    return (
+        query_rows("""
+            select
+                item,
+                count
+            from inventory"""))
+
+class IntervalPricingStrategy:
+    """Samples each competitor's price uniformly from its price bounds, the
+    way get_thompson_competition does."""
+    def __init__(self, lows, highs):
+        pass
+    def sample_prices(self, competitor_ids, lows, highs, rng):
+        sampled_prices = rng.integers(lows, highs + 1)
+        return sampled_prices, sampled_prices
+    def record_reaction(self, item_id, price, mood):
+        pass
+
+class PosteriorPricingStrategy:
+    """Thompson sampling from Dirichlet counts of the moods seen in each of an
+    item's price bins.
+
+    Bins split the price bounds items start with. Only angry customers leave
+    without paying, so a bin's chance of a sale is Beta distributed, and each
+    competitor is priced within the bin, inside its current bounds, with the
+    highest sampled revenue.
+    """
+    def __init__(self, lows, highs, bin_count=DEFAULT_PRICE_BIN_COUNT, prior=1.0):
+        # Items with fewer prices than bins get empty bins, with the low above
+        # the high, that are never chosen
+        edges = lows[:, None] + (highs - lows + 1)[:, None] * np.arange(bin_count + 1) // bin_count
+        self.bin_lows = edges[:, :-1]
+        self.bin_highs = edges[:, 1:] - 1
+        # Even prior odds of a sale, split across the moods that pay
+        self.mood_counts = np.full((len(lows), bin_count, len(MOODS)), prior / (len(MOODS) - 1))
+        self.mood_counts[:, :, MOODS.index('angry')] = prior
+    def sample_prices(self, competitor_ids, lows, highs, rng):
+        mood_counts = self.mood_counts[competitor_ids]
+        angry_counts = mood_counts[:, :, MOODS.index('angry')]
+        # Customers who pay a price would pay any lower one, so sampled sale
+        # chances only fall as prices rise
+        sale_probabilities = np.minimum.accumulate(
+            rng.beta(mood_counts.sum(axis=2) - angry_counts, angry_counts),
+            axis=1)
+        price_lows = np.maximum(self.bin_lows[competitor_ids], lows[:, None])
+        price_highs = np.minimum(self.bin_highs[competitor_ids], highs[:, None])
+        in_bounds = price_lows <= price_highs
+        prices = rng.integers(
+            np.where(in_bounds, price_lows, 0),
+            np.where(in_bounds, price_highs, 0) + 1)
+        revenues = np.where(in_bounds, prices * sale_probabilities, -np.inf)
+        best_bins = revenues.argmax(axis=1)
+        competitor_indices = np.arange(len(competitor_ids))
+        return (
+            prices[competitor_indices, best_bins],
+            revenues[competitor_indices, best_bins])
+    def record_reaction(self, item_id, price, mood):
+        # Compaction can drop the initial bounds, leaving bins split from
+        # later ones that reactions replayed from the database can fall outside
+        if not self.bin_lows[item_id, 0] <= price <= self.bin_highs[item_id, -1]:
+            return
+        bin_index = np.searchsorted(self.bin_highs[item_id], price)
+        # An angry customer would be angry at any higher price and the others
+        # would pay any lower one
+        if mood == 'angry':
+            self.mood_counts[item_id, bin_index:, MOODS.index(mood)] += 1
+        else:
+            self.mood_counts[item_id, :bin_index + 1, MOODS.index(mood)] += 1
+
+PRICING_STRATEGIES = {
+    'interval': IntervalPricingStrategy,
+    'posterior': PosteriorPricingStrategy}
+
+class MoonlighterEngine:
+    """In-memory copy of the shop state that runs the same simulation as the
+    SQL helpers and writes the resulting history rows to the database in
+    batches.
+
+    Item arrays are indexed by position in the sorted item list, which is the
+    order get_inventory_item_price_bounds returns competitors in, so draws
+    line up with the SQL implementation for the same rng.
+    """
+    def __init__(
+            self, items, shelf_ids, shelf_items, shelf_prices, inventory_counts,
+            lows, highs, has_price_bounds, reaction_bounds,
+            next_competition_index, next_reaction_id, history_rowids=None,
+            flush_every=None, batch_fills=False, visits_per_tick=None,
+            competition_storage='full', pricing_strategy='interval',
+            initial_lows=None, initial_highs=None, compact_every=None,
+            retain_rows=DEFAULT_RETAIN_ROWS):
+        self.items = list(items)
+        self.item_ids = {item: i for i, item in enumerate(self.items)}
+        self.shelf_ids = np.asarray(shelf_ids, dtype=np.int64)
+        self.shelf_items = np.asarray(shelf_items, dtype=np.int64)
+        self.shelf_prices = np.asarray(shelf_prices, dtype=np.int64)
+        self.inventory_counts = np.asarray(inventory_counts, dtype=np.int64)
+        self.lows = np.asarray(lows, dtype=np.int64)
+        self.highs = np.asarray(highs, dtype=np.int64)
+        self.has_price_bounds = np.asarray(has_price_bounds, dtype=bool)
+        self.reaction_bounds = np.asarray(reaction_bounds, dtype=np.int64)
+        self.next_competition_index = next_competition_index
+        self.next_reaction_id = next_reaction_id
+        # Last price_bound_history and inventory_changes rowids, which winner
+        # records keep as watermarks for reconstructing their competitions
+        self.history_rowids = dict(
+            {'price_bound_history_rowid': 0, 'inventory_changes_rowid': 0}
+            if history_rowids is None else
+            history_rowids)
+        self.flush_every = flush_every
+        self.compact_every = compact_every
+        self.retain_rows = retain_rows
+        self.batch_fills = batch_fills
+        self.visits_per_tick = visits_per_tick
+        if batch_fills and competition_storage != 'full':
+            raise Exception('Batched fills only support full competition storage')
+        self.competition_storage = competition_storage
+        if pricing_strategy not in PRICING_STRATEGIES:
+            raise Exception(f'Unknown pricing strategy {pricing_strategy}')
+        # Batched fills and winner records replay uniform draws from the
+        # price bounds
+        if pricing_strategy != 'interval' and (batch_fills or competition_storage != 'full'):
+            raise Exception(
+                'Batched fills and winner storage only support the interval pricing strategy')
+        self.pricing_strategy = pricing_strategy
+        # Price bounds the run started with, which default to the current ones
+        self.strategy = PRICING_STRATEGIES[pricing_strategy](
+            self.lows if initial_lows is None else np.asarray(initial_lows, dtype=np.int64),
+            self.highs if initial_highs is None else np.asarray(initial_highs, dtype=np.int64))
+        self.tick_count = 0
+        self.revenue = 0
+        self.reaction_count = 0
+        # Tick each item's price bounds settled in, with 0 for items that
+        # were already settled
+        self.convergence_ticks = {
+            self.items[i]: 0
+            for i in np.flatnonzero(self.has_price_bounds & (self.lows == self.highs))}
+        self.last_reaction_prices = np.full(len(self.items), EMPTY, dtype=np.int64)
+        self.pending_rows = {table: [] for table in HISTORY_TABLE_COLUMNS}
+
+    @classmethod
+    def from_config(
+            cls, shelf_count, item_counts, price_bounds, price_reaction_bounds,
+            flush_every=None, batch_fills=False, visits_per_tick=None,
+            competition_storage='full', pricing_strategy='interval',
+            compact_every=None, retain_rows=DEFAULT_RETAIN_ROWS):
+        # Same starting state as from_database after initialize_simulation,
+        # without touching a database
+        price_bound_records = get_price_bound_records(price_bounds)
+        items = sorted(
+            set(item_counts)
+            | {x['item'] for x in price_bound_records}
+            | {x['item'] for x in price_reaction_bounds})
+        item_ids = {item: i for i, item in enumerate(items)}
+        inventory_counts = np.zeros(len(items), dtype=np.int64)
+        for item, count in item_counts.items():
+            inventory_counts[item_ids[item]] += count
+        lows = np.zeros(len(items), dtype=np.int64)
+        highs = np.zeros(len(items), dtype=np.int64)
+        has_price_bounds = np.zeros(len(items), dtype=bool)
+        for x in price_bound_records:
+            lows[item_ids[x['item']]] = x['low']
+            highs[item_ids[x['item']]] = x['high']
+            has_price_bounds[item_ids[x['item']]] = True
+        reaction_bounds = np.full((len(items), 3), np.iinfo(np.int64).min)
+        for x in reversed(price_reaction_bounds):
+            reaction_bounds[item_ids[x['item']]] = [
+                x['cheap_upper'], x['perfect_upper'], x['expensive_upper']]
+        return cls(
+            items=items,
+            shelf_ids=range(shelf_count),
+            shelf_items=[EMPTY] * shelf_count,
+            shelf_prices=[0] * shelf_count,
+            inventory_counts=inventory_counts,
+            lows=lows,
+            highs=highs,
+            has_price_bounds=has_price_bounds,
+            reaction_bounds=reaction_bounds,
+            next_competition_index=0,
+            next_reaction_id=1,
+            history_rowids={
+                'price_bound_history_rowid': len(price_bound_records),
+                'inventory_changes_rowid': len(item_counts)},
+            flush_every=flush_every,
+            batch_fills=batch_fills,
+            visits_per_tick=visits_per_tick,
+            competition_storage=competition_storage,
+            pricing_strategy=pricing_strategy,
+            compact_every=compact_every,
+            retain_rows=retain_rows)
+
+    @classmethod
+    @profiled_helper
+    def from_database(
+            cls, flush_every=None, batch_fills=False, visits_per_tick=None,
+            competition_storage='full', pricing_strategy='interval',
+            compact_every=None, retain_rows=DEFAULT_RETAIN_ROWS):
+        items = get_database_items()
+        item_ids = {item: i for i, item in enumerate(items)}
+        inventory_counts = np.zeros(len(items), dtype=np.int64)
+        for item, count in get_inventory_totals():
+            inventory_counts[item_ids[item]] = count
+        lows = np.zeros(len(items), dtype=np.int64)
+        highs = np.zeros(len(items), dtype=np.int64)
+        has_price_bounds = np.zeros(len(items), dtype=bool)
+        for item, low, high in get_latest_price_bounds():
+            lows[item_ids[item]] = low
+            highs[item_ids[item]] = high
+            has_price_bounds[item_ids[item]] = True
+        initial_lows = lows.copy()
+        initial_highs = highs.copy()
+        for item, low, high in query_rows("""
+                select
+                    item,
+                    low,
+                    high
+                from price_bound_history
+                where
+                    rowid in (
+                        select
+                            max(rowid)
+                        from price_bound_history
+                        where
+                            reaction_id is null
+                            and shop_id = 0
+                        group by
+                            item)"""):
+            initial_lows[item_ids[item]] = low
+            initial_highs[item_ids[item]] = high
+        # Items without reaction bounds always make customers angry, as the
+        # null comparisons in get_random_shelf_reaction do
+        reaction_bounds = np.full((len(items), 3), np.iinfo(np.int64).min)
+        seen_items = set()
+        for item, *bounds in query_rows("""
+                select
+                    item,
+                    cheap_upper,
+                    perfect_upper,
+                    expensive_upper
+                from price_reaction_bounds"""):
+            if item not in seen_items:
+                reaction_bounds[item_ids[item]] = bounds
+                seen_items.add(item)
+        shelves = query_rows("""
+            select
+                id,
+                item,
+                price
+            from shelves
+            order by
+                rowid""")
+        engine = cls(
+            items=items,
+            shelf_ids=[shelf_id for shelf_id, _, _ in shelves],
+            shelf_items=[
+                EMPTY if item is None else item_ids[item]
+                for _, item, _ in shelves],
+            shelf_prices=[
+                0 if price is None else price
+                for _, _, price in shelves],
+            inventory_counts=inventory_counts,
+            lows=lows,
+            highs=highs,
+            has_price_bounds=has_price_bounds,
+            reaction_bounds=reaction_bounds,
+            next_competition_index=get_next_competition_index(),
+            next_reaction_id=get_next_reaction_id(),
+            history_rowids=get_history_rowid_watermarks(),
+            flush_every=flush_every,
+            batch_fills=batch_fills,
+            visits_per_tick=visits_per_tick,
+            competition_storage=competition_storage,
+            pricing_strategy=pricing_strategy,
+            initial_lows=initial_lows,
+            initial_highs=initial_highs,
+            compact_every=compact_every,
+            retain_rows=retain_rows)
+        if pricing_strategy != 'interval':
+            # The posterior is rebuilt from the reactions kept in full
+            for item, price, mood in query_rows("""
+                    select
+                        item,
+                        price,
+                        mood
+                    from reactions
+                    where
+                        shop_id = 0
+                    order by
+                        rowid"""):
+                engine.strategy.record_reaction(item_ids[item], price, mood)
+        return engine
+
+    def get_inventory_item_count(self):
+        return int(self.inventory_counts[self.inventory_counts >= 0].sum())
+    def get_shelf_item_count(self):
+        return int((self.shelf_items != EMPTY).sum())
+    def get_mood(self, item_id, price):
+        return MOODS[int((price > self.reaction_bounds[item_id]).sum())]
+    def get_random_shelf_reaction(self, rng):
+        shelf_index = int(rng.choice(np.flatnonzero(self.shelf_items != EMPTY)))
+        return {
+            'shelf_index': shelf_index,
+            'mood': self.get_mood(
+                self.shelf_items[shelf_index],
+                self.shelf_prices[shelf_index])}
+    def record_reaction(self, shelf_index, mood):
+        item_id = int(self.shelf_items[shelf_index])
+        price = int(self.shelf_prices[shelf_index])
+        self.pending_rows['reactions'].append(
+            (int(self.shelf_ids[shelf_index]), self.items[item_id], price, mood))
+        self.last_reaction_prices[item_id] = price
+        self.strategy.record_reaction(item_id, price, mood)
+        self.reaction_count += 1
+        if mood != 'angry':
+            self.revenue += price
+        self.update_price_bounds(
+            reaction_id=self.next_reaction_id,
+            item_id=item_id,
+            price=price,
+            mood=mood)
+        self.next_reaction_id += 1
+    def update_price_bounds(self, reaction_id, item_id, price, mood):
+        low, high = get_updated_price_bounds(
+            low=int(self.lows[item_id]),
+            high=int(self.highs[item_id]),
+            price=price,
+            mood=mood)
+        self.lows[item_id] = low
+        self.highs[item_id] = high
+        if low == high:
+            self.convergence_ticks.setdefault(self.items[item_id], self.tick_count + 1)
+        self.pending_rows['price_bound_history'].append(
+            (reaction_id, self.items[item_id], low, high))
+        self.history_rowids['price_bound_history_rowid'] += 1
+    def add_item_2_inventory(self, item_id, change=1):
+        self.inventory_counts[item_id] += change
+        self.pending_rows['inventory_changes'].append(
+            (self.items[item_id], change))
+        self.history_rowids['inventory_changes_rowid'] += 1
+    def empty_shelf(self, shelf_index):
+        self.shelf_items[shelf_index] = EMPTY
+        self.shelf_prices[shelf_index] = 0
+        self.pending_rows['shelf_history'].append(
+            (int(self.shelf_ids[shelf_index]), None, None))
+    def move_item_2_shelf_and_set_price(self, item_id, shelf_index, price):
+        self.add_item_2_inventory(item_id, change=-1)
+        self.pending_rows['shelf_history'].append(
+            (int(self.shelf_ids[shelf_index]), self.items[item_id], price))
+        self.shelf_items[shelf_index] = item_id
+        self.shelf_prices[shelf_index] = price
+    def run_thompson_competition(self, rng):
+        competitor_ids = np.flatnonzero(
+            (self.inventory_counts > 0) & self.has_price_bounds)
+        lows = self.lows[competitor_ids]
+        highs = self.highs[competitor_ids]
+        rng_state = rng.bit_generator.state
+        if self.competition_storage == 'pruned':
+            competition = get_pruned_thompson_competition(lows, highs, rng)
+            sampled_prices = competition['sampled_prices']
+            winner_index = competition['winner_index']
+            stored = competition['sampled']
+        else:
+            sampled_prices, scores = self.strategy.sample_prices(competitor_ids, lows, highs, rng)
+            winner_index = get_thompson_winner_index(scores, rng)
+            stored = slice(None)
+        if self.competition_storage in ('full', 'pruned'):
+            stored_ids = competitor_ids[stored]
+            self.pending_rows['thompson_competitions'].extend(
+                zip(
+                    [self.next_competition_index] * len(stored_ids),
+                    [self.items[i] for i in stored_ids],
+                    lows[stored].tolist(),
+                    highs[stored].tolist(),
+                    sampled_prices[stored].tolist()))
+            # Competitions are numbered from their stored rows, so one that
+            # only settled items entered leaves its number to the next
+            if len(stored_ids) > 0:
+                self.next_competition_index += 1
+        elif self.competition_storage == 'winners':
+            self.pending_rows['thompson_competition_winners'].append((
+                self.next_competition_index,
+                self.items[competitor_ids[winner_index]],
+                int(sampled_prices[winner_index]),
+                len(competitor_ids),
+                json.dumps(rng_state),
+                self.history_rowids['price_bound_history_rowid'],
+                self.history_rowids['inventory_changes_rowid']))
+            self.next_competition_index += 1
+        else:
+            raise Exception(f'Unknown competition storage {self.competition_storage}')
+        return int(competitor_ids[winner_index]), int(sampled_prices[winner_index])
+    def fill_shelf_w_priced_item(self, shelf_index, rng):
+        item_id, price = self.run_thompson_competition(rng)
+        self.move_item_2_shelf_and_set_price(
+            item_id=item_id,
+            shelf_index=shelf_index,
+            price=price)
+    def fill_empty_shelves_w_priced_items(self, rng):
+        empty_shelf_indices = np.flatnonzero(self.shelf_items == EMPTY)
+        for shelf_index in empty_shelf_indices[:self.get_inventory_item_count()]:
+            self.fill_shelf_w_priced_item(shelf_index, rng)
+    def fill_empty_shelves_w_priced_items_batched(self, rng):
+        empty_shelf_indices = (
+            np.flatnonzero(self.shelf_items == EMPTY)
+            [:self.get_inventory_item_count()])
+        if len(empty_shelf_indices) == 0:
+            return
+        competitor_ids = np.flatnonzero(
+            (self.inventory_counts > 0) & self.has_price_bounds)
+        batch = get_batch_thompson_competitions(
+            items=[self.items[i] for i in competitor_ids],
+            lows=self.lows[competitor_ids],
+            highs=self.highs[competitor_ids],
+            inventory_counts=self.inventory_counts[competitor_ids],
+            shelf_ids=empty_shelf_indices.tolist(),
+            rng=rng,
+            next_competition_index=self.next_competition_index)
+        self.pending_rows['thompson_competitions'].extend(
+            tuple(row.values()) for row in batch['competition_data'])
+        self.next_competition_index += len(batch['assignments'])
+        for assignment in batch['assignments']:
+            self.move_item_2_shelf_and_set_price(
+                item_id=self.item_ids[assignment['item']],
+                shelf_index=assignment['shelf_id'],
+                price=assignment['price'])
+    def fill_empty_shelves(self, rng):
+        if self.batch_fills:
+            self.fill_empty_shelves_w_priced_items_batched(rng)
+        else:
+            self.fill_empty_shelves_w_priced_items(rng)
+    def get_price_bound_violating_shelf_indices(self):
+        occupied = self.shelf_items != EMPTY
+        shelf_items = np.where(occupied, self.shelf_items, 0)
+        return np.flatnonzero(
+            occupied
+            & self.has_price_bounds[shelf_items]
+            & (
+                (self.shelf_prices < self.lows[shelf_items])
+                | (self.shelf_prices > self.highs[shelf_items])))
+    def replace_items_on_shelf_violating_price_bounds(self, rng):
+        for shelf_index in self.get_price_bound_violating_shelf_indices():
+            item_id = int(self.shelf_items[shelf_index])
+            self.empty_shelf(shelf_index)
+            self.add_item_2_inventory(item_id)
+            self.fill_shelf_w_priced_item(shelf_index, rng)
+    def record_shelf_reaction(self, shelf_index, mood):
+        self.record_reaction(
+            shelf_index=shelf_index,
+            mood=mood)
+        if mood == 'angry':
+            self.add_item_2_inventory(int(self.shelf_items[shelf_index]))
+        self.empty_shelf(shelf_index)
+    def record_batch_shelf_reactions(self, visit_count, rng):
+        occupied = np.flatnonzero(self.shelf_items != EMPTY)
+        visited = rng.choice(
+            occupied,
+            size=min(visit_count, len(occupied)),
+            replace=False)
+        mood_indices = get_reaction_mood_indices(
+            item_ids=self.shelf_items[visited],
+            prices=self.shelf_prices[visited],
+            reaction_bounds=self.reaction_bounds)
+        for shelf_index, mood_index in zip(visited, mood_indices):
+            self.record_shelf_reaction(shelf_index, MOODS[mood_index])
+    def run_simulation_tick(self, rng):
+        if self.visits_per_tick is None:
+            shelf_reaction = self.get_random_shelf_reaction(rng)
+            self.record_shelf_reaction(
+                shelf_index=shelf_reaction['shelf_index'],
+                mood=shelf_reaction['mood'])
+        else:
+            self.record_batch_shelf_reactions(self.visits_per_tick, rng)
+        self.fill_empty_shelves(rng)
+        self.replace_items_on_shelf_violating_price_bounds(rng)
+        self.tick_count += 1
+        # Compaction works on the database, so the buffered rows go first
+        is_compacting = self.compact_every is not None and self.tick_count % self.compact_every == 0
+        if is_compacting or (self.flush_every is not None and self.tick_count % self.flush_every == 0):
+            self.flush()
+        if is_compacting:
+            compact_history(retain_rows=self.retain_rows)
+    def run_until_sold_out(self, rng, max_ticks=None):
+        self.fill_empty_shelves(rng)
+        tick_count = 0
+        while (
+                (max_ticks is None or tick_count < max_ticks)
+                and (self.get_inventory_item_count() or self.get_shelf_item_count())):
+            self.run_simulation_tick(rng)
+            tick_count += 1
+        return tick_count
+    def run_simulation_ticks(self, rng, max_ticks=None):
+        tick_count = self.run_until_sold_out(rng, max_ticks=max_ticks)
+        self.flush()
+        return tick_count
+    def get_summary(self):
+        return {
+            'ticks': self.tick_count,
+            'reactions': self.reaction_count,
+            'revenue': self.revenue,
+            'final_prices': {
+                item: int(price)
+                for item, price in zip(self.items, self.last_reaction_prices)
+                if price != EMPTY},
+            'convergence_ticks': dict(sorted(self.convergence_ticks.items()))}
+    def get_pending_inventory_changes(self):
+        item_changes = Counter()
+        for item, change in self.pending_rows['inventory_changes']:
+            item_changes[item] += change
+        return dict(item_changes)
+    @profiled_helper
+    def flush(self):
+        with database_transaction():
+            for table, rows in self.pending_rows.items():
+                if rows:
+                    execute_many_queries(
+                        f"""
+                        insert into {table}({', '.join(HISTORY_TABLE_COLUMNS[table])}) values(
+                            {', '.join(['?'] * len(HISTORY_TABLE_COLUMNS[table]))})""",
+                        rows)
+            execute_many_queries(
+                """
+                update shelves
+                set
+                    item = ?,
+                    price = ?
+                where
+                    id = ?""",
+                [
+                    (
+                        (None, None) if item_id == EMPTY else
+                        (self.items[item_id], int(price)))
+                    + (int(shelf_id),)
+                    for shelf_id, item_id, price in zip(
+                        self.shelf_ids, self.shelf_items, self.shelf_prices)])
+            update_inventory(item_changes=self.get_pending_inventory_changes())
+        self.pending_rows = {table: [] for table in HISTORY_TABLE_COLUMNS}
+
+def get_argument_parser():
+    # Only the options the engine acts on, so that maintenance flags such as
+    # --resume are rejected instead of starting a fresh run over the database
+    parser = get_simulation_argument_parser(
+        'Simulate Bayesian bandit pricing of a Moonlighter shop in memory, '
+        'writing the history to the database in batches.')
+    parser.add_argument(
+        '--flush-every',
+        type=int,
+        help='Write buffered history to the database every this many ticks.')
+    parser.add_argument(
+        '--pricing-strategy',
+        choices=list(PRICING_STRATEGIES),
+        default='interval',
+        help=(
+            'Sample prices uniformly from the price bounds, or from a posterior '
+            'over the moods seen at each price bin within them.'))
+    parser.add_argument(
+        '--compact-every',
+        type=int,
+        help='Flush and compact the history tables every this many ticks.')
+    parser.add_argument(
+        '--retain-rows',
+        type=int,
+        default=DEFAULT_RETAIN_ROWS,
+        help='Latest rows of each history table that compaction keeps in full.')
+    return parser
+
+if __name__ == '__main__':
+    args = get_argument_parser().parse_args()
+    with moonlighter_session(
+            args.db_path,
+            journal_mode=args.journal_mode,
+            synchronous=args.synchronous):
+        initialize_simulation()
+        engine = MoonlighterEngine.from_database(
+            flush_every=args.flush_every,
+            batch_fills=args.batch_fills,
+            visits_per_tick=args.visits_per_tick,
+            competition_storage=args.competition_storage,
+            pricing_strategy=args.pricing_strategy,
+            compact_every=args.compact_every,
+            retain_rows=args.retain_rows)
+        with (
+                profile_queries(args.profile_trace)
+                if args.profile or args.profile_trace else
+                nullcontext()) as profiler:
+            engine.run_simulation_ticks(np.random.default_rng(args.seed))
+        print_convergence_ticks(engine.get_summary()['convergence_ticks'])
+        if profiler is not None:
+            print(get_query_profile_summary(profiler).to_string(index=False))
@@ -0,0 +1,247 @@
+import argparse
+import heapq
+import time
+import numpy as np
+from moonlighter_engine import MoonlighterEngine
+from moonlighter_pricing import (
+    DEFAULT_DB_PATH,
+    DEFAULT_ITEM_COUNTS,
+    DEFAULT_RETAIN_ROWS,
+    DEFAULT_SEED,
+    DEFAULT_SHELF_COUNT,
+    compact_history,
+    initialize_simulation,
+    moonlighter_session)
+
+# Minutes the shop is open each day
+DEFAULT_DAY_LENGTH = 600
+# Deliveries are stocked before the customers arriving at the same minute,
+# and a day closes after its last customers
+EVENT_PRIORITIES = {'restock': 0, 'arrival': 1, 'day': 2}
+
+def get_poisson_arrival_counts(rng, arrival_rate, day_length):
+    return rng.poisson(arrival_rate, size=day_length)
+def get_trace_arrival_counts(arrival_trace, day, day_length):
+    # Trace timestamps are minutes since the shop first opened
+    start, end = np.searchsorted(arrival_trace, [day * day_length, (day + 1) * day_length])
+    return np.bincount(
+        (arrival_trace[start:end] - day * day_length).astype(np.int64),
+        minlength=day_length)
+
+class EventScheduler:
+    """Discrete-event simulation of a shop over days of integer minutes.
+
+    Customers arrive through a Poisson process or a trace of arrival minutes,
+    deliveries restock the inventory and day boundaries flush the engine's
+    history to the database, compacting it every compact_every days. All
+    events due at the same minute are popped as one batch and handled kind by
+    kind in EVENT_PRIORITIES order: arriving customers visit distinct occupied
+    shelves through record_batch_shelf_reactions, and customers left without
+    a shelf to visit walk out. Each batch of customers counts as one engine
+    tick.
+    """
+    def __init__(
+            self, engine, arrival_rate=None, arrival_trace=None,
+            day_length=DEFAULT_DAY_LENGTH, restock_item_counts=None,
+            restock_every=None, compact_every=None, retain_rows=DEFAULT_RETAIN_ROWS):
+        if (arrival_rate is None) == (arrival_trace is None):
+            raise Exception('Give either an arrival rate or an arrival trace')
+        if restock_every is not None and not restock_item_counts:
+            raise Exception('Restocks need the item counts to deliver')
+        self.engine = engine
+        self.arrival_rate = arrival_rate
+        self.arrival_trace = (
+            None if arrival_trace is None else
+            np.sort(np.floor(np.asarray(arrival_trace, dtype=float))))
+        self.day_length = day_length
+        self.restock_item_counts = {
+            engine.item_ids[item]: count
+            for item, count in (restock_item_counts or {}).items()}
+        self.restock_every = restock_every
+        self.compact_every = compact_every
+        self.retain_rows = retain_rows
+        self.events = []
+        self.event_count = 0
+        self.day = 0
+        self.customer_count = 0
+        self.walkout_count = 0
+        self.daily_summaries = []
+        self.day_start = None
+
+    def schedule(self, minute, kind, payload):
+        # The event count breaks ties between events of the same kind
+        heapq.heappush(self.events, (minute, EVENT_PRIORITIES[kind], self.event_count, kind, payload))
+        self.event_count += 1
+    def pop_batch(self):
+        # The heap pops the minute's events in priority order, which the
+        # payloads grouped by kind keep
+        minute = self.events[0][0]
+        batch = {}
+        while self.events and self.events[0][0] == minute:
+            _, _, _, kind, payload = heapq.heappop(self.events)
+            batch.setdefault(kind, []).append(payload)
+        return minute, batch
+    def open_day(self, rng):
+        start = self.day * self.day_length
+        arrival_counts = (
+            get_poisson_arrival_counts(rng, self.arrival_rate, self.day_length)
+            if self.arrival_trace is None else
+            get_trace_arrival_counts(self.arrival_trace, self.day, self.day_length))
+        for minute in np.flatnonzero(arrival_counts):
+            self.schedule(start + int(minute), 'arrival', int(arrival_counts[minute]))
+        if self.restock_every is not None and self.day % self.restock_every == 0 and self.day > 0:
+            self.schedule(start, 'restock', self.restock_item_counts)
+        self.schedule(start + self.day_length, 'day', self.day)
+        self.day_start = {
+            'customers': self.customer_count,
+            'walkouts': self.walkout_count,
+            'reactions': self.engine.reaction_count,
+            'revenue': self.engine.revenue}
+    def close_day(self):
+        self.engine.flush()
+        if self.compact_every is not None and (self.day + 1) % self.compact_every == 0:
+            compact_history(retain_rows=self.retain_rows)
+        self.daily_summaries.append(
+            {'day': self.day}
+            | {
+                name: value - self.day_start[name]
+                for name, value in [
+                    ('customers', self.customer_count),
+                    ('walkouts', self.walkout_count),
+                    ('reactions', self.engine.reaction_count),
+                    ('revenue', self.engine.revenue)]})
+        self.day += 1
+    def handle_arrivals(self, customer_count, rng):
+        engine = self.engine
+        visit_count = min(customer_count, engine.get_shelf_item_count())
+        self.customer_count += customer_count
+        self.walkout_count += customer_count - visit_count
+        if visit_count:
+            engine.record_batch_shelf_reactions(visit_count, rng)
+            engine.fill_empty_shelves(rng)
+            engine.replace_items_on_shelf_violating_price_bounds(rng)
+        engine.tick_count += 1
+    def handle_restock(self, item_counts, rng):
+        for item_id, count in item_counts.items():
+            self.engine.add_item_2_inventory(item_id, change=count)
+        self.engine.fill_empty_shelves(rng)
+    def is_sold_out(self):
+        return (
+            self.restock_every is None
+            and not self.engine.get_inventory_item_count()
+            and not self.engine.get_shelf_item_count())
+    def run(self, rng, days, max_customers=None):
+        start = time.perf_counter()
+        batch_count = 0
+        event_count = 0
+        self.engine.fill_empty_shelves(rng)
+        self.open_day(rng)
+        is_done = False
+        while self.events and not is_done:
+            minute, batch = self.pop_batch()
+            batch_count += 1
+            event_count += sum(len(payloads) for payloads in batch.values())
+            for kind, payloads in batch.items():
+                if kind == 'restock':
+                    for item_counts in payloads:
+                        self.handle_restock(item_counts, rng)
+                elif kind == 'arrival':
+                    self.handle_arrivals(sum(payloads), rng)
+                    if max_customers is not None and self.customer_count >= max_customers:
+                        self.close_day()
+                        is_done = True
+                        break
+                else:
+                    self.close_day()
+                    if self.day >= days or self.is_sold_out():
+                        is_done = True
+                        break
+                    self.open_day(rng)
+        seconds = time.perf_counter() - start
+        return {
+            'days': self.day,
+            'customers': self.customer_count,
+            'walkouts': self.walkout_count,
+            'reactions': self.engine.reaction_count,
+            'revenue': self.engine.revenue,
+            'event_batches': batch_count,
+            'events': event_count,
+            'seconds': seconds,
+            # Walkouts cost next to nothing, so throughput is measured in the
+            # reactions and events actually handled
+            'reactions_per_second': self.engine.reaction_count / seconds if seconds else None,
+            'events_per_second': event_count / seconds if seconds else None,
+            'daily': self.daily_summaries}
+def run_event_simulation(
+        rng, days, arrival_rate=None, arrival_trace=None,
+        day_length=DEFAULT_DAY_LENGTH, restock_item_counts=None,
+        restock_every=None, max_customers=None, compact_every=None,
+        retain_rows=DEFAULT_RETAIN_ROWS, **engine_kwargs):
+    # Runs on the active session's database from its current state
+    return (
+        EventScheduler(
+            MoonlighterEngine.from_database(**engine_kwargs),
+            arrival_rate=arrival_rate,
+            arrival_trace=arrival_trace,
+            day_length=day_length,
+            restock_item_counts=restock_item_counts,
+            restock_every=restock_every,
+            compact_every=compact_every,
+            retain_rows=retain_rows)
+        .run(rng, days=days, max_customers=max_customers))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Simulate days of customer arrivals and deliveries as discrete events.')
+    parser.add_argument('--db-path', default=DEFAULT_DB_PATH)
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--day-length', type=int, default=DEFAULT_DAY_LENGTH)
+    parser.add_argument('--shelf-count', type=int, default=DEFAULT_SHELF_COUNT)
+    parser.add_argument(
+        '--arrival-rate',
+        type=float,
+        default=0.5,
+        help='Mean customers arriving per minute, as a Poisson process.')
+    parser.add_argument(
+        '--arrival-trace',
+        help='Text file of customer arrival minutes to replay instead of Poisson arrivals.')
+    parser.add_argument(
+        '--restock-every',
+        type=int,
+        help='Deliver the starting item counts again at the start of every this many days.')
+    parser.add_argument('--max-customers', type=int)
+    parser.add_argument(
+        '--compact-every',
+        type=int,
+        help='Compact the history tables at the close of every this many days.')
+    parser.add_argument(
+        '--retain-rows',
+        type=int,
+        default=DEFAULT_RETAIN_ROWS,
+        help='Latest rows of each history table that compaction keeps in full.')
+    parser.add_argument(
+        '--batch-fills',
+        action='store_true',
+        help='Price all empty shelves with one batched Thompson draw.')
+    args = parser.parse_args()
+    with moonlighter_session(args.db_path):
+        initialize_simulation(shelf_count=args.shelf_count)
+        summary = run_event_simulation(
+            np.random.default_rng(args.seed),
+            days=args.days,
+            arrival_rate=None if args.arrival_trace is not None else args.arrival_rate,
+            arrival_trace=None if args.arrival_trace is None else np.loadtxt(args.arrival_trace, ndmin=1),
+            day_length=args.day_length,
+            restock_item_counts=DEFAULT_ITEM_COUNTS,
+            restock_every=args.restock_every,
+            max_customers=args.max_customers,
+            compact_every=args.compact_every,
+            retain_rows=args.retain_rows,
+            batch_fills=args.batch_fills)
+    print(
+        f"{summary['customers']} customers ({summary['walkouts']} walked out) over "
+        f"{summary['days']} days, {summary['reactions']} reactions and {summary['events']} events "
+        f"in {summary['event_batches']} batches, {summary['seconds']:.2f} s "
+        f"({summary['reactions_per_second']:.0f} reactions/sec, "
+        f"{summary['events_per_second']:.0f} events/sec), revenue {summary['revenue']}")
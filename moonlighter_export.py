@@ -0,0 +1,170 @@
+from pathlib import Path
+import argparse
+import json
+import time
+import numpy as np
+from moonlighter_pricing import (
+    DEFAULT_DB_PATH,
+    MOODS,
+    database_transaction,
+    moonlighter_session,
+    profiled_helper,
+    query_rows,
+    query_value)
+
+EXPORT_TABLE_COLUMNS = {
+    'reactions': ['shop_id', 'shelf_id', 'item', 'price', 'mood'],
+    'price_bound_history': ['shop_id', 'reaction_id', 'item', 'low', 'high'],
+    'inventory_changes': ['shop_id', 'item', 'change'],
+    'thompson_competitions': [
+        'shop_id', 'competition_ind', 'item', 'price_lower_bound',
+        'price_upper_bound', 'sampled_price']}
+CATEGORICAL_COLUMNS = ['item', 'mood']
+# Stored in place of null in the integer columns that have them, which are
+# ids like the reaction_id of initial price bounds and never negative
+MISSING = -1
+
+@profiled_helper
+def get_categories():
+    return {
+        'item': [
+            x[0]
+            for x in query_rows("""
+                select item from price_bound_history
+                union
+                select item from inventory_changes
+                union
+                select item from reactions
+                union
+                select item from thompson_competitions
+                order by
+                    item""")],
+        'mood': MOODS}
+def get_code_dtype(categories):
+    return np.min_scalar_type(max(len(categories) - 1, 0))
+@profiled_helper
+def get_integer_dtype(table, column, max_rowid):
+    low, high, has_nulls = query_rows(
+        f"""
+        select
+            min({column}),
+            max({column}),
+            count(*) > count({column})
+        from {table}
+        where
+            rowid <= :max_rowid""",
+        {'max_rowid': max_rowid})[0]
+    if has_nulls and low is not None and low <= MISSING:
+        raise Exception(f'{table}.{column} has nulls and values that could be mistaken for them')
+    return np.promote_types(
+        np.min_scalar_type(min(0 if low is None else low, MISSING if has_nulls else 0)),
+        np.min_scalar_type(0 if high is None else high))
+def get_column_dtypes(table, categories, max_rowid):
+    return {'rowid': np.dtype(np.int64)} | {
+        column: (
+            get_code_dtype(categories[column])
+            if column in CATEGORICAL_COLUMNS else
+            get_integer_dtype(table, column, max_rowid))
+        for column in EXPORT_TABLE_COLUMNS[table]}
+def get_column_values(values, column, category_codes):
+    if column in CATEGORICAL_COLUMNS:
+        return np.fromiter(map(category_codes[column].__getitem__, values), np.int64, len(values))
+    if None in values:
+        return np.array([MISSING if x is None else x for x in values])
+    return np.array(values)
+@profiled_helper
+def export_table(output_dir, table, categories, max_rowid, chunksize=100000):
+    category_codes = {
+        column: {category: code for code, category in enumerate(categories[column])}
+        for column in CATEGORICAL_COLUMNS}
+    row_count = query_value(
+        f"select count(*) from {table} where rowid <= :max_rowid",
+        {'max_rowid': max_rowid})
+    dtypes = get_column_dtypes(table, categories, max_rowid)
+    columns = {
+        column: np.lib.format.open_memmap(
+            output_dir / f'{table}.{column}.npy',
+            mode='w+',
+            dtype=dtype,
+            shape=(row_count,))
+        for column, dtype in dtypes.items()}
+    # Rows are read a chunk at a time by rowid, so neither the table nor a
+    # whole column is ever held in memory
+    start, last_rowid = 0, 0
+    while start < row_count:
+        rows = query_rows(
+            f"""
+            select
+                rowid,
+                {', '.join(EXPORT_TABLE_COLUMNS[table])}
+            from {table}
+            where
+                rowid > :last_rowid
+                and rowid <= :max_rowid
+            order by
+                rowid
+            limit :chunksize""",
+            {'last_rowid': last_rowid, 'max_rowid': max_rowid, 'chunksize': chunksize})
+        for column, values in zip(dtypes, zip(*rows)):
+            columns[column][start:start + len(rows)] = get_column_values(values, column, category_codes)
+        start += len(rows)
+        last_rowid = rows[-1][0]
+    for column in columns.values():
+        column.flush()
+    return {
+        'rows': row_count,
+        'columns': {column: dtype.str for column, dtype in dtypes.items()}}
+def export_history(output_dir, tables=list(EXPORT_TABLE_COLUMNS), chunksize=100000):
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    # One read transaction gives every table the same snapshot while a writer
+    # carries on, and each table is read up to the rowid it had at the start
+    with database_transaction():
+        max_rowids = {
+            table: query_value(f"select coalesce(max(rowid), 0) from {table}")
+            for table in tables}
+        categories = get_categories()
+        manifest = {
+            'categories': categories,
+            'missing': MISSING,
+            'tables': {
+                table: export_table(output_dir, table, categories, max_rowids[table], chunksize=chunksize)
+                for table in tables}}
+    (output_dir / 'manifest.json').write_text(json.dumps(manifest, indent=4))
+    return {
+        'rows': sum(x['rows'] for x in manifest['tables'].values()),
+        'seconds': time.perf_counter() - start}
+def load_history(export_dir):
+    """Memory-map an export_history directory.
+
+    Returns each table as a dict of column arrays, with item and mood as
+    codes into the returned categories and null integers as MISSING.
+    """
+    export_dir = Path(export_dir)
+    manifest = json.loads((export_dir / 'manifest.json').read_text())
+    return {
+        'categories': {
+            column: np.array(categories)
+            for column, categories in manifest['categories'].items()},
+        'tables': {
+            table: {
+                column: np.load(export_dir / f'{table}.{column}.npy', mmap_mode='r')
+                for column in table_manifest['columns']}
+            for table, table_manifest in manifest['tables'].items()}}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export the run history to memory-mappable .npy columns.')
+    parser.add_argument('output_dir')
+    parser.add_argument('--db-path', default=DEFAULT_DB_PATH)
+    parser.add_argument(
+        '--tables',
+        nargs='+',
+        choices=list(EXPORT_TABLE_COLUMNS),
+        default=list(EXPORT_TABLE_COLUMNS))
+    parser.add_argument('--chunksize', type=int, default=100000)
+    args = parser.parse_args()
+    with moonlighter_session(args.db_path):
+        stats = export_history(args.output_dir, tables=args.tables, chunksize=args.chunksize)
+    print(f"Exported {stats['rows']} rows in {stats['seconds']:.2f} s")
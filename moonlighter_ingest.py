@@ -0,0 +1,131 @@
+from pathlib import Path
+import argparse
+import sys
+import time
+import pandas as pd
+from moonlighter_pricing import (
+    DEFAULT_DB_PATH,
+    MOODS,
+    database_transaction,
+    execute_many_queries,
+    get_current_price_bounds,
+    get_next_reaction_id,
+    get_updated_price_bounds,
+    migrate_database,
+    moonlighter_session,
+    profiled_helper,
+    query_rows)
+
+REACTION_COLUMNS = ['shelf_id', 'item', 'price', 'mood']
+
+def get_reaction_file_format(source, file_format=None):
+    if file_format is not None:
+        return file_format
+    if source != '-' and Path(source).suffix in ('.jsonl', '.ndjson'):
+        return 'jsonl'
+    return 'csv'
+def read_reaction_chunks(source, file_format=None, chunksize=100000):
+    file = sys.stdin if source == '-' else source
+    if get_reaction_file_format(source, file_format) == 'jsonl':
+        return pd.read_json(file, lines=True, chunksize=chunksize)
+    return pd.read_csv(file, chunksize=chunksize)
+@profiled_helper
+def get_shelf_items():
+    return dict(query_rows("""
+        select
+            id,
+            item
+        from shelves"""))
+def get_reaction_records(chunk):
+    if 'item' not in chunk:
+        # Logs that only name the shelf react to whatever is on it right now
+        chunk = chunk.assign(item=chunk['shelf_id'].map(get_shelf_items()))
+    missing_columns = set(REACTION_COLUMNS) - set(chunk.columns)
+    if missing_columns:
+        raise Exception(f'Reactions are missing columns {sorted(missing_columns)}')
+    invalid_moods = set(chunk['mood']) - set(MOODS)
+    if invalid_moods:
+        raise Exception(f'Reactions have unknown moods {sorted(invalid_moods)}')
+    if chunk['item'].isna().any():
+        raise Exception('Reactions have shelves without an item')
+    return list(zip(
+        chunk['shelf_id'].astype(int).tolist(),
+        chunk['item'].tolist(),
+        chunk['price'].astype(int).tolist(),
+        chunk['mood'].tolist()))
+@profiled_helper
+def ingest_reaction_chunk(chunk, price_bounds):
+    reactions = []
+    price_bound_rows = []
+    skipped_count = 0
+    with database_transaction():
+        next_reaction_id = get_next_reaction_id()
+        for reaction in get_reaction_records(chunk):
+            _, item, price, mood = reaction
+            # Items without bounds have no history to extend, so only their
+            # reaction is kept; update_price_bound_history would fail on the
+            # null bounds instead
+            if item in price_bounds:
+                low, high = get_updated_price_bounds(
+                    *price_bounds[item],
+                    price=price,
+                    mood=mood)
+                if low > high:
+                    # The reaction contradicts what is known about the item
+                    # and would leave it with no price to sample, so it is
+                    # skipped as the service rejects it
+                    skipped_count += 1
+                    continue
+                price_bounds[item] = (low, high)
+                price_bound_rows.append((next_reaction_id + len(reactions), item, low, high))
+            reactions.append(reaction)
+        execute_many_queries(
+            query="insert into reactions(shelf_id, item, price, mood) values(?, ?, ?, ?)",
+            data=reactions)
+        execute_many_queries(
+            query="insert into price_bound_history(reaction_id, item, low, high) values(?, ?, ?, ?)",
+            data=price_bound_rows)
+    return {'rows': len(reactions), 'skipped': skipped_count}
+def ingest_reactions(source, file_format=None, chunksize=100000):
+    migrate_database()
+    price_bounds = get_current_price_bounds()
+    start = time.perf_counter()
+    chunk_stats = [
+        ingest_reaction_chunk(chunk, price_bounds)
+        for chunk in read_reaction_chunks(source, file_format, chunksize)]
+    rows = sum(x['rows'] for x in chunk_stats)
+    seconds = time.perf_counter() - start
+    return {
+        'rows': rows,
+        'skipped': sum(x['skipped'] for x in chunk_stats),
+        'seconds': seconds,
+        'rows_per_second': rows / seconds if seconds else None}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Load customer reactions from shop logs and update price bounds.')
+    parser.add_argument(
+        'source',
+        help='CSV or JSONL file with shelf_id, item, price and mood, or - for stdin.')
+    parser.add_argument('--format', choices=['csv', 'jsonl'], dest='file_format')
+    parser.add_argument('--chunksize', type=int, default=100000)
+    parser.add_argument('--db-path', default=DEFAULT_DB_PATH)
+    parser.add_argument(
+        '--journal-mode',
+        choices=['delete', 'truncate', 'persist', 'memory', 'wal', 'off'])
+    parser.add_argument(
+        '--synchronous',
+        choices=['off', 'normal', 'full', 'extra'])
+    args = parser.parse_args()
+    with moonlighter_session(
+            args.db_path,
+            journal_mode=args.journal_mode,
+            synchronous=args.synchronous):
+        stats = ingest_reactions(
+            args.source,
+            file_format=args.file_format,
+            chunksize=args.chunksize)
+    print(
+        f"Ingested {stats['rows']} reactions in {stats['seconds']:.2f} s "
+        f"({stats['rows_per_second'] or 0:.0f} rows/sec), skipped "
+        f"{stats['skipped']} that contradict the price bounds")
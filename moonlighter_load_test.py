@@ -0,0 +1,155 @@
+from collections import Counter, defaultdict
+import argparse
+import asyncio
+import json
+import time
+import numpy as np
+from moonlighter_pricing import DEFAULT_SEED
+from moonlighter_service import start_service, stop_service
+
+async def send_request(reader, writer, method, path, payload=None):
+    body = b'' if payload is None else json.dumps(payload).encode()
+    writer.write(
+        f'{method} {path} HTTP/1.1\r\n'
+        'Host: localhost\r\n'
+        'Content-Type: application/json\r\n'
+        f'Content-Length: {len(body)}\r\n\r\n'.encode()
+        + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+        name, _, value = line.decode().partition(':')
+        headers[name.strip().lower()] = value.strip()
+    return status, json.loads(await reader.readexactly(int(headers['content-length'])))
+def get_customer_mood(price, value):
+    # Customers value each item at a hidden price and react to the asking
+    # price the way price_reaction_bounds model it
+    return (
+        'ecstatic' if price <= 0.8 * value else
+        'content' if price <= value else
+        'sad' if price <= 1.1 * value else
+        'angry')
+async def run_client(host, port, shop, deadline, rng, latencies, statuses):
+    reader, writer = await asyncio.open_connection(host, port)
+    async def timed_request(operation, method, path, payload=None):
+        start = time.perf_counter()
+        status, response = await send_request(reader, writer, method, path, payload)
+        latencies[operation].append(time.perf_counter() - start)
+        statuses[operation][status] += 1
+        return status, response
+    try:
+        _, snapshot = await send_request(reader, writer, 'GET', f'/shops/{shop}')
+        values = {
+            item: rng.uniform(low, high - 1)
+            for item, (low, high) in snapshot['price_bounds'].items()}
+        while time.perf_counter() < deadline:
+            _, snapshot = await timed_request('snapshot', 'GET', f'/shops/{shop}')
+            empty_shelf_ids = [x['shelf_id'] for x in snapshot['shelves'] if x['item'] is None]
+            occupied_shelf_ids = [x['shelf_id'] for x in snapshot['shelves'] if x['item'] is not None]
+            if empty_shelf_ids and snapshot['inventory']:
+                await timed_request(
+                    'fill',
+                    'POST',
+                    f'/shops/{shop}/shelves/{rng.choice(empty_shelf_ids)}/fill')
+            elif occupied_shelf_ids:
+                shelf = snapshot['shelves'][
+                    [x['shelf_id'] for x in snapshot['shelves']].index(
+                        rng.choice(occupied_shelf_ids))]
+                await timed_request(
+                    'reaction',
+                    'POST',
+                    f"/shops/{shop}/shelves/{shelf['shelf_id']}/reactions",
+                    {'mood': get_customer_mood(shelf['price'], values[shelf['item']])})
+            else:
+                # Sold out
+                break
+    finally:
+        writer.close()
+def get_latency_summary(latencies, statuses, seconds):
+    request_count = sum(len(x) for x in latencies.values())
+    # Clients acting on the same snapshot race for the same shelves, and the
+    # losers get a 409 rather than an error
+    conflicts = {operation: x[409] for operation, x in statuses.items()}
+    errors = {
+        operation: sum(x.values()) - x[200] - x[409]
+        for operation, x in statuses.items()}
+    return {
+        'requests': request_count,
+        'conflicts': sum(conflicts.values()),
+        'errors': sum(errors.values()),
+        'seconds': seconds,
+        'requests_per_second': request_count / seconds if seconds else None,
+        'operations': {
+            operation: {
+                'requests': len(x),
+                'conflicts': conflicts[operation],
+                'errors': errors[operation],
+                'p50_ms': float(np.percentile(x, 50)) * 1e3,
+                'p99_ms': float(np.percentile(x, 99)) * 1e3}
+            for operation, x in latencies.items()}}
+async def run_load_test(host, port, shop, clients=8, seconds=10, seed=DEFAULT_SEED):
+    latencies = defaultdict(list)
+    statuses = defaultdict(Counter)
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        run_client(
+            host, port, shop, start + seconds, np.random.default_rng(seed_sequence),
+            latencies, statuses)
+        for seed_sequence in np.random.SeedSequence(seed).spawn(clients)])
+    return get_latency_summary(latencies, statuses, time.perf_counter() - start)
+async def run_local_load_test(db_path, clients=8, seconds=10, seed=DEFAULT_SEED, batch_size=64):
+    server, writer_tasks = await start_service(
+        {'main': db_path},
+        port=0,
+        seed=seed,
+        batch_size=batch_size)
+    try:
+        return await run_load_test(
+            '127.0.0.1',
+            server.sockets[0].getsockname()[1],
+            'main',
+            clients=clients,
+            seconds=seconds,
+            seed=seed)
+    finally:
+        await stop_service(server, writer_tasks)
+def print_load_test_report(summary):
+    print(
+        f"{summary['requests']} requests ({summary['conflicts']} conflicts, "
+        f"{summary['errors']} errors) in "
+        f"{summary['seconds']:.2f} s ({summary['requests_per_second']:.0f} requests/sec)")
+    for operation, x in summary['operations'].items():
+        print(
+            f"    {operation}: {x['requests']} requests, {x['conflicts']} conflicts, "
+            f"p50 {x['p50_ms']:.2f} ms, p99 {x['p99_ms']:.2f} ms")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Drive the pricing service with concurrent shop clients.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--shop', default='main')
+    parser.add_argument(
+        '--db-path',
+        help='Start a service for this database in-process instead of using --host/--port.')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--batch-size', type=int, default=64)
+    args = parser.parse_args()
+    print_load_test_report(asyncio.run(
+        run_local_load_test(
+            args.db_path,
+            clients=args.clients,
+            seconds=args.seconds,
+            seed=args.seed,
+            batch_size=args.batch_size)
+        if args.db_path is not None else
+        run_load_test(
+            args.host,
+            args.port,
+            args.shop,
+            clients=args.clients,
+            seconds=args.seconds,
+            seed=args.seed)))
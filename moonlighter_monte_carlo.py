@@ -0,0 +1,95 @@
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import numpy as np
+from moonlighter_engine import PRICING_STRATEGIES, MoonlighterEngine
+from moonlighter_pricing import DEFAULT_SEED, get_default_simulation_config, run_simulation
+
+def get_run_seed_sequences(seed, run_count):
+    return np.random.SeedSequence(seed).spawn(run_count)
+def get_replicate_summary(seed_sequence, config, backend, pricing_strategy='interval'):
+    rng = np.random.default_rng(seed_sequence)
+    if backend == 'engine':
+        engine = MoonlighterEngine.from_config(**config, pricing_strategy=pricing_strategy)
+        engine.run_until_sold_out(rng)
+        return engine.get_summary()
+    if backend == 'sql':
+        if pricing_strategy != 'interval':
+            raise Exception('The SQL backend only supports the interval pricing strategy')
+        return run_simulation(config, rng, db=':memory:')
+    raise Exception(f'Unknown backend {backend}')
+def run_replicate(run_index, seed_sequence, config, backend='engine', pricing_strategy='interval'):
+    summary = get_replicate_summary(seed_sequence, config, backend, pricing_strategy)
+    expensive_uppers = {
+        x['item']: x['expensive_upper']
+        for x in reversed(config['price_reaction_bounds'])}
+    return (
+        {
+            'run': run_index,
+            'ticks_to_sell_out': summary['ticks'],
+            'reactions': summary['reactions'],
+            'revenue': summary['revenue']}
+        | {
+            f'{item}_final_price_ratio': price / expensive_uppers[item]
+            for item, price in sorted(summary['final_prices'].items())
+            if expensive_uppers.get(item)})
+def run_replicate_batch(batch):
+    return [run_replicate(*replicate) for replicate in batch]
+def get_replicate_batches(replicates, batch_count):
+    return [
+        replicates[i::batch_count]
+        for i in range(batch_count)]
+def run_monte_carlo(
+        run_count, seed=DEFAULT_SEED, workers=1, config=None, backend='engine',
+        pricing_strategy='interval'):
+    import pandas as pd
+    config = get_default_simulation_config() if config is None else config
+    replicates = [
+        (run_index, seed_sequence, config, backend, pricing_strategy)
+        for run_index, seed_sequence in enumerate(
+            get_run_seed_sequences(seed, run_count))]
+    # Every run draws from its own spawned stream and rows are sorted by run,
+    # so the table does not depend on the worker count or scheduling
+    if workers == 1:
+        summaries = run_replicate_batch(replicates)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            summaries = [
+                summary
+                for batch_summaries in executor.map(
+                    run_replicate_batch,
+                    get_replicate_batches(replicates, workers * 4))
+                for summary in batch_summaries]
+    return (
+        pd.DataFrame(summaries)
+        .sort_values('run')
+        .reset_index(drop=True))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run independent pricing simulations in parallel.')
+    parser.add_argument('--runs', type=int, default=100)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument(
+        '--backend',
+        choices=['engine', 'sql'],
+        default='engine',
+        help='Run each replicate in memory, or through the SQL helpers on an in-memory database.')
+    parser.add_argument(
+        '--pricing-strategy',
+        choices=list(PRICING_STRATEGIES),
+        default='interval',
+        help='How the engine backend samples prices.')
+    parser.add_argument(
+        '--output',
+        help='CSV file to write the per-run results table to.')
+    args = parser.parse_args()
+    results = run_monte_carlo(
+        run_count=args.runs,
+        seed=args.seed,
+        workers=args.workers,
+        backend=args.backend,
+        pricing_strategy=args.pricing_strategy)
+    if args.output is not None:
+        results.to_csv(args.output, index=False)
+    print(results.drop(columns='run').describe().T.to_string())
@@ -1,43 +1,300 @@
-from functools import reduce
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from functools import reduce, wraps
+from pathlib import Path
+import argparse
+import json
+import queue
 import sqlite3
-import pandas as pd
+import time
 import numpy as np
 
+DEFAULT_DB_PATH = "moonlighter_db.sqlite"
+active_connection = ContextVar('active_connection', default=None)
+active_transaction = ContextVar('active_transaction', default=False)
+active_profiler = ContextVar('active_profiler', default=None)
+# Helper and database operation the next query is profiled under
+active_profiled_call = ContextVar('active_profiled_call', default=('unknown', None))
+MOODS = ['ecstatic', 'content', 'sad', 'angry']
+CHECKPOINT_HISTORY_TABLES = [
+    'reactions', 'thompson_competitions', 'thompson_competition_winners',
+    'price_bound_history', 'inventory_changes', 'shelf_history',
+    'reaction_price_bounds', 'inventory_snapshots']
+DEFAULT_SEED = 71071763
+DEFAULT_SHELF_COUNT = 4
+DEFAULT_RETAIN_ROWS = 100000
+DEFAULT_SUMMARY_BUCKET_SIZE = 1000
+DEFAULT_ITEM_COUNTS = {
+    'gold_runes': 20,
+    'broken_sword': 20,
+    'vine': 20,
+    'root': 20,
+    'hardened_steel': 20,
+    'glass_lenses': 20,
+    'teeth_stone': 20,
+    'iron_bar': 20,
+    'crystallized_energy': 20,
+    'golem_core': 20}
+DEFAULT_PRICE_BOUNDS = {
+    '275|3000': [
+        'gold_runes', 'hardened_steel'],
+    '2|275': [
+        'broken_sword', 'ancient_pot', 'crystallized_energy',
+        'glass_lenses', 'golem_core', 'iron_bar', 'root', 'teeth_stone', 'vine']}
+DEFAULT_PRICE_REACTION_BOUNDS = [
+    {
+        'item': item,
+        'cheap_upper': cheap_upper,
+        'perfect_upper': perfect_upper,
+        'expensive_upper': expensive_upper}
+    for item, cheap_upper, perfect_upper, expensive_upper in [
+        ['broken_sword', 134, 165, 173],
+        ['crystallized_energy', 89, 110, 115],
+        ['glass_lenses', 89, 110, 115],
+        ['gold_runes', 269, 330, 345],
+        ['golem_core', 89, 110, 115],
+        ['hardened_steel', 269, 330, 345],
+        ['iron_bar', 21, 28, 30],
+        ['root', 3, 6, 8],
+        ['teeth_stone', 3, 6, 8],
+        ['vine', 0, 3, 5]]]
+
 def enforce_foreign_key_constraints(cursor):
     cursor.execute("pragma foreign_keys = on;")
-def get_moonlighter_data_connection():
-    return sqlite3.connect("moonlighter_db.sqlite")
-def transact_w_database(f):
-    con = get_moonlighter_data_connection()
+def enable_incremental_vacuum(cursor):
+    # Only takes effect on a database nothing has been written to yet.
+    # Converting an existing one would take a full VACUUM, which renumbers
+    # the rowids the history tables refer to each other by
+    cursor.execute("pragma auto_vacuum = incremental;")
+def get_moonlighter_data_connection(db_path=DEFAULT_DB_PATH, **connect_kwargs):
+    return sqlite3.connect(db_path, **connect_kwargs)
+def set_journal_settings(cursor, journal_mode=None, synchronous=None):
+    if journal_mode is not None:
+        cursor.execute(f"pragma journal_mode = {journal_mode};")
+    if synchronous is not None:
+        cursor.execute(f"pragma synchronous = {synchronous};")
+@contextmanager
+def moonlighter_session(
+        db_path=DEFAULT_DB_PATH, journal_mode=None, synchronous=None,
+        **connect_kwargs):
+    con = get_moonlighter_data_connection(db_path, **connect_kwargs)
+    enforce_foreign_key_constraints(con.cursor())
+    enable_incremental_vacuum(con.cursor())
+    set_journal_settings(
+        con.cursor(),
+        journal_mode=journal_mode,
+        synchronous=synchronous)
+    token = active_connection.set(con)
+    try:
+        yield con
+    finally:
+        active_connection.reset(token)
+        con.commit()
+        con.close()
+@contextmanager
+def moonlighter_reader_pool(db_path=DEFAULT_DB_PATH, size=4):
+    connections = [
+        get_moonlighter_data_connection(
+            Path(db_path).resolve().as_uri() + '?mode=ro',
+            uri=True,
+            check_same_thread=False)
+        for _ in range(size)]
+    pool = queue.Queue()
+    for con in connections:
+        pool.put(con)
+    try:
+        yield pool
+    finally:
+        for con in connections:
+            con.close()
+@contextmanager
+def pooled_connection(pool):
+    con = pool.get()
+    token = active_connection.set(con)
+    try:
+        yield con
+    finally:
+        active_connection.reset(token)
+        pool.put(con)
+@contextmanager
+def database_transaction(con=None):
+    con = con if con is not None else active_connection.get()
+    if con is None:
+        raise Exception('database_transaction requires an active moonlighter_session')
+    con.execute("begin")
+    token = active_transaction.set(True)
+    try:
+        yield con
+    except Exception:
+        con.rollback()
+        raise
+    else:
+        con.commit()
+    finally:
+        active_transaction.reset(token)
+@contextmanager
+def profile_queries(trace_path=None):
+    trace_file = None if trace_path is None else open(trace_path, 'w')
+    profiler = {
+        'seconds': defaultdict(list),
+        'commit_seconds': defaultdict(float),
+        'rows': defaultdict(int),
+        'trace_file': trace_file}
+    token = active_profiler.set(profiler)
+    try:
+        yield profiler
+    finally:
+        active_profiler.reset(token)
+        if trace_file is not None:
+            trace_file.close()
+def profiled_helper(f):
+    # Queries are profiled under the innermost decorated helper that issued them
+    @wraps(f)
+    def profiled_helper_inner(*args, **kwargs):
+        if active_profiler.get() is None:
+            return f(*args, **kwargs)
+        token = active_profiled_call.set((f.__name__, None))
+        try:
+            return f(*args, **kwargs)
+        finally:
+            active_profiled_call.reset(token)
+    return profiled_helper_inner
+def profiled_operation(f):
+    # The outermost query wrapper a helper calls names the operation, so
+    # query_value is not reported as the query_rows it wraps
+    @wraps(f)
+    def profiled_operation_inner(*args, **kwargs):
+        name, operation = active_profiled_call.get()
+        if active_profiler.get() is None or operation is not None:
+            return f(*args, **kwargs)
+        token = active_profiled_call.set((name, f.__name__))
+        try:
+            return f(*args, **kwargs)
+        finally:
+            active_profiled_call.reset(token)
+    return profiled_operation_inner
+def get_result_row_count(result):
+    return (
+        max(result.rowcount, 0) if isinstance(result, sqlite3.Cursor) else
+        len(result) if hasattr(result, '__len__') else
+        0)
+def record_query_profile(profiler, seconds, commit_seconds, rows):
+    name, operation = active_profiled_call.get()
+    operation = 'transact_w_database' if operation is None else operation
+    profiler['seconds'][(name, operation)].append(seconds)
+    profiler['commit_seconds'][(name, operation)] += commit_seconds
+    profiler['rows'][(name, operation)] += rows
+    if profiler['trace_file'] is not None:
+        profiler['trace_file'].write(
+            json.dumps({
+                'time': time.time(),
+                'name': name,
+                'operation': operation,
+                'seconds': seconds,
+                'commit_seconds': commit_seconds,
+                'rows': rows})
+            + '\n')
+def get_query_profile_summary(profiler):
+    import pandas as pd
+    return (
+        pd.DataFrame(
+            [
+                {
+                    'name': name,
+                    'operation': operation,
+                    'calls': len(seconds),
+                    'total_seconds': float(np.sum(seconds)),
+                    'mean_seconds': float(np.mean(seconds)),
+                    'p99_seconds': float(np.percentile(seconds, 99)),
+                    'rows': profiler['rows'][(name, operation)],
+                    'commit_seconds': profiler['commit_seconds'][(name, operation)]}
+                for (name, operation), seconds in profiler['seconds'].items()],
+            columns=[
+                'name', 'operation', 'calls', 'total_seconds', 'mean_seconds',
+                'p99_seconds', 'rows', 'commit_seconds'])
+        .sort_values('total_seconds', ascending=False)
+        .reset_index(drop=True))
+def transact_w_database(f, con=None):
+    session_con = con if con is not None else active_connection.get()
+    con = get_moonlighter_data_connection() if session_con is None else session_con
     cursor = con.cursor()
+    profiler = active_profiler.get()
+    start = time.perf_counter()
     try:
-        enforce_foreign_key_constraints(cursor)
+        if session_con is None:
+            enforce_foreign_key_constraints(cursor)
         result = f(con=con, cursor=cursor)
         error = None
     except Exception as e:
         result = None
         error = e
     finally:
-        con.commit()
-        con.close()
+        query_end = time.perf_counter()
+        if not active_transaction.get():
+            con.commit()
+        commit_end = time.perf_counter()
+        if session_con is None:
+            con.close()
+    if profiler is not None:
+        record_query_profile(
+            profiler,
+            seconds=query_end - start,
+            commit_seconds=commit_end - query_end,
+            rows=get_result_row_count(result))
     if error is not None:
         raise Exception(error)
     return result
-def query_data(query, params={}):
+@profiled_operation
+def query_data(query, params={}, con=None):
+    # pandas is only needed for analysis, so the simulation itself starts
+    # without importing it
+    import pandas as pd
     return (
         transact_w_database(
             lambda con, cursor: (
                 pd.read_sql(
                     query,
                     con=con,
-                    params=params))))
-def query_data_without_output(query, params={}):
+                    params=params)),
+            con=con))
+@profiled_operation
+def query_rows(query, params={}, con=None):
+    return (
+        transact_w_database(
+            lambda con, cursor: (
+                cursor
+                .execute(
+                    query,
+                    params)
+                .fetchall()),
+            con=con))
+@profiled_operation
+def query_records(query, params={}, con=None):
+    return (
+        transact_w_database(
+            lambda con, cursor: (
+                pipe(
+                    cursor.execute(
+                        query,
+                        params),
+                    lambda x: [
+                        dict(zip([y[0] for y in x.description], row))
+                        for row in x.fetchall()])),
+            con=con))
+@profiled_operation
+def query_value(query, params={}, con=None):
+    return query_rows(query, params, con=con)[0][0]
+@profiled_operation
+def query_data_without_output(query, params={}, con=None):
     return (
         transact_w_database(
             lambda con, cursor: (
                 cursor.execute(
                     query,
-                    params))))
+                    params)),
+            con=con))
+@profiled_helper
 def initialize_shelves(shelf_count):
     return (
         transact_w_database(
@@ -47,12 +304,15 @@ def initialize_shelves(shelf_count):
                     insert or ignore into shelves(id, item, price) values(?, null, null)
                     """,
                     [[x] for x in range(shelf_count)]))))
-def execute_sqlite_script(query):
+@profiled_operation
+def execute_sqlite_script(query, con=None):
     return (
         transact_w_database(
             lambda con, cursor: (
                 cursor.executescript(
-                    query))))
+                    query)),
+            con=con))
+@profiled_helper
 def drop_table(table_name):
     query_data_without_output(f"""drop table if exists {table_name}""")
 def move_allowed_tables_to_end(table_names):
@@ -65,98 +325,418 @@ def move_allowed_tables_to_end(table_names):
             table_name
             for table_name in table_names
             if 'allowed_' in table_name])
+@profiled_helper
 def get_current_tables():
     return (
         pipe(
-            query_data("""
+            query_rows("""
                 select distinct
                     tbl_name
                 from sqlite_master
                 where
                     type = 'table'"""),
-            lambda query_result: (
-                [] if query_result is None else
-                (
-                    query_result
-                    ['tbl_name']
-                    .pipe(list)))))
+            lambda rows: [x[0] for x in rows]))
+@profiled_helper
 def clear_database():
     for table_name in move_allowed_tables_to_end(get_current_tables()):
         drop_table(table_name)
-def initialize_database():
-    execute_sqlite_script(
-        """
-        pragma foreign_keys = on;
+    query_data_without_output("pragma user_version = 0")
+SCHEMA_MIGRATIONS = [
+    # 1: tables of the original simulation
+    """
+    /* Bounds used to simulate customer reactions to prices */
+    create table if not exists price_reaction_bounds (
+        item text not null,
+        cheap_upper integer not null,
+        perfect_upper integer not null,
+        expensive_upper integer not null
+    ) strict;
 
-        /* Bounds used to simulate customer reactions to prices */
-        create table if not exists price_reaction_bounds (
-            item text not null,
-            cheap_upper integer not null,
-            perfect_upper integer not null,
-            expensive_upper integer not null
-        ) strict;
+    create table if not exists allowed_moods (
+        mood text primary key
+    ) strict;
+    insert or ignore into allowed_moods(mood) values
+        ('ecstatic'),
+        ('content'),
+        ('sad'),
+        ('angry');
 
-        create table if not exists allowed_moods (
-            mood text primary key
-        ) strict;
-        insert or ignore into allowed_moods(mood) values
-            ('ecstatic'),
-            ('content'),
-            ('sad'),
-            ('angry');
+    create table if not exists reactions (
+        shelf_id integer not null,
+        item text not null,
+        price integer not null,
+        mood text not null,
+        foreign key (mood) references allowed_moods(mood)
+    ) strict;
+    create table if not exists thompson_competitions (
+        competition_ind integer not null,
+        item text not null,
+        price_lower_bound integer not null,
+        price_upper_bound integer not null,
+        sampled_price integer not null
+    ) strict;
+    create table if not exists price_bound_history (
+        reaction_id integer,
+        item text not null,
+        low integer not null,
+        high integer not null
+    ) strict;
+    create table if not exists inventory (
+        item text not null,
+        count integer not null
+    ) strict;
+    create table if not exists inventory_changes (
+        item text not null,
+        change integer not null
+    ) strict;
+    create table if not exists shelves (
+        id integer not null,
+        item text,
+        price integer
+    ) strict;
+    create table if not exists shelf_history (
+        shelf_id integer not null,
+        item text,
+        price integer
+    ) strict;
+    """,
+    # 2: inventory keyed on item so it can be updated incrementally
+    """
+    create table inventory_keyed (
+        item text primary key,
+        count integer not null
+    ) strict;
+    insert into inventory_keyed(item, count)
+        select
+            item,
+            sum(change) as count
+        from inventory_changes
+        group by
+            item;
+    drop table inventory;
+    alter table inventory_keyed rename to inventory;
+    """,
+    # 3: latest price_bound_history row per item, kept in step by trigger
+    """
+    create table if not exists current_price_bounds (
+        item text primary key,
+        low integer not null,
+        high integer not null
+    ) strict;
+    insert or ignore into current_price_bounds(item, low, high)
+        select
+            b.item,
+            b.low,
+            b.high
+        from (
+            select
+                max(rowid) as max_rowid
+            from price_bound_history
+            group by
+                item) a
+        inner join price_bound_history b on
+            a.max_rowid = b.rowid;
+    create trigger if not exists update_current_price_bounds
+    after insert on price_bound_history
+    begin
+        insert into current_price_bounds(item, low, high) values(
+            new.item,
+            new.low,
+            new.high)
+        on conflict(item) do update set
+            low = excluded.low,
+            high = excluded.high;
+    end;
+    """,
+    # 4: shelves keyed on id plus indexes for the hot-path lookups
+    """
+    create table shelves_keyed (
+        id integer primary key,
+        item text,
+        price integer
+    ) strict;
+    insert or ignore into shelves_keyed(id, item, price)
+        select
+            id,
+            item,
+            price
+        from shelves
+        order by
+            rowid;
+    drop table shelves;
+    alter table shelves_keyed rename to shelves;
 
-        create table if not exists reactions (
-            shelf_id integer not null,
-            item text not null,
-            price integer not null,
-            mood text not null,
-            foreign key (mood) references allowed_moods(mood)
-        ) strict;
-        create table if not exists thompson_competitions (
-            competition_ind integer not null,
-            item text not null,
-            price_lower_bound integer not null,
-            price_upper_bound integer not null,
-            sampled_price integer not null
-        ) strict;
-        create table if not exists price_bound_history (
-            reaction_id integer,
-            item text not null,
-            low integer not null,
-            high integer not null
-        ) strict;
-        create table if not exists inventory (
-            item text not null,
-            count integer not null
-        ) strict;
-        create table if not exists inventory_changes (
-            item text not null,
-            change integer not null
-        ) strict;
-        create table if not exists shelves (
-            id integer not null,
-            item text,
-            price integer
-        ) strict;
-        create table if not exists shelf_history (
-            shelf_id integer not null,
-            item text,
-            price integer
-        ) strict;
-        """)
+    create index if not exists shelves_item on shelves(item);
+    create index if not exists inventory_count on inventory(count);
+    create index if not exists price_reaction_bounds_item
+        on price_reaction_bounds(item);
+    create index if not exists thompson_competitions_competition_ind
+        on thompson_competitions(competition_ind);
+    create index if not exists price_bound_history_item
+        on price_bound_history(item);
+    create index if not exists price_bound_history_reaction_id
+        on price_bound_history(reaction_id);
+    """,
+    # 5: winner-only competition records, reconstructable from the history
+    # rows written before them and the rng state the prices were drawn from
+    """
+    create table if not exists thompson_competition_winners (
+        competition_ind integer primary key,
+        item text not null,
+        sampled_price integer not null,
+        competitor_count integer not null,
+        rng_state text not null,
+        price_bound_history_rowid integer not null,
+        inventory_changes_rowid integer not null
+    ) strict;
+    """,
+    # 6: history tagged with the shop it happened in; the state tables and
+    # current_price_bounds describe shop 0, which the single-shop simulation
+    # runs as
+    """
+    alter table reactions add column shop_id integer not null default 0;
+    alter table thompson_competitions add column shop_id integer not null default 0;
+    alter table price_bound_history add column shop_id integer not null default 0;
+    alter table inventory_changes add column shop_id integer not null default 0;
+    alter table shelf_history add column shop_id integer not null default 0;
+
+    drop trigger if exists update_current_price_bounds;
+    create trigger if not exists update_current_price_bounds
+    after insert on price_bound_history
+    when new.shop_id = 0
+    begin
+        insert into current_price_bounds(item, low, high) values(
+            new.item,
+            new.low,
+            new.high)
+        on conflict(item) do update set
+            low = excluded.low,
+            high = excluded.high;
+    end;
+    """,
+    # 7: latest checkpoint of the simulation loop, which is enough to resume
+    # it without replaying the history
+    """
+    create table if not exists simulation_checkpoints (
+        tick integer primary key,
+        rng_state text not null,
+        settings text not null,
+        history_rowids text not null,
+        shelves text not null,
+        inventory text not null,
+        price_bounds text not null
+    ) strict;
+    """,
+    # 8: analytics tables kept in step with the history by triggers, so
+    # reading them needs no window functions over the whole history. Each
+    # reaction's row gets the bounds before and after it once its
+    # price_bound_history row is written, and each inventory change the
+    # item's running count. Both triggers find the item's previous row in
+    # its shop through a (shop_id, item) index
+    """
+    create table if not exists reaction_price_bounds (
+        reaction_id integer primary key,
+        shop_id integer not null,
+        shelf_id integer not null,
+        item text not null,
+        previous_low integer,
+        previous_high integer,
+        price integer not null,
+        mood text not null,
+        low integer,
+        high integer
+    ) strict;
+    insert into reaction_price_bounds
+        select
+            a.rowid,
+            a.shop_id,
+            a.shelf_id,
+            a.item,
+            b.previous_low,
+            b.previous_high,
+            a.price,
+            a.mood,
+            b.low,
+            b.high
+        from reactions a
+        left outer join (
+            select
+                reaction_id,
+                lag(low) over item_history as previous_low,
+                lag(high) over item_history as previous_high,
+                low,
+                high
+            from price_bound_history
+            window item_history as (partition by shop_id, item order by rowid)) b on
+            a.rowid = b.reaction_id;
+    create trigger if not exists add_reaction_price_bounds
+    after insert on reactions
+    begin
+        insert into reaction_price_bounds(reaction_id, shop_id, shelf_id, item, price, mood)
+        values(new.rowid, new.shop_id, new.shelf_id, new.item, new.price, new.mood);
+    end;
+    create index if not exists price_bound_history_shop_id_item
+        on price_bound_history(shop_id, item);
+    create trigger if not exists update_reaction_price_bounds
+    after insert on price_bound_history
+    when new.reaction_id is not null
+    begin
+        update reaction_price_bounds
+        set
+            (previous_low, previous_high) = (
+                select
+                    low,
+                    high
+                from price_bound_history
+                where
+                    item = new.item
+                    and shop_id = new.shop_id
+                    and rowid < new.rowid
+                order by
+                    rowid desc
+                limit 1),
+            low = new.low,
+            high = new.high
+        where
+            reaction_id = new.reaction_id;
+    end;
+
+    create table if not exists inventory_snapshots (
+        inventory_changes_rowid integer primary key,
+        shop_id integer not null,
+        item text not null,
+        count integer not null
+    ) strict;
+    create index if not exists inventory_snapshots_shop_id_item
+        on inventory_snapshots(shop_id, item);
+    insert into inventory_snapshots
+        select
+            rowid,
+            shop_id,
+            item,
+            sum(change) over (partition by shop_id, item order by rowid)
+        from inventory_changes;
+    create trigger if not exists add_inventory_snapshot
+    after insert on inventory_changes
+    begin
+        insert into inventory_snapshots(inventory_changes_rowid, shop_id, item, count)
+        values(
+            new.rowid,
+            new.shop_id,
+            new.item,
+            coalesce(
+                (
+                    select
+                        count
+                    from inventory_snapshots
+                    where
+                        shop_id = new.shop_id
+                        and item = new.item
+                    order by
+                        inventory_changes_rowid desc
+                    limit 1),
+                0)
+            + new.change);
+    end;
+    """,
+    # 9: roll-ups of compacted history, one row per bucket of consecutive
+    # rowids of the table they summarise
+    """
+    create table if not exists price_bound_history_summary (
+        shop_id integer not null,
+        item text not null,
+        bucket integer not null,
+        row_count integer not null,
+        last_rowid integer not null,
+        low integer not null,
+        high integer not null,
+        primary key (shop_id, item, bucket)
+    ) strict;
+    create table if not exists inventory_change_summary (
+        shop_id integer not null,
+        item text not null,
+        bucket integer not null,
+        row_count integer not null,
+        change integer not null,
+        primary key (shop_id, item, bucket)
+    ) strict;
+    create table if not exists thompson_competition_summary (
+        shop_id integer not null,
+        item text not null,
+        bucket integer not null,
+        row_count integer not null,
+        min_sampled_price integer not null,
+        max_sampled_price integer not null,
+        total_sampled_price integer not null,
+        primary key (shop_id, item, bucket)
+    ) strict;
+    create table if not exists shelf_history_summary (
+        shop_id integer not null,
+        shelf_id integer not null,
+        bucket integer not null,
+        row_count integer not null,
+        fill_count integer not null,
+        primary key (shop_id, shelf_id, bucket)
+    ) strict;
+    """,
+    # 10: roll-up of compacted winner-only competition records, whose
+    # competitions can no longer be reconstructed
+    """
+    create table if not exists thompson_competition_winner_summary (
+        item text not null,
+        bucket integer not null,
+        row_count integer not null,
+        competitor_count integer not null,
+        min_sampled_price integer not null,
+        max_sampled_price integer not null,
+        total_sampled_price integer not null,
+        primary key (item, bucket)
+    ) strict;
+    """]
+@profiled_helper
+def get_schema_version():
+    return (
+        transact_w_database(
+            lambda con, cursor: (
+                cursor
+                .execute("pragma user_version")
+                .fetchone()
+                [0])))
+@profiled_operation
+def execute_sqlite_script_atomically(query, con=None):
+    def execute_script(con, cursor):
+        try:
+            return cursor.executescript(f"begin;\n{query}\ncommit;")
+        except Exception:
+            con.rollback()
+            raise
+    return transact_w_database(execute_script, con=con)
+@profiled_helper
+def migrate_database(target_version=len(SCHEMA_MIGRATIONS)):
+    for version in range(get_schema_version() + 1, target_version + 1):
+        execute_sqlite_script_atomically(
+            f"""
+            {SCHEMA_MIGRATIONS[version - 1]}
+            pragma user_version = {version};
+            """)
+def initialize_database():
+    migrate_database()
 def pipe(data, *functions):
     return reduce(lambda a, x: x(a), functions, data)
-def execute_many_queries(query, data):
+@profiled_operation
+def execute_many_queries(query, data, con=None):
     return (
         transact_w_database(
             lambda con, cursor: (
                 cursor.executemany(
                     query,
-                    data))))
+                    data)),
+            con=con))
+@profiled_helper
 def bulk_update_inventory_changes(item_changes):
     execute_many_queries(
         query=f"""
-            insert into inventory_changes values(
+            insert into inventory_changes(item, change) values(
                 :item,
                 :change)""",
         data=[
@@ -164,33 +744,84 @@ def bulk_update_inventory_changes(item_changes):
                 'item': item,
                 'change': change}
             for item, change in item_changes.items()])
-def update_inventory():
-    execute_sqlite_script(
-        """
-        pragma foreign_keys = on;
-
-        drop table if exists inventory;
-
-        create table inventory as
+@profiled_helper
+def update_inventory(item_changes):
+    # Rows keep the running total of every item, even when it goes negative.
+    # Readers filter on count >= 0 when summing the inventory and on
+    # count > 0 when picking competitors, so negative totals count as absent
+    execute_many_queries(
+        query="""
+            insert into inventory(item, count) values(
+                :item,
+                :change)
+            on conflict(item) do update set
+                count = count + excluded.count""",
+        data=[
+            {
+                'item': item,
+                'change': change}
+            for item, change in item_changes.items()])
+@profiled_helper
+def rebuild_inventory():
+    transact_w_database(
+        lambda con, cursor: (
+            pipe(
+                [
+                    """delete from inventory""",
+                    """
+                    insert into inventory(item, count)
+                        select
+                            item,
+                            sum(change) as count
+                        from (
+                            select item, change from inventory_changes where shop_id = 0
+                            union all
+                            select item, change from inventory_change_summary where shop_id = 0)
+                        group by
+                            item"""],
+                use_map(cursor.execute))))
+@profiled_helper
+def get_inventory_inconsistencies():
+    return (
+        query_data("""
+            with inventory_change_totals as (
+                select
+                    item,
+                    sum(change) as expected_count
+                from (
+                    select item, change from inventory_changes where shop_id = 0
+                    union all
+                    select item, change from inventory_change_summary where shop_id = 0)
+                group by
+                    item)
+            select
+                a.item,
+                a.expected_count,
+                b.count
+            from inventory_change_totals a
+            left outer join inventory b on
+                a.item = b.item
+            where
+                a.expected_count is not b.count
+            union all
             select
                 item,
-                sum(change) as count
-            from inventory_changes
-            group by
-                item
-            having
-                count >= 0;
-        """)
+                null as expected_count,
+                count
+            from inventory
+            where
+                item not in (select item from inventory_change_totals)"""))
 def add_items_2_inventory(item_counts: dict):
     bulk_update_inventory_changes(
         item_changes=item_counts)
-    update_inventory()
+    update_inventory(
+        item_changes=item_counts)
 def use_map(f):
     def use_map_inner(x):
         return [f(y) for y in x]
     return use_map_inner
-def initialize_price_bound_history(price_bounds):
-    price_item_data = (
+def get_price_bound_records(price_bounds):
+    return (
         pipe(
             [
                 pipe(
@@ -207,14 +838,17 @@ def initialize_price_bound_history(price_bounds):
                 reduce(
                     lambda a, x: a + x,
                     separated_price_item_data))))
+@profiled_helper
+def initialize_price_bound_history(price_bounds):
     execute_many_queries(
         query="""
-            insert into price_bound_history values(
+            insert into price_bound_history(reaction_id, item, low, high) values(
                 null,
                 :item,
                 :low,
                 :high)""",
-        data=price_item_data)
+        data=get_price_bound_records(price_bounds))
+@profiled_helper
 def add_price_reaction_bounds(price_reaction_bounds):
     execute_many_queries(
         """
@@ -225,26 +859,29 @@ def add_price_reaction_bounds(price_reaction_bounds):
             :expensive_upper)
         """,
         price_reaction_bounds)
+@profiled_helper
 def get_empty_shelf_ids():
     inventory_item_count = get_inventory_item_count()
-    empty_shelf_ids = (
-        query_data("""
+    empty_shelf_ids = [
+        x[0]
+        for x in query_rows("""
             select distinct
                 id
             from shelves
             where
-                item is null""")
-        ['id']
-        .pipe(lambda x: [int(y) for y in x.values]))
+                item is null
+            order by
+                id""")]
     return (
         empty_shelf_ids if inventory_item_count >= len(empty_shelf_ids) else
         # Use only the number of empty shelves for which there are inventory
         # items to fill them with
         empty_shelf_ids[:inventory_item_count])
+@profiled_helper
 def add_thompson_competition(competition_data):
     execute_many_queries(
         """
-        insert into thompson_competitions values(
+        insert into thompson_competitions(competition_ind, item, price_lower_bound, price_upper_bound, sampled_price) values(
             :competition_ind,
             :item,
             :price_lower_bound,
@@ -252,17 +889,17 @@ def add_thompson_competition(competition_data):
             :sampled_price)
         """,
         competition_data)
+@profiled_helper
 def get_next_competition_index():
     return (
-        query_data("""
+        query_value("""
             select
-                max(competition_ind) as max_competition_ind
-            from thompson_competitions
-        """)
-        ['max_competition_ind']
-        .pipe(lambda x: (
-            int(x.values[0]) + 1 if x.values[0] is not None else
-            0)))
+                coalesce(max(competition_ind) + 1, 0) as next_competition_index
+            from (
+                select max(competition_ind) as competition_ind from thompson_competitions
+                union all
+                select max(competition_ind) from thompson_competition_winners)
+        """))
 def get_thompson_competition(price_bounds, rng, next_competition_index):
     return (
         price_bounds
@@ -287,45 +924,106 @@ def get_thompson_sampled_item_and_price(competition_data, rng):
         .pipe(lambda y: {
             'item': y['item'].values[0],
             'price': int(y['sampled_price'].values[0])}))
+def get_thompson_winner_index(sampled_prices, rng):
+    # Matches the shuffle get_thompson_sampled_item_and_price does through
+    # DataFrame.sample so both consume the same random numbers
+    tied_indices = np.flatnonzero(sampled_prices == sampled_prices.max())
+    shuffle_seed = rng.integers(0, 1e8)
+    return int(
+        tied_indices[0] if len(tied_indices) == 1 else
+        tied_indices[
+            np.random.RandomState(shuffle_seed)
+            .permutation(len(tied_indices))
+            [-1]])
+def get_pruned_thompson_competition(lows, highs, rng):
+    # Settled items, with one price left, need no draw. No item can sample
+    # below the highest low, so unsettled items whose highs are below it can
+    # never win and only the rest are sampled. The winner is drawn from the
+    # same distribution as when every competitor is sampled
+    sampled = (lows != highs) & (highs >= lows.max())
+    sampled_prices = lows.copy()
+    sampled_prices[sampled] = rng.integers(lows[sampled], highs[sampled] + 1)
+    return {
+        'sampled': sampled,
+        'sampled_prices': sampled_prices,
+        'winner_index': get_thompson_winner_index(sampled_prices, rng)}
+def get_batch_thompson_competitions(
+        items, lows, highs, inventory_counts, shelf_ids, rng,
+        next_competition_index):
+    # One draw for every shelf/item pair; later shelves only compete over the
+    # items earlier shelves in the batch left in stock
+    sampled_prices = rng.integers(lows, highs + 1, size=(len(shelf_ids), len(items)))
+    tie_breakers = rng.random((len(shelf_ids), len(items)))
+    remaining_counts = np.array(inventory_counts, dtype=np.int64)
+    assignments = []
+    competition_data = []
+    for shelf_index, shelf_id in enumerate(shelf_ids):
+        competitor_ids = np.flatnonzero(remaining_counts > 0)
+        if len(competitor_ids) == 0:
+            break
+        competitor_prices = sampled_prices[shelf_index, competitor_ids]
+        tied_ids = competitor_ids[competitor_prices == competitor_prices.max()]
+        winner_id = tied_ids[np.argmax(tie_breakers[shelf_index, tied_ids])]
+        remaining_counts[winner_id] -= 1
+        assignments.append({
+            'shelf_id': shelf_id,
+            'item': items[winner_id],
+            'price': int(sampled_prices[shelf_index, winner_id])})
+        competition_data.extend([
+            {
+                'competition_ind': next_competition_index + shelf_index,
+                'item': items[i],
+                'price_lower_bound': int(lows[i]),
+                'price_upper_bound': int(highs[i]),
+                'sampled_price': int(sampled_prices[shelf_index, i])}
+            for i in competitor_ids])
+    return {
+        'assignments': assignments,
+        'competition_data': competition_data}
+@profiled_helper
+def get_inventory_item_price_bounds_and_counts():
+    price_bounds = query_rows(
+        """
+        select
+            a.item,
+            a.low,
+            a.high,
+            b.count
+        from current_price_bounds a
+        inner join inventory b on
+            a.item = b.item
+        where
+            b.count > 0
+        order by
+            a.item
+        """)
+    return {
+        'items': [x[0] for x in price_bounds],
+        'lows': np.array([x[1] for x in price_bounds], dtype=np.int64),
+        'highs': np.array([x[2] for x in price_bounds], dtype=np.int64),
+        'counts': np.array([x[3] for x in price_bounds], dtype=np.int64)}
+@profiled_helper
 def get_inventory_item_price_bounds():
     return (
         query_data(
             """
-            with max_item_rowids as (
-                select
-                    item,
-                    max(rowid) as max_rowid
-                from price_bound_history
-                group by
-                    item),
-            latest_price_bounds as (
-                select
-                    a.item,
-                    b.low,
-                    b.high
-                from max_item_rowids a
-                left outer join price_bound_history b on
-                    a.item = b.item
-                    and a.max_rowid = b.rowid),
-            inventory_items as (
-                select
-                    item
-                from inventory
-                where
-                    count > 0)
-
             select
-                item,
-                low,
-                high
-            from latest_price_bounds
+                a.item,
+                a.low,
+                a.high
+            from current_price_bounds a
+            inner join inventory b on
+                a.item = b.item
             where
-                 item in inventory_items
+                b.count > 0
+            order by
+                a.item
             """))
+@profiled_helper
 def update_shelf_history(shelf_id, item, price):
     query_data_without_output(
         query=f"""
-            insert into shelf_history values(
+            insert into shelf_history(shelf_id, item, price) values(
                 :shelf_id,
                 :item,
                 :price)
@@ -334,6 +1032,7 @@ def update_shelf_history(shelf_id, item, price):
             'shelf_id': shelf_id,
             'item': item,
             'price': price})
+@profiled_helper
 def add_item_2_shelf_and_set_price(shelf_id, item, price):
     query_data_without_output(
         query="""
@@ -348,9 +1047,8 @@ def add_item_2_shelf_and_set_price(shelf_id, item, price):
             'item': item,
             'price': price})
 def move_item_2_shelf_and_set_price(item, shelf_id, price):
-    bulk_update_inventory_changes(
-        item_changes={item: -1})
-    update_inventory()
+    add_items_2_inventory(
+        item_counts={item: -1})
     update_shelf_history(
         shelf_id=shelf_id,
         item=item,
@@ -359,64 +1057,242 @@ def move_item_2_shelf_and_set_price(item, shelf_id, price):
         shelf_id=shelf_id,
         item=item,
         price=price)
-def fill_empty_shelves_w_priced_items(rng):
-    for empty_shelf_id in get_empty_shelf_ids():
-        competition_data = (
-            get_thompson_competition(
-                price_bounds=get_inventory_item_price_bounds(),
-                rng=rng,
-                next_competition_index=get_next_competition_index()))
+@profiled_helper
+def get_history_rowid_watermarks():
+    return dict(zip(
+        ['price_bound_history_rowid', 'inventory_changes_rowid'],
+        query_rows("""
+            select
+                coalesce((select max(rowid) from price_bound_history), 0),
+                coalesce((select max(rowid) from inventory_changes), 0)""")
+        [0]))
+@profiled_helper
+def add_thompson_competition_winner(competition_winner):
+    query_data_without_output(
+        """
+        insert into thompson_competition_winners values(
+            :competition_ind,
+            :item,
+            :sampled_price,
+            :competitor_count,
+            :rng_state,
+            :price_bound_history_rowid,
+            :inventory_changes_rowid)
+        """,
+        competition_winner)
+def fill_shelf_w_priced_item(shelf_id, rng, competition_storage='full'):
+    competitors = get_inventory_item_price_bounds_and_counts()
+    competition_ind = get_next_competition_index()
+    rng_state = rng.bit_generator.state
+    if competition_storage == 'pruned':
+        competition = get_pruned_thompson_competition(
+            competitors['lows'], competitors['highs'], rng)
+        sampled_prices = competition['sampled_prices']
+        winner_index = competition['winner_index']
+        stored = competition['sampled']
+    else:
+        sampled_prices = rng.integers(competitors['lows'], competitors['highs'] + 1)
+        winner_index = get_thompson_winner_index(sampled_prices, rng)
+        stored = np.ones(len(sampled_prices), dtype=bool)
+    if competition_storage in ('full', 'pruned'):
         add_thompson_competition(
-            competition_data=competition_data.to_dict('records'))
-        suggested_shelf_changes = (
-            get_thompson_sampled_item_and_price(
-                competition_data=competition_data,
-                rng=rng)
-            | {'shelf_id': empty_shelf_id})
-        move_item_2_shelf_and_set_price(
-            item=suggested_shelf_changes['item'],
-            shelf_id=suggested_shelf_changes['shelf_id'],
-            price=suggested_shelf_changes['price'])
+            competition_data=[
+                {
+                    'competition_ind': competition_ind,
+                    'item': item,
+                    'price_lower_bound': int(low),
+                    'price_upper_bound': int(high),
+                    'sampled_price': int(sampled_price)}
+                for item, low, high, sampled_price, is_stored in zip(
+                    competitors['items'],
+                    competitors['lows'],
+                    competitors['highs'],
+                    sampled_prices,
+                    stored)
+                if is_stored])
+    elif competition_storage == 'winners':
+        add_thompson_competition_winner(
+            {
+                'competition_ind': competition_ind,
+                'item': competitors['items'][winner_index],
+                'sampled_price': int(sampled_prices[winner_index]),
+                'competitor_count': len(sampled_prices),
+                'rng_state': json.dumps(rng_state)}
+            | get_history_rowid_watermarks())
+    else:
+        raise Exception(f'Unknown competition storage {competition_storage}')
+    move_item_2_shelf_and_set_price(
+        item=competitors['items'][winner_index],
+        shelf_id=shelf_id,
+        price=int(sampled_prices[winner_index]))
+@profiled_helper
+def get_reconstructed_thompson_competition(competition_ind):
+    competition_winners = query_records(
+        """
+        select
+            *
+        from thompson_competition_winners
+        where
+            competition_ind = :competition_ind""",
+        {'competition_ind': int(competition_ind)})
+    if not competition_winners:
+        raise Exception(f'No winner is stored for competition {competition_ind}')
+    competition_winner = competition_winners[0]
+    price_bounds = query_data(
+        """
+        with inventory_counts as (
+            select
+                item,
+                sum(change) as count
+            from (
+                select item, change from inventory_changes
+                where rowid <= :inventory_changes_rowid and shop_id = 0
+                union all
+                select item, change from inventory_change_summary where shop_id = 0)
+            group by
+                item),
+        price_bounds as (
+            select rowid, item, low, high from price_bound_history
+            where rowid <= :price_bound_history_rowid and shop_id = 0
+            union all
+            select last_rowid, item, low, high from price_bound_history_summary where shop_id = 0),
+        -- Bare low and high come from the max(rowid) row of each item
+        latest_price_bounds as (
+            select
+                item,
+                max(rowid),
+                low,
+                high
+            from price_bounds
+            group by
+                item)
+
+        select
+            b.item,
+            b.low,
+            b.high
+        from inventory_counts a
+        inner join latest_price_bounds b on
+            a.item = b.item
+        where
+            a.count > 0
+        order by
+            b.item""",
+        competition_winner)
+    if len(price_bounds) != competition_winner['competitor_count']:
+        raise Exception(
+            f"Competition {competition_ind} had {competition_winner['competitor_count']} "
+            f'competitors but the history reconstructs {len(price_bounds)}')
+    rng_state = json.loads(competition_winner['rng_state'])
+    rng = np.random.Generator(getattr(np.random, rng_state['bit_generator'])())
+    rng.bit_generator.state = rng_state
+    return get_thompson_competition(
+        price_bounds=price_bounds,
+        rng=rng,
+        next_competition_index=competition_ind)
+def fill_empty_shelves_w_priced_items(rng, competition_storage='full'):
+    for empty_shelf_id in get_empty_shelf_ids():
+        fill_shelf_w_priced_item(
+            shelf_id=empty_shelf_id,
+            rng=rng,
+            competition_storage=competition_storage)
+@profiled_helper
+def fill_empty_shelves_w_priced_items_batched(rng):
+    empty_shelf_ids = get_empty_shelf_ids()
+    if not empty_shelf_ids:
+        return
+    price_bounds = get_inventory_item_price_bounds_and_counts()
+    batch = get_batch_thompson_competitions(
+        items=price_bounds['items'],
+        lows=price_bounds['lows'],
+        highs=price_bounds['highs'],
+        inventory_counts=price_bounds['counts'],
+        shelf_ids=empty_shelf_ids,
+        rng=rng,
+        next_competition_index=get_next_competition_index())
+    add_thompson_competition(competition_data=batch['competition_data'])
+    execute_many_queries(
+        query="""
+            insert into inventory_changes(item, change) values(
+                :item,
+                -1)""",
+        data=batch['assignments'])
+    update_inventory(
+        item_changes=pipe(
+            batch['assignments'],
+            lambda assignments: Counter(x['item'] for x in assignments),
+            lambda item_counts: {
+                item: -count
+                for item, count in item_counts.items()}))
+    execute_many_queries(
+        query="""
+            insert into shelf_history(shelf_id, item, price) values(
+                :shelf_id,
+                :item,
+                :price)""",
+        data=batch['assignments'])
+    execute_many_queries(
+        query="""
+            update shelves
+            set
+                item = :item,
+                price = :price
+            where
+                id = :shelf_id""",
+        data=batch['assignments'])
+@profiled_helper
 def get_inventory_item_count():
     return (
-        query_data("""
+        query_value("""
             select
-                sum(count) as inventory_item_count
+                coalesce(sum(count), 0) as inventory_item_count
             from inventory
-        """)
-        ['inventory_item_count']
-        .pipe(lambda x: int(x.values[0])))
+            where
+                count >= 0
+        """))
+@profiled_helper
 def get_shelf_item_count():
     return (
-        query_data("""
+        query_value("""
             select
                 count(*) as non_null_count
             from shelves
             where
                 item is not null
-        """)
-        ['non_null_count']
-        .pipe(lambda x: int(x.values[0])))
+        """))
+@profiled_helper
+def get_converged_items():
+    return [
+        x[0]
+        for x in query_rows("""
+            select
+                item
+            from current_price_bounds
+            where
+                low = high""")]
+@profiled_helper
 def get_occupied_shelf_ids():
-    return (
-        query_data("""
+    return [
+        x[0]
+        for x in query_rows("""
             select distinct
                 id
             from shelves
             where
                 item is not null
-        """)
-        ['id']
-        .pipe(lambda x: [int(y) for y in x.values]))
+            order by
+                id
+        """)]
 def choose_random_occupied_shelf(rng):
     return (
         pipe(
             get_occupied_shelf_ids(),
             rng.choice,
             int))
+@profiled_helper
 def get_random_shelf_reaction(rng):
     return (
-        query_data(
+        query_records(
             """
             with chosen_shelf_data as (
                 select
@@ -427,6 +1303,7 @@ def get_random_shelf_reaction(rng):
 
             select
                 a.id as shelf_id,
+                a.item,
                 case
                     when a.price <= b.cheap_upper
                     then 'ecstatic'
@@ -441,8 +1318,8 @@ def get_random_shelf_reaction(rng):
                 a.item = b.item
             """,
             {'shelf_id': choose_random_occupied_shelf(rng)})
-        .to_dict('records')
         [0])
+@profiled_helper
 def record_reaction(shelf_id, mood):
     query_data_without_output(
         """
@@ -455,7 +1332,7 @@ def record_reaction(shelf_id, mood):
             where
                 id = :shelf_id)
 
-        insert into reactions values(
+        insert into reactions(shelf_id, item, price, mood) values(
             :shelf_id,
             (select item from shelf_data where id = :shelf_id),
             (select price from shelf_data where id = :shelf_id),
@@ -464,10 +1341,36 @@ def record_reaction(shelf_id, mood):
         {
             'shelf_id': shelf_id,
             'mood': mood})
+def get_updated_price_bounds(low, high, price, mood):
+    return (
+        (
+            price + 1 if mood in ('content', 'ecstatic') else
+            price if mood == 'sad' and low != high else
+            low),
+        (
+            price - 1 if mood == 'angry' and low != high else
+            high))
+def get_updated_price_bound_arrays(lows, highs, prices, mood_indices):
+    # get_updated_price_bounds elementwise, with moods as MOODS indices
+    mood_indices = np.asarray(mood_indices)
+    unconverged = lows != highs
+    return (
+        np.where(
+            mood_indices <= MOODS.index('content'),
+            prices + 1,
+            np.where(
+                (mood_indices == MOODS.index('sad')) & unconverged,
+                prices,
+                lows)),
+        np.where(
+            (mood_indices == MOODS.index('angry')) & unconverged,
+            prices - 1,
+            highs))
+@profiled_helper
 def update_price_bound_history():
     query_data_without_output(
         """
-        insert into price_bound_history
+        insert into price_bound_history(reaction_id, item, low, high)
         with latest_reaction as (
             select
                 rowid as reaction_id,
@@ -482,15 +1385,9 @@ def update_price_bound_history():
                 item,
                 low,
                 high
-            from price_bound_history
+            from current_price_bounds
             where
-                item = (select item from latest_reaction)
-                and rowid = (
-                    select
-                        max(rowid)
-                    from price_bound_history
-                    where
-                        item = (select item from latest_reaction))),
+                item = (select item from latest_reaction)),
 
         price_bounds_w_reaction as (
             select
@@ -520,9 +1417,10 @@ def update_price_bound_history():
                 else high
             end as high
         from price_bounds_w_reaction""")
+@profiled_helper
 def get_shelf_item_and_price(shelf_id):
     return (
-        query_data(
+        query_records(
             """
             select
                 item,
@@ -532,8 +1430,8 @@ def get_shelf_item_and_price(shelf_id):
                 id = :shelf_id
             """,
             {'shelf_id': shelf_id})
-        .to_dict('records')
         [0])
+@profiled_helper
 def empty_shelf(shelf_id):
     query_data_without_output(
         query="""
@@ -546,124 +1444,764 @@ def empty_shelf(shelf_id):
         params={'shelf_id': shelf_id})
     query_data_without_output(
         query=f"""
-            insert into shelf_history values(
+            insert into shelf_history(shelf_id, item, price) values(
                 :shelf_id,
                 null,
                 null)
         """,
         params={
             'shelf_id': shelf_id})
-def get_price_bound_violating_shelf_ids():
-    return (
-        query_data(
-            """
-            with latest_item_rowids as (
-                select
-                    max(rowid) as max_rowid,
-                    item
-                from price_bound_history
-                group by
-                    item),
-            latest_price_bounds as (
-                select
-                    a.item,
-                    b.low,
-                    b.high
-                from latest_item_rowids a
-                left outer join price_bound_history b on
-                    a.max_rowid = b.rowid
-                    and a.item = b.item)
+@profiled_helper
+def get_price_bound_violating_shelf_ids(items=None):
+    # Shelves are only ever filled at prices within their item's bounds, so
+    # after a tick only the shelves holding the items it reacted to can
+    # violate them, and those are found through the shelves_item index
+    return [
+        x[0]
+        for x in query_rows(
+            f"""
             select
                 a.id
             from shelves a
-            left outer join latest_price_bounds b on
+            inner join current_price_bounds b on
                 a.item = b.item
             where
-                a.price < b.low
-                or a.price > b.high
-            """
-        )
-        ['id']
-        .pipe(lambda x: [int(y) for y in x.values]))
-def replace_items_on_shelf_violating_price_bounds():
-    for violating_shelf_id in get_price_bound_violating_shelf_ids():
+                {'' if items is None else f"a.item in ({', '.join(['?'] * len(items))}) and"}
+                (a.price < b.low or a.price > b.high)
+            order by
+                a.id
+            """,
+            params=[] if items is None else list(items))]
+def replace_items_on_shelf_violating_price_bounds(
+        rng, competition_storage='full', items=None):
+    for violating_shelf_id in get_price_bound_violating_shelf_ids(items):
         violating_shelf_item_and_price = get_shelf_item_and_price(violating_shelf_id)
         empty_shelf(shelf_id=violating_shelf_id)
         add_items_2_inventory(
             item_counts={violating_shelf_item_and_price['item']: 1})
-        competition_data = (
-            get_thompson_competition(
-                price_bounds=get_inventory_item_price_bounds(),
-                rng=rng,
-                next_competition_index=get_next_competition_index()))
-        add_thompson_competition(
-            competition_data=competition_data.to_dict('records'))
-        violating_shelf_replacement_and_price = (
-            get_thompson_sampled_item_and_price(
-                competition_data=competition_data,
-                rng=rng))
-        move_item_2_shelf_and_set_price(
-            item=violating_shelf_replacement_and_price['item'],
+        fill_shelf_w_priced_item(
             shelf_id=violating_shelf_id,
-            price=violating_shelf_replacement_and_price['price'])
+            rng=rng,
+            competition_storage=competition_storage)
 
-if __name__ == '__main__':
-    clear_database()
-    initialize_database()
-    initialize_shelves(shelf_count=4)
-    item_count = 20
-    add_items_2_inventory(
-        item_counts={
-            'gold_runes': item_count,
-            'broken_sword': item_count,
-            'vine': item_count,
-            'root': item_count,
-            'hardened_steel': item_count,
-            'glass_lenses': item_count,
-            'teeth_stone': item_count,
-            'iron_bar': item_count,
-            'crystallized_energy': item_count,
-            'golem_core': item_count})
-    initialize_price_bound_history({
-        '275|3000': [
-            'gold_runes', 'hardened_steel'],
-        '2|275': [
-            'broken_sword', 'ancient_pot', 'crystallized_energy',
-            'glass_lenses', 'golem_core', 'iron_bar', 'root', 'teeth_stone', 'vine']})
-    add_price_reaction_bounds(
-        price_reaction_bounds=(
-            pd.DataFrame(
+def get_reaction_mood_indices(item_ids, prices, reaction_bounds):
+    # One searchsorted over every item's cheap/perfect/expensive uppers laid
+    # end to end, each item shifted past the previous one's price range.
+    # Bounds below every price (including missing ones) all count as
+    # exceeded, which makes the customer angry as in get_random_shelf_reaction
+    if len(prices) == 0:
+        return np.zeros(0, dtype=np.int64)
+    low = prices.min() - 1
+    reaction_bounds = np.maximum(reaction_bounds, low)
+    span = max(prices.max(), reaction_bounds.max()) - low + 1
+    offsets = np.arange(len(reaction_bounds)) * span
+    return (
+        np.searchsorted(
+            (reaction_bounds - low + offsets[:, None]).ravel(),
+            prices - low + offsets[item_ids])
+        - 3 * np.asarray(item_ids))
+@profiled_helper
+def get_occupied_shelves_w_reaction_bounds():
+    return (
+        query_records("""
+            select
+                a.id as shelf_id,
+                a.item,
+                a.price,
+                b.cheap_upper,
+                b.perfect_upper,
+                b.expensive_upper
+            from shelves a
+            left outer join price_reaction_bounds b on
+                b.rowid = (
+                    select
+                        min(rowid)
+                    from price_reaction_bounds
+                    where
+                        item = a.item)
+            where
+                a.item is not null
+            order by
+                a.id"""))
+@profiled_helper
+def get_current_price_bounds(items=None):
+    return {
+        item: (low, high)
+        for item, low, high in query_rows(
+            f"""
+            select
+                item,
+                low,
+                high
+            from current_price_bounds
+            {'' if items is None else f"where item in ({', '.join(['?'] * len(items))})"}""",
+            params=[] if items is None else list(items))}
+@profiled_helper
+def get_next_reaction_id():
+    return (
+        query_value("""
+            select
+                coalesce(max(rowid), 0) + 1 as next_reaction_id
+            from reactions"""))
+@profiled_helper
+def record_batch_shelf_reactions(visit_count, rng):
+    shelves = get_occupied_shelves_w_reaction_bounds()
+    visited = rng.choice(
+        len(shelves),
+        size=min(visit_count, len(shelves)),
+        replace=False)
+    # Each occupied shelf row carries its own item's reaction bounds
+    mood_indices = get_reaction_mood_indices(
+        item_ids=visited,
+        prices=np.array([x['price'] for x in shelves], dtype=np.int64)[visited],
+        reaction_bounds=np.array(
+            [
                 [
-                    ['broken_sword', 134, 165, 173],
-                    ['crystallized_energy', 89, 110, 115],
-                    ['glass_lenses', 89, 110, 115],
-                    ['gold_runes', 269, 330, 345],
-                    ['golem_core', 89, 110, 115],
-                    ['hardened_steel', 269, 330, 345],
-                    ['iron_bar', 21, 28, 30],
-                    ['root', 3, 6, 8],
-                    ['teeth_stone', 3, 6, 8],
-                    ['vine', 0, 3, 5]],
-                columns=[
-                    'item', 'cheap_upper', 'perfect_upper',
-                    'expensive_upper'])
-            .to_dict('records')))
-    rng = np.random.default_rng(71071763)
-    fill_empty_shelves_w_priced_items(rng)
-    inventory_item_count = get_inventory_item_count()
-    shelf_item_count = get_shelf_item_count()
-    while inventory_item_count or shelf_item_count:
+                    np.iinfo(np.int64).min if x[bound] is None else x[bound]
+                    for bound in ['cheap_upper', 'perfect_upper', 'expensive_upper']]
+                for x in shelves],
+            dtype=np.int64).reshape(-1, 3))
+    reactions = [
+        {
+            'shelf_id': shelves[i]['shelf_id'],
+            'item': shelves[i]['item'],
+            'price': shelves[i]['price'],
+            'mood': MOODS[mood_index]}
+        for i, mood_index in zip(visited, mood_indices)]
+    # Bounds of an item seen several times in the batch build on each other,
+    # as they would with one reaction per tick
+    price_bounds = get_current_price_bounds({x['item'] for x in reactions})
+    price_bound_rows = []
+    for reaction_id, reaction in enumerate(reactions, start=get_next_reaction_id()):
+        low, high = get_updated_price_bounds(
+            *price_bounds[reaction['item']],
+            price=reaction['price'],
+            mood=reaction['mood'])
+        price_bounds[reaction['item']] = (low, high)
+        price_bound_rows.append({
+            'reaction_id': reaction_id,
+            'item': reaction['item'],
+            'low': low,
+            'high': high})
+    execute_many_queries(
+        query="""
+            insert into reactions(shelf_id, item, price, mood) values(
+                :shelf_id,
+                :item,
+                :price,
+                :mood)""",
+        data=reactions)
+    execute_many_queries(
+        query="""
+            insert into price_bound_history(reaction_id, item, low, high) values(
+                :reaction_id,
+                :item,
+                :low,
+                :high)""",
+        data=price_bound_rows)
+    rejected = [x for x in reactions if x['mood'] == 'angry']
+    execute_many_queries(
+        query="""
+            insert into inventory_changes(item, change) values(
+                :item,
+                1)""",
+        data=rejected)
+    update_inventory(
+        item_changes=dict(Counter(x['item'] for x in rejected)))
+    execute_many_queries(
+        query="""
+            update shelves
+            set
+                item = null,
+                price = null
+            where
+                id = :shelf_id""",
+        data=reactions)
+    execute_many_queries(
+        query="""
+            insert into shelf_history(shelf_id, item, price) values(
+                :shelf_id,
+                null,
+                null)""",
+        data=reactions)
+    return reactions
+def fill_empty_shelves(rng, batch_fills=False, competition_storage='full'):
+    if batch_fills:
+        # Batched draws come from one matrix per refill, which the winner
+        # records cannot replay
+        if competition_storage != 'full':
+            raise Exception('Batched fills only support full competition storage')
+        fill_empty_shelves_w_priced_items_batched(rng)
+    else:
+        fill_empty_shelves_w_priced_items(rng, competition_storage=competition_storage)
+def run_simulation_tick(
+        rng, batch_fills=False, visits_per_tick=None, competition_storage='full'):
+    if visits_per_tick is None:
         shelf_reaction = get_random_shelf_reaction(rng)
         record_reaction(
             shelf_id=shelf_reaction['shelf_id'],
             mood=shelf_reaction['mood'])
         update_price_bound_history()
         if shelf_reaction['mood'] == 'angry':
-            add_items_2_inventory(
-                item_counts={
-                    get_shelf_item_and_price(shelf_id=shelf_reaction['shelf_id'])['item']: 1})
+            add_items_2_inventory(item_counts={shelf_reaction['item']: 1})
         empty_shelf(shelf_id=shelf_reaction['shelf_id'])
-        fill_empty_shelves_w_priced_items(rng)
-        replace_items_on_shelf_violating_price_bounds()
-        inventory_item_count = get_inventory_item_count()
-        shelf_item_count = get_shelf_item_count()
+        reacted_items = {shelf_reaction['item']}
+    else:
+        reacted_items = {x['item'] for x in record_batch_shelf_reactions(visits_per_tick, rng)}
+    fill_empty_shelves(
+        rng,
+        batch_fills=batch_fills,
+        competition_storage=competition_storage)
+    replace_items_on_shelf_violating_price_bounds(
+        rng,
+        competition_storage=competition_storage,
+        items=reacted_items)
+@profiled_helper
+def save_simulation_checkpoint(tick, rng, settings):
+    with database_transaction():
+        query_data_without_output("delete from simulation_checkpoints")
+        query_data_without_output(
+            """
+            insert into simulation_checkpoints values(
+                :tick,
+                :rng_state,
+                :settings,
+                :history_rowids,
+                :shelves,
+                :inventory,
+                :price_bounds)
+            """,
+            {
+                'tick': tick,
+                'rng_state': json.dumps(rng.bit_generator.state),
+                'settings': json.dumps(settings),
+                'history_rowids': json.dumps({
+                    table: query_value(f"select coalesce(max(rowid), 0) from {table}")
+                    for table in CHECKPOINT_HISTORY_TABLES}),
+                'shelves': json.dumps(query_rows("select id, item, price from shelves order by id")),
+                'inventory': json.dumps(query_rows("select item, count from inventory order by item")),
+                'price_bounds': json.dumps(query_rows(
+                    "select item, low, high from current_price_bounds order by item"))})
+@profiled_helper
+def restore_simulation_checkpoint():
+    checkpoint = query_records("select * from simulation_checkpoints")
+    if not checkpoint:
+        raise Exception('There is no simulation checkpoint to resume from')
+    checkpoint = checkpoint[0]
+    with database_transaction():
+        # Rows written after the checkpoint belong to the interrupted tick.
+        # Without autoincrement, their rowids are handed out again as the
+        # tick is rerun
+        for table, rowid in json.loads(checkpoint['history_rowids']).items():
+            query_data_without_output(
+                f"delete from {table} where rowid > :rowid",
+                {'rowid': rowid})
+        execute_many_queries(
+            "update shelves set item = ?, price = ? where id = ?",
+            [(item, price, shelf_id) for shelf_id, item, price in json.loads(checkpoint['shelves'])])
+        query_data_without_output("delete from inventory")
+        execute_many_queries(
+            "insert into inventory(item, count) values(?, ?)",
+            json.loads(checkpoint['inventory']))
+        query_data_without_output("delete from current_price_bounds")
+        execute_many_queries(
+            "insert into current_price_bounds(item, low, high) values(?, ?, ?)",
+            json.loads(checkpoint['price_bounds']))
+    rng_state = json.loads(checkpoint['rng_state'])
+    rng = np.random.Generator(getattr(np.random, rng_state['bit_generator'])())
+    rng.bit_generator.state = rng_state
+    return {
+        'tick': checkpoint['tick'],
+        'rng': rng,
+        'settings': json.loads(checkpoint['settings'])}
+def continue_simulation_ticks(
+        rng, tick_transactions=False, batch_fills=False, max_ticks=None,
+        visits_per_tick=None, competition_storage='full', checkpoint_every=None,
+        compact_every=None, retain_rows=DEFAULT_RETAIN_ROWS, tick_count=0,
+        convergence_ticks=None):
+    # convergence_ticks, when given, is a dict the tick each item's price
+    # bounds settle in is added to. Items settled before the first tick run
+    # here are added with that tick
+    settings = {
+        'batch_fills': batch_fills,
+        'visits_per_tick': visits_per_tick,
+        'competition_storage': competition_storage}
+    def update_convergence_ticks():
+        if convergence_ticks is not None:
+            for item in get_converged_items():
+                convergence_ticks.setdefault(item, tick_count)
+    update_convergence_ticks()
+    while (
+            (max_ticks is None or tick_count < max_ticks)
+            and (get_inventory_item_count() or get_shelf_item_count())):
+        with database_transaction() if tick_transactions else nullcontext():
+            run_simulation_tick(rng, **settings)
+        tick_count += 1
+        update_convergence_ticks()
+        if checkpoint_every is not None and tick_count % checkpoint_every == 0:
+            save_simulation_checkpoint(tick_count, rng, settings)
+        if compact_every is not None and tick_count % compact_every == 0:
+            compact_history(retain_rows=retain_rows)
+    return tick_count
+def run_simulation_ticks(
+        rng, tick_transactions=False, batch_fills=False, max_ticks=None,
+        visits_per_tick=None, competition_storage='full', checkpoint_every=None,
+        compact_every=None, retain_rows=DEFAULT_RETAIN_ROWS, convergence_ticks=None):
+    fill_empty_shelves(
+        rng,
+        batch_fills=batch_fills,
+        competition_storage=competition_storage)
+    if checkpoint_every is not None:
+        save_simulation_checkpoint(
+            0,
+            rng,
+            {
+                'batch_fills': batch_fills,
+                'visits_per_tick': visits_per_tick,
+                'competition_storage': competition_storage})
+    return continue_simulation_ticks(
+        rng,
+        tick_transactions=tick_transactions,
+        batch_fills=batch_fills,
+        max_ticks=max_ticks,
+        visits_per_tick=visits_per_tick,
+        competition_storage=competition_storage,
+        checkpoint_every=checkpoint_every,
+        compact_every=compact_every,
+        retain_rows=retain_rows,
+        convergence_ticks=convergence_ticks)
+def resume_simulation_ticks(
+        tick_transactions=False, max_ticks=None, checkpoint_every=None,
+        compact_every=None, retain_rows=DEFAULT_RETAIN_ROWS):
+    # Continues with the settings the checkpointed run was started with
+    checkpoint = restore_simulation_checkpoint()
+    return continue_simulation_ticks(
+        checkpoint['rng'],
+        tick_transactions=tick_transactions,
+        max_ticks=max_ticks,
+        checkpoint_every=checkpoint_every,
+        compact_every=compact_every,
+        retain_rows=retain_rows,
+        tick_count=checkpoint['tick'],
+        **checkpoint['settings'])
+def initialize_simulation(
+        shelf_count=DEFAULT_SHELF_COUNT,
+        item_counts=DEFAULT_ITEM_COUNTS,
+        price_bounds=DEFAULT_PRICE_BOUNDS,
+        price_reaction_bounds=DEFAULT_PRICE_REACTION_BOUNDS):
+    clear_database()
+    initialize_database()
+    initialize_shelves(shelf_count=shelf_count)
+    add_items_2_inventory(item_counts=item_counts)
+    initialize_price_bound_history(price_bounds)
+    add_price_reaction_bounds(price_reaction_bounds=price_reaction_bounds)
+def get_default_simulation_config():
+    return {
+        'shelf_count': DEFAULT_SHELF_COUNT,
+        'item_counts': DEFAULT_ITEM_COUNTS,
+        'price_bounds': DEFAULT_PRICE_BOUNDS,
+        'price_reaction_bounds': DEFAULT_PRICE_REACTION_BOUNDS}
+@profiled_helper
+def get_simulation_summary(tick_count, seconds):
+    reaction_count, revenue = query_rows("""
+        select
+            count(*),
+            coalesce(sum(case when mood != 'angry' then price else 0 end), 0)
+        from reactions
+        where
+            shop_id = 0""")[0]
+    return {
+        'ticks': tick_count,
+        'reactions': reaction_count,
+        'revenue': revenue,
+        'final_prices': dict(query_rows("""
+            select
+                item,
+                price
+            from reactions
+            where
+                rowid in (
+                    select
+                        max(rowid)
+                    from reactions
+                    where
+                        shop_id = 0
+                    group by
+                        item)
+            order by
+                item""")),
+        'price_bounds': {
+            item: [low, high]
+            for item, low, high in query_rows("""
+                select
+                    item,
+                    low,
+                    high
+                from current_price_bounds
+                order by
+                    item""")},
+        'seconds': seconds,
+        'ticks_per_second': tick_count / seconds if seconds else None}
+def run_simulation(config, rng, db=DEFAULT_DB_PATH, **simulation_kwargs):
+    """Run a whole simulation from a fresh database and summarise it.
+
+    config holds the shelf_count, item_counts, price_bounds and
+    price_reaction_bounds to start from, with missing ones taken from the
+    defaults. db is the database file to write to, or None to use the
+    active moonlighter_session. The remaining keyword arguments are passed
+    on to run_simulation_ticks.
+    """
+    with moonlighter_session(db) if db is not None else nullcontext():
+        initialize_simulation(**(get_default_simulation_config() | config))
+        start = time.perf_counter()
+        convergence_ticks = {}
+        tick_count = run_simulation_ticks(
+            rng,
+            convergence_ticks=convergence_ticks,
+            **simulation_kwargs)
+        return (
+            get_simulation_summary(tick_count, time.perf_counter() - start)
+            | {'convergence_ticks': dict(sorted(convergence_ticks.items()))})
+HISTORY_COMPACTIONS = {
+    # The latest bounds of every item up to the cutoff are kept, which the
+    # analytics triggers read as the previous bounds of its next reaction
+    # once the history is truncated back to a checkpoint
+    'price_bound_history': {
+        'compacted': """
+            rowid <= :cutoff
+            and rowid not in (
+                select
+                    max(rowid)
+                from price_bound_history
+                where
+                    rowid <= :cutoff
+                group by
+                    shop_id,
+                    item)""",
+        # Bare low and high come from the max(rowid) row of each group
+        'rollup': """
+            insert into price_bound_history_summary
+                select
+                    shop_id,
+                    item,
+                    rowid / :bucket_size as bucket,
+                    count(*),
+                    max(rowid),
+                    low,
+                    high
+                from price_bound_history
+                where
+                    {compacted}
+                group by
+                    shop_id,
+                    item,
+                    bucket
+            on conflict do update set
+                row_count = row_count + excluded.row_count,
+                last_rowid = excluded.last_rowid,
+                low = excluded.low,
+                high = excluded.high"""},
+    'inventory_changes': {
+        'compacted': "rowid <= :cutoff",
+        'rollup': """
+            insert into inventory_change_summary
+                select
+                    shop_id,
+                    item,
+                    rowid / :bucket_size as bucket,
+                    count(*),
+                    sum(change)
+                from inventory_changes
+                where
+                    {compacted}
+                group by
+                    shop_id,
+                    item,
+                    bucket
+            on conflict do update set
+                row_count = row_count + excluded.row_count,
+                change = change + excluded.change"""},
+    'thompson_competitions': {
+        'compacted': "rowid <= :cutoff",
+        'rollup': """
+            insert into thompson_competition_summary
+                select
+                    shop_id,
+                    item,
+                    rowid / :bucket_size as bucket,
+                    count(*),
+                    min(sampled_price),
+                    max(sampled_price),
+                    sum(sampled_price)
+                from thompson_competitions
+                where
+                    {compacted}
+                group by
+                    shop_id,
+                    item,
+                    bucket
+            on conflict do update set
+                row_count = row_count + excluded.row_count,
+                min_sampled_price = min(min_sampled_price, excluded.min_sampled_price),
+                max_sampled_price = max(max_sampled_price, excluded.max_sampled_price),
+                total_sampled_price = total_sampled_price + excluded.total_sampled_price"""},
+    'shelf_history': {
+        'compacted': "rowid <= :cutoff",
+        'rollup': """
+            insert into shelf_history_summary
+                select
+                    shop_id,
+                    shelf_id,
+                    rowid / :bucket_size as bucket,
+                    count(*),
+                    count(item)
+                from shelf_history
+                where
+                    {compacted}
+                group by
+                    shop_id,
+                    shelf_id,
+                    bucket
+            on conflict do update set
+                row_count = row_count + excluded.row_count,
+                fill_count = fill_count + excluded.fill_count"""},
+    # Competitions compacted away can no longer be reconstructed, so only
+    # their winners are summarised
+    'thompson_competition_winners': {
+        'compacted': "rowid <= :cutoff",
+        'rollup': """
+            insert into thompson_competition_winner_summary
+                select
+                    item,
+                    rowid / :bucket_size as bucket,
+                    count(*),
+                    sum(competitor_count),
+                    min(sampled_price),
+                    max(sampled_price),
+                    sum(sampled_price)
+                from thompson_competition_winners
+                where
+                    {compacted}
+                group by
+                    item,
+                    bucket
+            on conflict do update set
+                row_count = row_count + excluded.row_count,
+                competitor_count = competitor_count + excluded.competitor_count,
+                min_sampled_price = min(min_sampled_price, excluded.min_sampled_price),
+                max_sampled_price = max(max_sampled_price, excluded.max_sampled_price),
+                total_sampled_price = total_sampled_price + excluded.total_sampled_price"""},
+    # Summarised by inventory_change_summary, keeping each item's latest
+    # running count up to the cutoff for the trigger to add to
+    'inventory_snapshots': {
+        'compacted': """
+            rowid <= :cutoff
+            and rowid not in (
+                select
+                    max(rowid)
+                from inventory_snapshots
+                where
+                    rowid <= :cutoff
+                group by
+                    shop_id,
+                    item)"""}}
+@profiled_helper
+def vacuum_incrementally(pages=None):
+    # Databases created without incremental auto-vacuum keep their size and
+    # reuse the freed pages for new rows instead
+    if query_value("pragma auto_vacuum") == 2:
+        execute_sqlite_script(
+            "pragma incremental_vacuum;" if pages is None else
+            f"pragma incremental_vacuum({int(pages)});")
+@profiled_helper
+def get_history_compaction_cutoffs(retain_rows):
+    cutoffs = {
+        table: query_value(f"select coalesce(max(rowid), 0) from {table}") - retain_rows
+        for table in HISTORY_COMPACTIONS}
+    # Resuming truncates the history back to the checkpoint's rowids, so
+    # nothing written after them is rolled up and their last rows are kept
+    # for the rerun ticks' rowids to count up from
+    for (history_rowids,) in query_rows("select history_rowids from simulation_checkpoints"):
+        for table, rowid in json.loads(history_rowids).items():
+            if table in cutoffs:
+                cutoffs[table] = min(cutoffs[table], rowid - 1)
+    # Winners that outlive the compaction are rebuilt from the summaries and
+    # the rows after the cutoff, which have to cover every row up to their
+    # watermarks
+    for table, rowid in zip(
+            ['price_bound_history', 'inventory_changes'],
+            query_rows(
+                """
+                select
+                    min(price_bound_history_rowid),
+                    min(inventory_changes_rowid)
+                from thompson_competition_winners
+                where
+                    competition_ind > :cutoff""",
+                {'cutoff': cutoffs['thompson_competition_winners']})[0]):
+        if rowid is not None:
+            cutoffs[table] = min(cutoffs[table], rowid)
+    return cutoffs
+@profiled_helper
+def compact_history(
+        retain_rows=DEFAULT_RETAIN_ROWS, bucket_size=DEFAULT_SUMMARY_BUCKET_SIZE,
+        vacuum_pages=None):
+    """Roll all but the latest retain_rows rows of each log table up into its
+    summary table and delete them.
+
+    The state tables are untouched, and the latest row of every table is
+    always kept so rowids and competition indexes keep counting up. Rows
+    written after the simulation checkpoint are kept as well.
+    """
+    if retain_rows < 1:
+        raise Exception('Compaction has to retain at least one row of each table')
+    with database_transaction():
+        compacted_rows = {}
+        cutoffs = get_history_compaction_cutoffs(retain_rows)
+        for table, compaction in HISTORY_COMPACTIONS.items():
+            params = {
+                'cutoff': cutoffs[table],
+                'bucket_size': bucket_size}
+            if 'rollup' in compaction:
+                query_data_without_output(
+                    compaction['rollup'].format(compacted=compaction['compacted']),
+                    params)
+            compacted_rows[table] = query_value(
+                f"select count(*) from {table} where {compaction['compacted']}",
+                params)
+            query_data_without_output(
+                f"delete from {table} where {compaction['compacted']}",
+                params)
+    vacuum_incrementally(vacuum_pages)
+    return compacted_rows
+def print_convergence_ticks(convergence_ticks):
+    for item, tick in convergence_ticks.items():
+        print(f'{item} price settled at tick {tick}')
+def get_simulation_argument_parser(description):
+    # The options every simulation driver supports; each adds its own
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--db-path', default=DEFAULT_DB_PATH)
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument(
+        '--batch-fills',
+        action='store_true',
+        help=(
+            'Price all empty shelves with one batched Thompson draw. This '
+            'consumes the rng differently from the one-shelf-at-a-time fill.'))
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Print per-helper query timings at the end of the run.')
+    parser.add_argument(
+        '--profile-trace',
+        help='JSONL file to stream one record per database call to.')
+    parser.add_argument(
+        '--visits-per-tick',
+        type=int,
+        help=(
+            'Simulate this many customer visits to distinct shelves per tick '
+            'instead of one, with bound updates applied in visit order.'))
+    parser.add_argument(
+        '--competition-storage',
+        choices=['full', 'winners', 'pruned'],
+        default='full',
+        help=(
+            'Store every sampled competitor price, only each competition\'s '
+            'winner with what is needed to reconstruct the rest on demand, or '
+            'only the prices of items that are still unsettled and could win. '
+            'Pruning consumes the rng differently from the other two.'))
+    parser.add_argument(
+        '--journal-mode',
+        choices=['delete', 'truncate', 'persist', 'memory', 'wal', 'off'])
+    parser.add_argument(
+        '--synchronous',
+        choices=['off', 'normal', 'full', 'extra'])
+    return parser
+def get_argument_parser():
+    parser = get_simulation_argument_parser(
+        'Simulate Bayesian bandit pricing of a Moonlighter shop.')
+    parser.add_argument(
+        '--tick-transactions',
+        action='store_true',
+        help='Commit each simulation tick as a single transaction.')
+    parser.add_argument(
+        '--migrate',
+        action='store_true',
+        help='Bring an existing database up to the current schema and exit.')
+    parser.add_argument(
+        '--checkpoint-every',
+        type=int,
+        help='Save the rng and shop state every this many ticks for --resume.')
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help=(
+            'Continue an interrupted run from its last checkpoint, with the '
+            'settings it was started with.'))
+    parser.add_argument(
+        '--compact-every',
+        type=int,
+        help='Compact the history tables every this many ticks.')
+    parser.add_argument(
+        '--retain-rows',
+        type=int,
+        default=DEFAULT_RETAIN_ROWS,
+        help='Latest rows of each history table that compaction keeps in full.')
+    parser.add_argument(
+        '--compact',
+        action='store_true',
+        help='Compact the history tables of an existing database and exit.')
+    parser.add_argument(
+        '--check-inventory',
+        action='store_true',
+        help='List items whose inventory differs from inventory_changes and exit.')
+    parser.add_argument(
+        '--repair-inventory',
+        action='store_true',
+        help='Rebuild the inventory table from inventory_changes and exit.')
+    return parser
+
+if __name__ == '__main__':
+    args = get_argument_parser().parse_args()
+    with moonlighter_session(
+            args.db_path,
+            journal_mode=args.journal_mode,
+            synchronous=args.synchronous):
+        if args.migrate:
+            migrate_database()
+            raise SystemExit
+        if args.compact:
+            migrate_database()
+            print(compact_history(retain_rows=args.retain_rows))
+            raise SystemExit
+        if args.check_inventory:
+            print(get_inventory_inconsistencies().to_string(index=False))
+            raise SystemExit
+        if args.repair_inventory:
+            rebuild_inventory()
+            raise SystemExit
+        with (
+                profile_queries(args.profile_trace)
+                if args.profile or args.profile_trace else
+                nullcontext()) as profiler:
+            if args.resume:
+                resume_simulation_ticks(
+                    tick_transactions=args.tick_transactions,
+                    checkpoint_every=args.checkpoint_every,
+                    compact_every=args.compact_every,
+                    retain_rows=args.retain_rows)
+            else:
+                summary = run_simulation(
+                    get_default_simulation_config(),
+                    np.random.default_rng(args.seed),
+                    db=None,
+                    tick_transactions=args.tick_transactions,
+                    batch_fills=args.batch_fills,
+                    visits_per_tick=args.visits_per_tick,
+                    competition_storage=args.competition_storage,
+                    checkpoint_every=args.checkpoint_every,
+                    compact_every=args.compact_every,
+                    retain_rows=args.retain_rows)
+                print_convergence_ticks(summary['convergence_ticks'])
+        if profiler is not None:
+            print(get_query_profile_summary(profiler).to_string(index=False))
@@ -0,0 +1,319 @@
+import argparse
+import asyncio
+import json
+import numpy as np
+from moonlighter_engine import EMPTY, MoonlighterEngine
+from moonlighter_pricing import (
+    DEFAULT_DB_PATH,
+    DEFAULT_SEED,
+    MOODS,
+    get_updated_price_bounds,
+    moonlighter_session)
+
+STATUS_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    409: 'Conflict',
+    500: 'Internal Server Error'}
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class ShopWriter:
+    """Single writer for one shop's database.
+
+    Requests are queued and applied in arrival order to an in-memory engine.
+    Each batch of queued requests is committed in one transaction before any
+    of them is answered. Reads are served from the snapshot published after
+    the last commit, so they never wait on the writer.
+    """
+    def __init__(self, db_path, rng, batch_size=64, journal_mode='wal', synchronous='normal'):
+        self.db_path = db_path
+        self.rng = rng
+        self.batch_size = batch_size
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.operations = asyncio.Queue()
+        self.ready = asyncio.Event()
+        self.engine = None
+        self.shelf_indices = {}
+        self.snapshot = None
+
+    async def run(self):
+        with moonlighter_session(
+                self.db_path,
+                journal_mode=self.journal_mode,
+                synchronous=self.synchronous,
+                check_same_thread=False):
+            self.load_engine()
+            self.ready.set()
+            while True:
+                batch = [await self.operations.get()]
+                while len(batch) < self.batch_size and not self.operations.empty():
+                    batch.append(self.operations.get_nowait())
+                if self.engine is None and (error := self.reload_engine()) is not None:
+                    self.answer([(future, None, error) for _, _, future in batch])
+                    continue
+                results = []
+                for operation, kwargs, future in batch:
+                    # A failed request is answered with its error; the
+                    # operations validate before changing any state
+                    try:
+                        results.append((future, operation(**kwargs), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+                try:
+                    await asyncio.to_thread(self.engine.flush)
+                except Exception as e:
+                    # The rolled back batch is lost, so the engine starts over
+                    # from what the database holds
+                    results = [(future, None, e) for future, _, _ in results]
+                    self.reload_engine()
+                if self.engine is not None:
+                    self.publish_snapshot()
+                self.answer(results)
+    def answer(self, results):
+        for future, result, error in results:
+            if future.cancelled():
+                continue
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+    def reload_engine(self):
+        # Until a reload succeeds every request fails with its error, and
+        # reads keep the snapshot of the last commit
+        try:
+            self.load_engine()
+        except Exception as e:
+            self.engine = None
+            return e
+    def load_engine(self):
+        self.engine = MoonlighterEngine.from_database()
+        self.shelf_indices = {
+            int(shelf_id): i
+            for i, shelf_id in enumerate(self.engine.shelf_ids)}
+        self.publish_snapshot()
+    def publish_snapshot(self):
+        engine = self.engine
+        self.snapshot = {
+            'shelves': [
+                {
+                    'shelf_id': int(shelf_id),
+                    'item': None if item_id == EMPTY else engine.items[item_id],
+                    'price': None if item_id == EMPTY else int(price)}
+                for shelf_id, item_id, price in zip(
+                    engine.shelf_ids, engine.shelf_items, engine.shelf_prices)],
+            'inventory': {
+                item: int(count)
+                for item, count in zip(engine.items, engine.inventory_counts)
+                if count > 0},
+            'price_bounds': {
+                item: [int(low), int(high)]
+                for item, low, high, has_price_bounds in zip(
+                    engine.items, engine.lows, engine.highs, engine.has_price_bounds)
+                if has_price_bounds}}
+    async def submit(self, operation, **kwargs):
+        future = asyncio.get_running_loop().create_future()
+        await self.operations.put((operation, kwargs, future))
+        return await future
+    def get_shelf_index(self, shelf_id):
+        if shelf_id not in self.shelf_indices:
+            raise RequestError(404, f'Unknown shelf {shelf_id}')
+        return self.shelf_indices[shelf_id]
+    def fill_shelf(self, shelf_id):
+        shelf_index = self.get_shelf_index(shelf_id)
+        engine = self.engine
+        if engine.shelf_items[shelf_index] != EMPTY:
+            raise RequestError(409, f'Shelf {shelf_id} is not empty')
+        if not ((engine.inventory_counts > 0) & engine.has_price_bounds).any():
+            raise RequestError(409, 'No priced items left in the inventory')
+        engine.fill_shelf_w_priced_item(shelf_index, self.rng)
+        return {
+            'shelf_id': shelf_id,
+            'item': engine.items[engine.shelf_items[shelf_index]],
+            'price': int(engine.shelf_prices[shelf_index])}
+    def record_reaction(self, shelf_id, mood):
+        shelf_index = self.get_shelf_index(shelf_id)
+        engine = self.engine
+        if mood not in MOODS:
+            raise RequestError(400, f'Unknown mood {mood}')
+        item_id = int(engine.shelf_items[shelf_index])
+        if item_id == EMPTY:
+            raise RequestError(409, f'Shelf {shelf_id} is empty')
+        price = int(engine.shelf_prices[shelf_index])
+        low, high = get_updated_price_bounds(
+            int(engine.lows[item_id]), int(engine.highs[item_id]), price, mood)
+        if low > high:
+            # Recording it would leave the item with no price to sample
+            raise RequestError(
+                409, f'A {mood} reaction at {price} contradicts the price bounds of {engine.items[item_id]}')
+        engine.record_shelf_reaction(shelf_index, mood)
+        # Shelves now priced outside their item's bounds would answer every
+        # later reaction with a conflict, so they are repriced in this batch
+        # as the simulation tick does
+        replaced_shelf_indices = engine.get_price_bound_violating_shelf_indices()
+        engine.replace_items_on_shelf_violating_price_bounds(self.rng)
+        return {
+            'shelf_id': shelf_id,
+            'item': engine.items[item_id],
+            'price': price,
+            'mood': mood,
+            'price_bounds': [int(engine.lows[item_id]), int(engine.highs[item_id])],
+            'replaced_shelves': [
+                {
+                    'shelf_id': int(engine.shelf_ids[i]),
+                    'item': engine.items[engine.shelf_items[i]],
+                    'price': int(engine.shelf_prices[i])}
+                for i in replaced_shelf_indices]}
+
+def get_json_body(body):
+    try:
+        body = json.loads(body or b'{}')
+    except ValueError:
+        raise RequestError(400, 'Request body is not JSON')
+    if not isinstance(body, dict):
+        raise RequestError(400, 'Request body is not a JSON object')
+    return body
+def get_shelf_id(value):
+    try:
+        return int(value)
+    except ValueError:
+        raise RequestError(404, f'Unknown shelf {value}')
+async def handle_request(shops, method, path, body):
+    parts = path.split('?')[0].strip('/').split('/')
+    if len(parts) < 2 or parts[0] != 'shops':
+        raise RequestError(404, f'Unknown path {path}')
+    if parts[1] not in shops:
+        raise RequestError(404, f'Unknown shop {parts[1]}')
+    shop = shops[parts[1]]
+    if len(parts) == 2:
+        if method != 'GET':
+            raise RequestError(405, f'{method} is not allowed on {path}')
+        return shop.snapshot
+    if len(parts) != 5 or parts[2] != 'shelves' or parts[4] not in ('fill', 'reactions'):
+        raise RequestError(404, f'Unknown path {path}')
+    if method != 'POST':
+        raise RequestError(405, f'{method} is not allowed on {path}')
+    if parts[4] == 'fill':
+        return await shop.submit(shop.fill_shelf, shelf_id=get_shelf_id(parts[3]))
+    return await shop.submit(
+        shop.record_reaction,
+        shelf_id=get_shelf_id(parts[3]),
+        mood=get_json_body(body).get('mood'))
+async def read_request(reader, request_line):
+    try:
+        method, path, _ = request_line.decode().split()
+    except ValueError:
+        raise RequestError(400, f'Malformed request line {request_line!r}')
+    headers = {}
+    while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    content_length = headers.get('content-length', '0')
+    if not content_length.isdigit():
+        raise RequestError(400, f'Malformed Content-Length {content_length}')
+    return method, path, headers, await reader.readexactly(int(content_length))
+async def write_response(writer, status, payload):
+    data = json.dumps(payload).encode()
+    writer.write(
+        f'HTTP/1.1 {status} {STATUS_REASONS[status]}\r\n'
+        'Content-Type: application/json\r\n'
+        f'Content-Length: {len(data)}\r\n\r\n'.encode()
+        + data)
+    await writer.drain()
+async def handle_connection(shops, reader, writer):
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            try:
+                method, path, headers, body = await read_request(reader, request_line)
+            except RequestError as e:
+                # Without a well-formed request the next one cannot be found
+                # in the stream, so the connection is closed after answering
+                await write_response(writer, e.status, {'error': str(e)})
+                break
+            try:
+                status, payload = 200, await handle_request(shops, method, path, body)
+            except RequestError as e:
+                status, payload = e.status, {'error': str(e)}
+            except Exception as e:
+                status, payload = 500, {'error': str(e)}
+            await write_response(writer, status, payload)
+            if headers.get('connection', '').lower() == 'close':
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+async def start_service(shop_db_paths, host='127.0.0.1', port=8080, seed=DEFAULT_SEED, batch_size=64):
+    # Each shop draws from its own stream spawned from the seed
+    shops = {
+        shop: ShopWriter(db_path, np.random.default_rng(seed_sequence), batch_size=batch_size)
+        for (shop, db_path), seed_sequence in zip(
+            shop_db_paths.items(),
+            np.random.SeedSequence(seed).spawn(len(shop_db_paths)))}
+    writer_tasks = [asyncio.create_task(shop.run()) for shop in shops.values()]
+    for shop, task in zip(shops.values(), writer_tasks):
+        ready = asyncio.create_task(shop.ready.wait())
+        await asyncio.wait([ready, task], return_when=asyncio.FIRST_COMPLETED)
+        if task.done():
+            ready.cancel()
+            await stop_service(None, writer_tasks)
+            raise Exception(f'Could not open {shop.db_path}: {task.exception()}')
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(shops, reader, writer),
+        host=host,
+        port=port)
+    return server, writer_tasks
+async def stop_service(server, writer_tasks):
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+    for task in writer_tasks:
+        task.cancel()
+    await asyncio.gather(*writer_tasks, return_exceptions=True)
+def get_shop_db_paths(shop_args):
+    return dict(x.split('=', 1) for x in shop_args)
+async def serve(shop_db_paths, host, port, seed, batch_size):
+    server, writer_tasks = await start_service(
+        shop_db_paths,
+        host=host,
+        port=port,
+        seed=seed,
+        batch_size=batch_size)
+    print(f"Serving shops {', '.join(shop_db_paths)} on {host}:{server.sockets[0].getsockname()[1]}")
+    try:
+        await server.serve_forever()
+    finally:
+        await stop_service(server, writer_tasks)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve shelf pricing and customer reactions over HTTP/JSON.')
+    parser.add_argument(
+        '--shop',
+        action='append',
+        default=[],
+        help=f'Shop name and database as NAME=PATH; defaults to main={DEFAULT_DB_PATH}.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=64,
+        help='Most queued requests committed together in one transaction.')
+    args = parser.parse_args()
+    asyncio.run(serve(
+        get_shop_db_paths(args.shop or [f'main={DEFAULT_DB_PATH}']),
+        host=args.host,
+        port=args.port,
+        seed=args.seed,
+        batch_size=args.batch_size))
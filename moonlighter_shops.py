@@ -0,0 +1,352 @@
+from collections import Counter
+from contextlib import nullcontext
+import argparse
+import numpy as np
+from moonlighter_engine import EMPTY, HISTORY_TABLE_COLUMNS, MoonlighterEngine
+from moonlighter_pricing import (
+    DEFAULT_DB_PATH,
+    DEFAULT_RETAIN_ROWS,
+    DEFAULT_SEED,
+    MOODS,
+    compact_history,
+    database_transaction,
+    execute_many_queries,
+    get_query_profile_summary,
+    get_reaction_mood_indices,
+    get_updated_price_bound_arrays,
+    initialize_simulation,
+    moonlighter_session,
+    profile_queries,
+    profiled_helper,
+    update_inventory)
+
+SHOP_HISTORY_TABLE_COLUMNS = {
+    table: columns + ['shop_id']
+    for table, columns in HISTORY_TABLE_COLUMNS.items()
+    if table != 'thompson_competition_winners'}
+
+class MoonlighterShops:
+    """Many independent shops with the same catalog and shelf layout, held as
+    [shops, items] and [shops, shelves] arrays so one tick advances them all.
+
+    Each tick follows run_simulation_tick: every shop with something left to
+    sell gets one customer reaction, refills its empty shelves through Thompson
+    competitions and replaces items priced outside their bounds. History rows
+    are tagged with their shop_id; shop 0 also keeps the shelves, inventory
+    and current_price_bounds tables up to date.
+    """
+    def __init__(
+            self, items, shelf_ids, shelf_items, shelf_prices, inventory_counts,
+            lows, highs, has_price_bounds, reaction_bounds,
+            next_competition_index, next_reaction_id, flush_every=None,
+            compact_every=None, retain_rows=DEFAULT_RETAIN_ROWS):
+        self.items = np.array(items, dtype=object)
+        self.shelf_ids = np.asarray(shelf_ids, dtype=np.int64)
+        self.shelf_items = np.array(shelf_items, dtype=np.int64)
+        self.shelf_prices = np.array(shelf_prices, dtype=np.int64)
+        self.inventory_counts = np.array(inventory_counts, dtype=np.int64)
+        self.lows = np.array(lows, dtype=np.int64)
+        self.highs = np.array(highs, dtype=np.int64)
+        self.has_price_bounds = np.asarray(has_price_bounds, dtype=bool)
+        self.reaction_bounds = np.asarray(reaction_bounds, dtype=np.int64)
+        self.next_competition_index = next_competition_index
+        self.next_reaction_id = next_reaction_id
+        self.flush_every = flush_every
+        self.compact_every = compact_every
+        self.retain_rows = retain_rows
+        self.shop_count = len(self.inventory_counts)
+        self.tick_count = 0
+        self.shop_tick_counts = np.zeros(self.shop_count, dtype=np.int64)
+        self.revenues = np.zeros(self.shop_count, dtype=np.int64)
+        # Column arrays per table, concatenated when flushed
+        self.pending_rows = {table: [] for table in SHOP_HISTORY_TABLE_COLUMNS}
+
+    @classmethod
+    def from_engine(
+            cls, engine, shop_count, flush_every=None, compact_every=None,
+            retain_rows=DEFAULT_RETAIN_ROWS):
+        # Every shop starts from the engine's state. Shop 0 continues the
+        # history already in the database; the others get rows recording
+        # their starting inventory, bounds and shelves
+        shops = cls(
+            items=engine.items,
+            shelf_ids=engine.shelf_ids,
+            shelf_items=np.tile(engine.shelf_items, (shop_count, 1)),
+            shelf_prices=np.tile(engine.shelf_prices, (shop_count, 1)),
+            inventory_counts=np.tile(engine.inventory_counts, (shop_count, 1)),
+            lows=np.tile(engine.lows, (shop_count, 1)),
+            highs=np.tile(engine.highs, (shop_count, 1)),
+            has_price_bounds=engine.has_price_bounds,
+            reaction_bounds=engine.reaction_bounds,
+            next_competition_index=engine.next_competition_index,
+            next_reaction_id=engine.next_reaction_id,
+            flush_every=flush_every,
+            compact_every=compact_every,
+            retain_rows=retain_rows)
+        new_shops = np.arange(1, shop_count)
+        stocked_items = np.flatnonzero(engine.inventory_counts)
+        bounded_items = np.flatnonzero(engine.has_price_bounds)
+        occupied_shelves = np.flatnonzero(engine.shelf_items != EMPTY)
+        shops.add_rows(
+            'price_bound_history',
+            None,
+            shops.items[bounded_items],
+            engine.lows[bounded_items],
+            engine.highs[bounded_items],
+            new_shops[:, None])
+        shops.add_rows(
+            'inventory_changes',
+            shops.items[stocked_items],
+            engine.inventory_counts[stocked_items],
+            new_shops[:, None])
+        shops.add_rows(
+            'shelf_history',
+            engine.shelf_ids[occupied_shelves],
+            shops.items[engine.shelf_items[occupied_shelves]],
+            engine.shelf_prices[occupied_shelves],
+            new_shops[:, None])
+        return shops
+    @classmethod
+    def from_database(
+            cls, shop_count, flush_every=None, compact_every=None,
+            retain_rows=DEFAULT_RETAIN_ROWS):
+        return cls.from_engine(
+            MoonlighterEngine.from_database(),
+            shop_count=shop_count,
+            flush_every=flush_every,
+            compact_every=compact_every,
+            retain_rows=retain_rows)
+
+    def add_rows(self, table, *columns):
+        self.pending_rows[table].append(
+            [x.ravel() for x in np.broadcast_arrays(*columns)])
+    def get_inventory_item_counts(self):
+        return self.inventory_counts.clip(min=0).sum(axis=1)
+    def get_active_shops(self):
+        return (
+            (self.get_inventory_item_counts() > 0)
+            | (self.shelf_items != EMPTY).any(axis=1))
+    def add_items_2_inventory(self, shops, item_ids, change):
+        # At most one change per shop per call, so plain fancy indexing
+        # cannot drop repeated updates
+        self.inventory_counts[shops, item_ids] += change
+        self.add_rows('inventory_changes', self.items[item_ids], change, shops)
+    def empty_shelves(self, shops, shelf_indices):
+        self.shelf_items[shops, shelf_indices] = EMPTY
+        self.shelf_prices[shops, shelf_indices] = 0
+        self.add_rows('shelf_history', self.shelf_ids[shelf_indices], None, None, shops)
+    def move_items_2_shelves_and_set_prices(self, shops, shelf_index, item_ids, prices):
+        self.add_items_2_inventory(shops, item_ids, change=-1)
+        self.add_rows('shelf_history', self.shelf_ids[shelf_index], self.items[item_ids], prices, shops)
+        self.shelf_items[shops, shelf_index] = item_ids
+        self.shelf_prices[shops, shelf_index] = prices
+    def run_thompson_competitions(self, shops, rng):
+        competing = (self.inventory_counts[shops] > 0) & self.has_price_bounds
+        lows = self.lows[shops]
+        highs = self.highs[shops]
+        # Items out of the competition draw from [0, 0] so their bounds
+        # cannot make the vectorized draw fail
+        sampled_prices = np.where(
+            competing,
+            rng.integers(
+                np.where(competing, lows, 0),
+                np.where(competing, highs, 0) + 1),
+            -1)
+        # Random tie-break among each shop's highest draws, as in
+        # get_batch_thompson_competitions
+        winner_ids = np.where(
+            competing & (sampled_prices == sampled_prices.max(axis=1, keepdims=True)),
+            rng.random(sampled_prices.shape),
+            -1).argmax(axis=1)
+        shop_indices, item_ids = np.nonzero(competing)
+        self.add_rows(
+            'thompson_competitions',
+            self.next_competition_index + shop_indices,
+            self.items[item_ids],
+            lows[shop_indices, item_ids],
+            highs[shop_indices, item_ids],
+            sampled_prices[shop_indices, item_ids],
+            shops[shop_indices])
+        self.next_competition_index += len(shops)
+        return winner_ids, sampled_prices[np.arange(len(shops)), winner_ids]
+    def fill_shelves_w_priced_items(self, shops, shelf_index, rng):
+        if len(shops) == 0:
+            return
+        item_ids, prices = self.run_thompson_competitions(shops, rng)
+        self.move_items_2_shelves_and_set_prices(shops, shelf_index, item_ids, prices)
+    def get_fillable_shops(self):
+        return (
+            (self.get_inventory_item_counts() > 0)
+            & ((self.inventory_counts > 0) & self.has_price_bounds).any(axis=1))
+    def fill_empty_shelves_w_priced_items(self, rng):
+        # Shelves are filled in order while a shop has stock, which fills
+        # the same shelves as get_empty_shelf_ids
+        for shelf_index in range(len(self.shelf_ids)):
+            self.fill_shelves_w_priced_items(
+                np.flatnonzero(
+                    (self.shelf_items[:, shelf_index] == EMPTY)
+                    & self.get_fillable_shops()),
+                shelf_index,
+                rng)
+    def replace_items_on_shelves_violating_price_bounds(self, rng):
+        for shelf_index in range(len(self.shelf_ids)):
+            occupied = self.shelf_items[:, shelf_index] != EMPTY
+            item_ids = np.where(occupied, self.shelf_items[:, shelf_index], 0)
+            shop_indices = np.arange(self.shop_count)
+            prices = self.shelf_prices[:, shelf_index]
+            shops = np.flatnonzero(
+                occupied
+                & self.has_price_bounds[item_ids]
+                & (
+                    (prices < self.lows[shop_indices, item_ids])
+                    | (prices > self.highs[shop_indices, item_ids])))
+            if len(shops) == 0:
+                continue
+            self.empty_shelves(shops, shelf_index)
+            self.add_items_2_inventory(shops, item_ids[shops], change=1)
+            self.fill_shelves_w_priced_items(shops, shelf_index, rng)
+    def record_reactions(self, shops, rng):
+        # Each shop's customer picks uniformly among its occupied shelves
+        shelf_indices = np.where(
+            self.shelf_items[shops] != EMPTY,
+            rng.random((len(shops), len(self.shelf_ids))),
+            -1).argmax(axis=1)
+        item_ids = self.shelf_items[shops, shelf_indices]
+        prices = self.shelf_prices[shops, shelf_indices]
+        mood_indices = get_reaction_mood_indices(item_ids, prices, self.reaction_bounds)
+        reaction_ids = self.next_reaction_id + np.arange(len(shops))
+        self.next_reaction_id += len(shops)
+        self.add_rows(
+            'reactions',
+            self.shelf_ids[shelf_indices],
+            self.items[item_ids],
+            prices,
+            np.array(MOODS, dtype=object)[mood_indices],
+            shops)
+        angry = mood_indices == MOODS.index('angry')
+        np.add.at(self.revenues, shops[~angry], prices[~angry])
+        # Same rules as update_price_bound_history, for all shops at once
+        lows, highs = get_updated_price_bound_arrays(
+            self.lows[shops, item_ids],
+            self.highs[shops, item_ids],
+            prices,
+            mood_indices)
+        self.lows[shops, item_ids] = lows
+        self.highs[shops, item_ids] = highs
+        bounded = self.has_price_bounds[item_ids]
+        self.add_rows(
+            'price_bound_history',
+            reaction_ids[bounded],
+            self.items[item_ids[bounded]],
+            lows[bounded],
+            highs[bounded],
+            shops[bounded])
+        self.add_items_2_inventory(shops[angry], item_ids[angry], change=1)
+        self.empty_shelves(shops, shelf_indices)
+    def run_simulation_tick(self, rng):
+        active = self.get_active_shops()
+        self.record_reactions(
+            np.flatnonzero(active & (self.shelf_items != EMPTY).any(axis=1)),
+            rng)
+        self.fill_empty_shelves_w_priced_items(rng)
+        self.replace_items_on_shelves_violating_price_bounds(rng)
+        self.shop_tick_counts += active
+        self.tick_count += 1
+        # Compaction works on the database, so the buffered rows go first
+        is_compacting = self.compact_every is not None and self.tick_count % self.compact_every == 0
+        if is_compacting or (self.flush_every is not None and self.tick_count % self.flush_every == 0):
+            self.flush()
+        if is_compacting:
+            compact_history(retain_rows=self.retain_rows)
+    def run_until_sold_out(self, rng, max_ticks=None):
+        self.fill_empty_shelves_w_priced_items(rng)
+        tick_count = 0
+        while (
+                (max_ticks is None or tick_count < max_ticks)
+                and self.get_active_shops().any()):
+            self.run_simulation_tick(rng)
+            tick_count += 1
+        return tick_count
+    def run_simulation_ticks(self, rng, max_ticks=None):
+        tick_count = self.run_until_sold_out(rng, max_ticks=max_ticks)
+        self.flush()
+        return tick_count
+    def get_summary(self):
+        return {
+            'ticks': self.shop_tick_counts.tolist(),
+            'revenue': self.revenues.tolist()}
+    def get_pending_rows(self, table):
+        chunks = self.pending_rows[table]
+        return list(zip(*[
+            np.concatenate([chunk[i] for chunk in chunks]).tolist()
+            for i in range(len(SHOP_HISTORY_TABLE_COLUMNS[table]))]))
+    @profiled_helper
+    def flush(self):
+        with database_transaction():
+            for table, columns in SHOP_HISTORY_TABLE_COLUMNS.items():
+                rows = self.get_pending_rows(table) if self.pending_rows[table] else []
+                if rows:
+                    execute_many_queries(
+                        f"""
+                        insert into {table}({', '.join(columns)}) values(
+                            {', '.join(['?'] * len(columns))})""",
+                        rows)
+                if table == 'inventory_changes':
+                    item_changes = Counter()
+                    for item, change, shop_id in rows:
+                        if shop_id == 0:
+                            item_changes[item] += change
+                    update_inventory(item_changes=dict(item_changes))
+            execute_many_queries(
+                """
+                update shelves
+                set
+                    item = ?,
+                    price = ?
+                where
+                    id = ?""",
+                [
+                    (
+                        (None, None) if item_id == EMPTY else
+                        (self.items[item_id], int(price)))
+                    + (int(shelf_id),)
+                    for shelf_id, item_id, price in zip(
+                        self.shelf_ids, self.shelf_items[0], self.shelf_prices[0])])
+        self.pending_rows = {table: [] for table in SHOP_HISTORY_TABLE_COLUMNS}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Simulate many independent shops with the same catalog at once.')
+    parser.add_argument('--shops', type=int, default=100)
+    parser.add_argument('--db-path', default=DEFAULT_DB_PATH)
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument(
+        '--flush-every',
+        type=int,
+        help='Write buffered history to the database every this many ticks.')
+    parser.add_argument(
+        '--compact-every',
+        type=int,
+        help='Flush and compact the history tables every this many ticks.')
+    parser.add_argument(
+        '--retain-rows',
+        type=int,
+        default=DEFAULT_RETAIN_ROWS,
+        help='Latest rows of each history table that compaction keeps in full.')
+    parser.add_argument('--profile', action='store_true')
+    args = parser.parse_args()
+    with moonlighter_session(args.db_path):
+        initialize_simulation()
+        shops = MoonlighterShops.from_database(
+            shop_count=args.shops,
+            flush_every=args.flush_every,
+            compact_every=args.compact_every,
+            retain_rows=args.retain_rows)
+        with profile_queries() if args.profile else nullcontext() as profiler:
+            ticks = shops.run_simulation_ticks(np.random.default_rng(args.seed))
+        if profiler is not None:
+            print(get_query_profile_summary(profiler).to_string(index=False))
+    summary = shops.get_summary()
+    print(
+        f'{args.shops} shops sold out within {ticks} ticks, '
+        f"mean revenue {np.mean(summary['revenue']):.1f}")
@@ -0,0 +1,43 @@
+from moonlighter_benchmark import (
+    get_regressions,
+    run_benchmark_case,
+    run_startup_benchmarks)
+
+def get_test_benchmark(ticks_per_second, mean_seconds):
+    return {
+        'results': [{
+            'backend': 'sql',
+            'shelf_count': 4,
+            'item_count': 10,
+            'stock': 20,
+            'max_ticks': 100,
+            'tick_transactions': False,
+            'ticks_per_second': ticks_per_second,
+            'function_timings': {
+                'update_inventory': {'calls': 10, 'mean_seconds': mean_seconds}}}]}
+def test_get_regressions():
+    baseline = get_test_benchmark(ticks_per_second=100, mean_seconds=0.010)
+    assert get_regressions(baseline, get_test_benchmark(95, 0.0105), 0.1) == []
+    assert (
+        [
+            regression['metric']
+            for regression in get_regressions(
+                baseline, get_test_benchmark(80, 0.012), 0.1)]
+        == ['ticks_per_second', 'update_inventory mean_seconds'])
+def test_run_benchmark_case_reports_function_timings():
+    for backend in ['sql', 'engine']:
+        result = run_benchmark_case(
+            backend=backend,
+            shelf_count=2,
+            item_count=3,
+            stock=2,
+            max_ticks=5)
+        assert result['ticks'] == 5
+        assert result['ticks_per_second'] > 0
+        assert result['function_timings']['get_random_shelf_reaction']['calls'] == 5
+def test_core_modules_start_without_pandas():
+    startup = run_startup_benchmarks(repeats=1)
+    assert set(startup) == {'moonlighter_pricing', 'moonlighter_engine', 'moonlighter_monte_carlo'}
+    for timing in startup.values():
+        assert timing['min_seconds'] > 0
+        assert not timing['imports_pandas']
@@ -0,0 +1,192 @@
+import numpy as np
+import pytest
+from moonlighter_engine import MoonlighterEngine, get_argument_parser
+from moonlighter_pricing import (
+    get_default_simulation_config,
+    run_simulation,
+    get_updated_price_bounds,
+    initialize_simulation,
+    moonlighter_session,
+    query_rows,
+    run_simulation_ticks)
+
+def get_test_simulation_kwargs():
+    return {
+        'shelf_count': 3,
+        'item_counts': {
+            'gold_runes': 3,
+            'broken_sword': 3,
+            'iron_bar': 3,
+            'vine': 3},
+        'price_bounds': {
+            '275|3000': ['gold_runes'],
+            '2|275': ['broken_sword', 'iron_bar', 'vine']},
+        'price_reaction_bounds': [
+            {'item': 'broken_sword', 'cheap_upper': 134, 'perfect_upper': 165, 'expensive_upper': 173},
+            {'item': 'gold_runes', 'cheap_upper': 269, 'perfect_upper': 330, 'expensive_upper': 345},
+            {'item': 'iron_bar', 'cheap_upper': 21, 'perfect_upper': 28, 'expensive_upper': 30},
+            {'item': 'vine', 'cheap_upper': 0, 'perfect_upper': 3, 'expensive_upper': 5}]}
+def get_history_tables():
+    return {
+        table_name: query_rows(f"select rowid, * from {table_name} order by rowid")
+        for table_name in [
+            'reactions', 'thompson_competitions', 'price_bound_history',
+            'inventory_changes', 'shelf_history', 'shelves',
+            'thompson_competition_winners', 'reaction_price_bounds',
+            'inventory_snapshots']} | {
+        table_name: query_rows(f"select * from {table_name} order by 1, 2, 3")
+        for table_name in [
+            'price_bound_history_summary', 'inventory_change_summary',
+            'thompson_competition_summary', 'shelf_history_summary',
+            'thompson_competition_winner_summary']} | {
+        'inventory': query_rows("select item, count from inventory order by item")}
+def get_sql_simulation_tables(
+        db_path, batch_fills=False, visits_per_tick=None, competition_storage='full',
+        **compaction_kwargs):
+    with moonlighter_session(db_path):
+        initialize_simulation(**get_test_simulation_kwargs())
+        run_simulation_ticks(
+            np.random.default_rng(5),
+            batch_fills=batch_fills,
+            visits_per_tick=visits_per_tick,
+            competition_storage=competition_storage,
+            **compaction_kwargs)
+        return get_history_tables()
+def get_engine_simulation_tables(
+        db_path, flush_every=None, batch_fills=False, visits_per_tick=None,
+        competition_storage='full', **compaction_kwargs):
+    with moonlighter_session(db_path):
+        initialize_simulation(**get_test_simulation_kwargs())
+        (
+            MoonlighterEngine
+            .from_database(
+                flush_every=flush_every,
+                batch_fills=batch_fills,
+                visits_per_tick=visits_per_tick,
+                competition_storage=competition_storage,
+                **compaction_kwargs)
+            .run_simulation_ticks(np.random.default_rng(5)))
+        return get_history_tables()
+def test_engine_matches_sql_simulation(tmp_path):
+    sql_tables = get_sql_simulation_tables(tmp_path / 'sql.sqlite')
+    assert len(sql_tables['reactions']) > 0
+    assert get_engine_simulation_tables(tmp_path / 'engine.sqlite') == sql_tables
+    assert (
+        get_engine_simulation_tables(tmp_path / 'flushed.sqlite', flush_every=3)
+        == sql_tables)
+def test_batch_fill_engine_matches_sql_simulation(tmp_path):
+    assert (
+        get_engine_simulation_tables(tmp_path / 'engine.sqlite', batch_fills=True)
+        == get_sql_simulation_tables(tmp_path / 'sql.sqlite', batch_fills=True))
+def test_batch_reaction_engine_matches_sql_simulation(tmp_path):
+    sql_tables = get_sql_simulation_tables(tmp_path / 'sql.sqlite', visits_per_tick=2)
+    assert len(sql_tables['reactions']) > 0
+    assert (
+        get_engine_simulation_tables(tmp_path / 'engine.sqlite', visits_per_tick=2)
+        == sql_tables)
+def test_winner_storage_engine_matches_sql_simulation(tmp_path):
+    sql_tables = get_sql_simulation_tables(
+        tmp_path / 'sql.sqlite',
+        competition_storage='winners')
+    assert len(sql_tables['thompson_competition_winners']) > 0
+    assert (
+        get_engine_simulation_tables(
+            tmp_path / 'engine.sqlite',
+            flush_every=3,
+            competition_storage='winners')
+        == sql_tables)
+def test_compacting_engine_matches_sql_simulation(tmp_path):
+    for competition_storage in ['full', 'winners']:
+        compaction_kwargs = {
+            'competition_storage': competition_storage,
+            'compact_every': 3,
+            'retain_rows': 2}
+        sql_tables = get_sql_simulation_tables(
+            tmp_path / f'sql_{competition_storage}.sqlite', **compaction_kwargs)
+        assert sql_tables['price_bound_history_summary']
+        assert (
+            get_engine_simulation_tables(
+                tmp_path / f'engine_{competition_storage}.sqlite',
+                flush_every=2,
+                **compaction_kwargs)
+            == sql_tables)
+def test_pruned_engine_matches_sql_simulation(tmp_path):
+    sql_tables = get_sql_simulation_tables(tmp_path / 'sql.sqlite', competition_storage='pruned')
+    assert (
+        len(sql_tables['thompson_competitions'])
+        < len(get_sql_simulation_tables(tmp_path / 'full.sqlite')['thompson_competitions']))
+    assert (
+        get_engine_simulation_tables(
+            tmp_path / 'engine.sqlite',
+            flush_every=3,
+            competition_storage='pruned')
+        == sql_tables)
+    engine = MoonlighterEngine.from_config(
+        **get_default_simulation_config(),
+        competition_storage='pruned')
+    engine.run_until_sold_out(np.random.default_rng(5))
+    assert (
+        engine.get_summary()['convergence_ticks']
+        == run_simulation(
+            get_default_simulation_config(),
+            np.random.default_rng(5),
+            db=tmp_path / 'convergence.sqlite',
+            competition_storage='pruned')['convergence_ticks'])
+def test_engine_from_config_matches_database_state(tmp_path):
+    with moonlighter_session(tmp_path / 'test.sqlite'):
+        initialize_simulation(**get_test_simulation_kwargs())
+        database_engine = MoonlighterEngine.from_database()
+    config_engine = MoonlighterEngine.from_config(**get_test_simulation_kwargs())
+    for name in [
+            'items', 'shelf_ids', 'shelf_items', 'inventory_counts', 'lows',
+            'highs', 'has_price_bounds', 'reaction_bounds',
+            'next_competition_index', 'next_reaction_id', 'history_rowids']:
+        assert np.array_equal(
+            getattr(config_engine, name),
+            getattr(database_engine, name))
+def test_posterior_strategy_writes_the_same_history(tmp_path):
+    with moonlighter_session(tmp_path / 'test.sqlite'):
+        initialize_simulation(**get_test_simulation_kwargs())
+        engine = MoonlighterEngine.from_database(flush_every=3, pricing_strategy='posterior')
+        engine.run_simulation_ticks(np.random.default_rng(5))
+        tables = get_history_tables()
+        reloaded_engine = MoonlighterEngine.from_database(pricing_strategy='posterior')
+    assert len(tables['reactions']) == engine.reaction_count > 0
+    assert tables['inventory'] == [(item, 0) for item, _ in tables['inventory']]
+    assert all(
+        low <= price <= high
+        for *_, low, high, price, _ in tables['thompson_competitions'])
+    price_bounds = {
+        item: (low, high)
+        for _, reaction_id, item, low, high, _ in tables['price_bound_history']
+        if reaction_id is None}
+    for (reaction_id, _, item, price, mood, _), (_, bound_reaction_id, _, low, high, _) in zip(
+            tables['reactions'],
+            [x for x in tables['price_bound_history'] if x[1] is not None]):
+        price_bounds[item] = get_updated_price_bounds(*price_bounds[item], price, mood)
+        assert (bound_reaction_id, low, high) == (reaction_id, *price_bounds[item])
+    # Reloading replays the reactions into the same posterior
+    assert np.array_equal(
+        reloaded_engine.strategy.mood_counts,
+        engine.strategy.mood_counts)
+def test_posterior_strategy_sells_out_in_fewer_reactions():
+    reaction_counts = {}
+    for pricing_strategy in ['interval', 'posterior']:
+        reaction_counts[pricing_strategy] = 0
+        for seed in range(10):
+            engine = MoonlighterEngine.from_config(
+                **get_default_simulation_config(),
+                pricing_strategy=pricing_strategy)
+            engine.run_until_sold_out(np.random.default_rng(seed))
+            reaction_counts[pricing_strategy] += engine.reaction_count
+    assert reaction_counts['posterior'] < reaction_counts['interval']
+def test_engine_cli_rejects_options_it_does_not_act_on():
+    args = get_argument_parser().parse_args(['--flush-every', '10', '--batch-fills'])
+    assert (args.flush_every, args.batch_fills) == (10, True)
+    # These would otherwise fall through to a fresh run over the database
+    for option in [
+            ['--resume'], ['--migrate'], ['--compact'], ['--check-inventory'],
+            ['--repair-inventory'], ['--checkpoint-every', '10'],
+            ['--tick-transactions']]:
+        with pytest.raises(SystemExit):
+            get_argument_parser().parse_args(option)
@@ -0,0 +1,82 @@
+import numpy as np
+from moonlighter_events import run_event_simulation
+from moonlighter_pricing import initialize_simulation, moonlighter_session, query_rows
+from test_moonlighter_engine import get_test_simulation_kwargs
+
+# Wall-clock figures that differ between otherwise identical runs
+TIMINGS = {'seconds': None, 'reactions_per_second': None, 'events_per_second': None}
+def run_test_event_simulation(db_path, seed=5, **kwargs):
+    with moonlighter_session(db_path):
+        initialize_simulation(**get_test_simulation_kwargs())
+        summary = run_event_simulation(np.random.default_rng(seed), **kwargs)
+        return summary, {
+            'reactions': query_rows("select shelf_id, item, price, mood from reactions order by rowid"),
+            'inventory_changes': query_rows("select item, change from inventory_changes order by rowid"),
+            'inventory': query_rows("select item, count from inventory order by item")}
+def test_poisson_arrivals_with_restocks(tmp_path):
+    kwargs = {
+        'days': 4,
+        'arrival_rate': 0.2,
+        'day_length': 60,
+        'restock_item_counts': {'vine': 2, 'iron_bar': 5},
+        'restock_every': 2}
+    summary, tables = run_test_event_simulation(tmp_path / 'test.sqlite', **kwargs)
+    assert summary['days'] == 4
+    assert summary['customers'] == summary['reactions'] + summary['walkouts'] > 0
+    assert summary['reactions'] == len(tables['reactions'])
+    assert summary['revenue'] == sum(price for *_, price, mood in tables['reactions'] if mood != 'angry')
+    for name in ['customers', 'walkouts', 'reactions', 'revenue']:
+        assert sum(x[name] for x in summary['daily']) == summary[name]
+    # Deliveries come at the start of day 2 only, as day 4 never opens
+    assert tables['inventory_changes'].count(('vine', 2)) == 1
+    assert tables['inventory_changes'].count(('iron_bar', 5)) == 1
+    assert sorted(tables['inventory']) == sorted(
+        (item, sum(change for x, change in tables['inventory_changes'] if x == item))
+        for item, _ in tables['inventory'])
+    repeated_summary, repeated_tables = run_test_event_simulation(tmp_path / 'repeat.sqlite', **kwargs)
+    assert repeated_tables == tables
+    assert repeated_summary | TIMINGS == summary | TIMINGS
+def test_trace_arrivals_at_the_same_minute_are_batched(tmp_path):
+    summary, tables = run_test_event_simulation(
+        tmp_path / 'test.sqlite',
+        days=3,
+        arrival_trace=[5.5, 0, 0, 0, 5, 61, 30, 0, 0],
+        day_length=60)
+    # Minute 0 brings five customers to three shelves, so two walk out
+    assert summary['customers'] == 9
+    assert summary['walkouts'] == 2
+    assert len(tables['reactions']) == 7
+    assert [(x['customers'], x['walkouts']) for x in summary['daily']] == [(8, 2), (1, 0), (0, 0)]
+    # Three minutes of arrivals and a day boundary on day 0, one minute of
+    # arrivals and a boundary on day 1, and the closing boundary
+    assert summary['event_batches'] == 7
+def test_restocks_and_arrivals_at_the_same_minute_are_one_batch(tmp_path):
+    summary, tables = run_test_event_simulation(
+        tmp_path / 'test.sqlite',
+        days=2,
+        arrival_trace=[60, 60],
+        day_length=60,
+        restock_item_counts={'iron_bar': 5},
+        restock_every=1)
+    assert summary['customers'] == 2
+    assert tables['inventory_changes'].count(('iron_bar', 5)) == 1
+    # The closing boundary of day 0, the delivery with the two customers at
+    # the start of day 1, and the closing boundary of day 1
+    assert summary['event_batches'] == 3
+    assert summary['events'] == 4
+def test_events_compact_the_history_at_day_boundaries(tmp_path):
+    kwargs = {'days': 4, 'arrival_rate': 0.2, 'day_length': 60}
+    summary, tables = run_test_event_simulation(tmp_path / 'full.sqlite', **kwargs)
+    with moonlighter_session(tmp_path / 'compacted.sqlite'):
+        initialize_simulation(**get_test_simulation_kwargs())
+        compacted_summary = run_event_simulation(
+            np.random.default_rng(5), compact_every=2, retain_rows=1, **kwargs)
+        # The last day closed with a compaction, which kept one row
+        assert query_rows("select count(*) from inventory_changes") == [(1,)]
+        assert query_rows("""
+            select
+                (select sum(change) from inventory_changes)
+                + (select sum(change) from inventory_change_summary)""") == [
+            (sum(change for _, change in tables['inventory_changes']),)]
+        assert len(query_rows("select * from reactions")) == len(tables['reactions'])
+    assert compacted_summary | TIMINGS == summary | TIMINGS
@@ -0,0 +1,58 @@
+import sqlite3
+import numpy as np
+import moonlighter_export
+from moonlighter_export import EXPORT_TABLE_COLUMNS, MISSING, export_history, load_history
+from moonlighter_pricing import (
+    initialize_simulation,
+    moonlighter_session,
+    query_rows,
+    run_simulation_ticks)
+from test_moonlighter_engine import get_test_simulation_kwargs
+
+def test_export_round_trips_the_history(tmp_path):
+    with moonlighter_session(tmp_path / 'test.sqlite'):
+        initialize_simulation(**get_test_simulation_kwargs())
+        run_simulation_ticks(np.random.default_rng(5))
+        stats = export_history(tmp_path / 'export', chunksize=7)
+        tables = {
+            table: query_rows(f"select rowid, {', '.join(columns)} from {table} order by rowid")
+            for table, columns in EXPORT_TABLE_COLUMNS.items()}
+    history = load_history(tmp_path / 'export')
+    assert stats['rows'] == sum(len(x) for x in tables.values())
+    assert history['categories']['item'].tolist() == ['broken_sword', 'gold_runes', 'iron_bar', 'vine']
+    for table, rows in tables.items():
+        columns = history['tables'][table]
+        assert isinstance(columns['rowid'], np.memmap)
+        decoded = [
+            [
+                history['categories'][column][x] if column in history['categories'] else
+                None if column == 'reaction_id' and x == MISSING else
+                int(x)
+                for x in columns[column]]
+            for column in ['rowid'] + EXPORT_TABLE_COLUMNS[table]]
+        assert list(map(tuple, zip(*decoded))) == rows
+    assert history['tables']['reactions']['item'].dtype == np.uint8
+    assert history['tables']['reactions']['mood'].dtype == np.uint8
+    assert history['tables']['price_bound_history']['low'].dtype == np.uint16
+def test_export_reads_one_snapshot_while_the_database_is_written(tmp_path, monkeypatch):
+    db_path = tmp_path / 'test.sqlite'
+    get_column_values = moonlighter_export.get_column_values
+    def get_column_values_during_writes(values, column, category_codes):
+        # Another connection commits new history rows between chunks
+        with sqlite3.connect(db_path) as con:
+            con.execute("insert into reactions(shelf_id, item, price, mood) values(0, 'vine', 1, 'angry')")
+            con.execute("insert into inventory_changes(item, change) values('vine', 1)")
+        return get_column_values(values, column, category_codes)
+    with moonlighter_session(db_path, journal_mode='wal'):
+        initialize_simulation(**get_test_simulation_kwargs())
+        run_simulation_ticks(np.random.default_rng(5))
+        row_counts = {
+            table: query_rows(f"select count(*) from {table}")[0][0]
+            for table in EXPORT_TABLE_COLUMNS}
+        monkeypatch.setattr(moonlighter_export, 'get_column_values', get_column_values_during_writes)
+        stats = export_history(tmp_path / 'export', chunksize=7)
+        assert query_rows("select count(*) from reactions")[0][0] > row_counts['reactions']
+    history = load_history(tmp_path / 'export')
+    assert stats['rows'] == sum(row_counts.values())
+    for table, row_count in row_counts.items():
+        assert len(history['tables'][table]['rowid']) == row_count
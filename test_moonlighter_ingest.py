@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+from moonlighter_pricing import (
+    MOODS,
+    get_current_price_bounds,
+    get_updated_price_bounds,
+    initialize_simulation,
+    moonlighter_session,
+    query_data_without_output,
+    query_rows,
+    record_reaction,
+    update_price_bound_history)
+from moonlighter_ingest import ingest_reactions
+
+def get_test_reactions():
+    rng = np.random.default_rng(3)
+    return pd.DataFrame({
+        'shelf_id': rng.integers(0, 3, size=200),
+        'item': rng.choice(['vine', 'root', 'iron_bar'], size=200),
+        'price': rng.integers(2, 300, size=200),
+        'mood': rng.choice(MOODS, size=200)})
+def get_ingested_tables():
+    return {
+        table: query_rows(f"select rowid, * from {table} order by rowid")
+        for table in ['reactions', 'price_bound_history', 'current_price_bounds']}
+def initialize_ingestion_test():
+    initialize_simulation(
+        shelf_count=3,
+        item_counts={'vine': 1, 'root': 1, 'iron_bar': 1},
+        price_bounds={'2|275': ['vine', 'root', 'iron_bar']},
+        price_reaction_bounds=[])
+def test_ingest_reactions_matches_record_reaction(tmp_path):
+    reactions = get_test_reactions()
+    skipped_count = 0
+    with moonlighter_session(tmp_path / 'recorded.sqlite'):
+        initialize_ingestion_test()
+        for reaction in reactions.itertuples(index=False):
+            low, high = get_updated_price_bounds(
+                *get_current_price_bounds([reaction.item])[reaction.item],
+                price=int(reaction.price),
+                mood=reaction.mood)
+            if low > high:
+                skipped_count += 1
+                continue
+            query_data_without_output(
+                "update shelves set item = :item, price = :price where id = :shelf_id",
+                {
+                    'item': reaction.item,
+                    'price': int(reaction.price),
+                    'shelf_id': int(reaction.shelf_id)})
+            record_reaction(shelf_id=int(reaction.shelf_id), mood=reaction.mood)
+            update_price_bound_history()
+        recorded_tables = get_ingested_tables()
+    reactions.iloc[:120].to_csv(tmp_path / 'reactions.csv', index=False)
+    reactions.iloc[120:].to_json(tmp_path / 'reactions.jsonl', orient='records', lines=True)
+    with moonlighter_session(tmp_path / 'ingested.sqlite'):
+        initialize_ingestion_test()
+        csv_stats = ingest_reactions(tmp_path / 'reactions.csv', chunksize=50)
+        jsonl_stats = ingest_reactions(str(tmp_path / 'reactions.jsonl'), chunksize=50)
+        assert get_ingested_tables() == recorded_tables
+    assert skipped_count > 0
+    assert csv_stats['rows'] + csv_stats['skipped'] == 120
+    assert jsonl_stats['rows'] + jsonl_stats['skipped'] == 80
+    assert csv_stats['skipped'] + jsonl_stats['skipped'] == skipped_count
+def test_ingest_skips_reactions_that_contradict_the_price_bounds(tmp_path):
+    reactions = pd.DataFrame({
+        'shelf_id': [0, 1, 2],
+        'item': ['vine', 'vine', 'root'],
+        'price': [275, 100, 50],
+        'mood': ['content', 'angry', 'sad']})
+    reactions.to_csv(tmp_path / 'reactions.csv', index=False)
+    with moonlighter_session(tmp_path / 'test.sqlite'):
+        initialize_ingestion_test()
+        stats = ingest_reactions(tmp_path / 'reactions.csv')
+        assert (stats['rows'], stats['skipped']) == (2, 1)
+        assert get_current_price_bounds(['vine', 'root']) == {'vine': (2, 99), 'root': (50, 275)}
+        assert query_rows("select rowid, item, price from reactions") == [(1, 'vine', 100), (2, 'root', 50)]
+        assert query_rows(
+            "select reaction_id, item from price_bound_history where reaction_id is not null"
+        ) == [(1, 'vine'), (2, 'root')]
@@ -0,0 +1,31 @@
+from moonlighter_monte_carlo import run_monte_carlo
+from test_moonlighter_engine import get_test_simulation_kwargs
+
+def test_run_monte_carlo_is_independent_of_worker_count():
+    results = run_monte_carlo(
+        run_count=6,
+        seed=3,
+        config=get_test_simulation_kwargs())
+    assert results['run'].tolist() == list(range(6))
+    assert (results['ticks_to_sell_out'] > 0).all()
+    assert results['revenue'].nunique() > 1
+    assert (
+        run_monte_carlo(
+            run_count=6,
+            seed=3,
+            workers=2,
+            config=get_test_simulation_kwargs())
+        .equals(results))
+def test_sql_replicates_match_engine_replicates():
+    assert (
+        run_monte_carlo(
+            run_count=3,
+            seed=3,
+            workers=2,
+            config=get_test_simulation_kwargs(),
+            backend='sql')
+        .equals(
+            run_monte_carlo(
+                run_count=3,
+                seed=3,
+                config=get_test_simulation_kwargs())))
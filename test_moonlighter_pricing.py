@@ -1,12 +1,56 @@
 import pandas as pd
 import numpy as np
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import re
+import pytest
+import moonlighter_pricing
 from moonlighter_pricing import (
+    moonlighter_session,
+    database_transaction,
+    initialize_database,
+    add_items_2_inventory,
+    get_inventory_inconsistencies,
+    get_inventory_item_count,
+    rebuild_inventory,
+    initialize_price_bound_history,
+    get_inventory_item_price_bounds,
+    get_schema_version,
+    migrate_database,
+    initialize_simulation,
+    compact_history,
+    run_simulation,
+    run_simulation_ticks,
+    run_simulation_tick,
+    fill_empty_shelves,
+    get_price_bound_violating_shelf_ids,
+    get_shelf_item_count,
+    resume_simulation_ticks,
+    get_reaction_mood_indices,
+    get_pruned_thompson_competition,
+    get_thompson_winner_index,
+    MOODS,
+    SCHEMA_MIGRATIONS,
+    profile_queries,
+    get_query_profile_summary,
+    moonlighter_reader_pool,
+    pooled_connection,
+    query_data,
+    query_data_without_output,
+    query_rows,
+    query_value,
+    execute_sqlite_script,
+    transact_w_database,
     move_allowed_tables_to_end,
     pipe,
     use_map,
     get_thompson_competition,
-    get_thompson_sampled_item_and_price)
+    get_thompson_sampled_item_and_price,
+    get_batch_thompson_competitions,
+    get_reconstructed_thompson_competition,
+    get_updated_price_bound_arrays,
+    get_updated_price_bounds)
+from test_moonlighter_engine import get_history_tables, get_test_simulation_kwargs
 
 def get_test_rng():
     return np.random.default_rng(71071763)
@@ -85,6 +129,68 @@ def test_get_thompson_sampled_item_and_price():
             competition_data=get_test_thompson_competition(),
             rng=get_test_rng())
         == {'item': 'gold_runes', 'price': 917})
+def test_get_thompson_winner_index_matches_dataframe_shuffle():
+    competition_data = (
+        get_test_thompson_competition()
+        .assign(sampled_price=[5, 9, 9, 1, 9, 3, 9, 2, 0, 9, 4]))
+    for seed in range(20):
+        rng = np.random.default_rng(seed)
+        winner = get_thompson_sampled_item_and_price(competition_data, rng)
+        rng = np.random.default_rng(seed)
+        winner_index = get_thompson_winner_index(
+            competition_data['sampled_price'].values,
+            rng)
+        assert competition_data['item'].values[winner_index] == winner['item']
+def get_test_batch_thompson_competitions():
+    return get_batch_thompson_competitions(
+        items=['gold_runes', 'root', 'vine'],
+        lows=np.array([275, 2, 2]),
+        highs=np.array([3000, 275, 275]),
+        inventory_counts=np.array([1, 0, 5]),
+        shelf_ids=[3, 4, 5, 6],
+        rng=get_test_rng(),
+        next_competition_index=7)
+def test_get_batch_thompson_competitions_respects_inventory_counts():
+    batch = get_test_batch_thompson_competitions()
+    assert [x['shelf_id'] for x in batch['assignments']] == [3, 4, 5, 6]
+    assert [x['item'] for x in batch['assignments']] == [
+        'gold_runes', 'vine', 'vine', 'vine']
+    assert (
+        pd.DataFrame(batch['competition_data'])
+        .groupby('competition_ind')
+        ['item']
+        .apply(list)
+        .to_dict()
+        == {
+            7: ['gold_runes', 'vine'],
+            8: ['vine'],
+            9: ['vine'],
+            10: ['vine']})
+    assert get_test_batch_thompson_competitions() == batch
+def test_get_updated_price_bounds():
+    assert get_updated_price_bounds(2, 275, 100, 'ecstatic') == (101, 275)
+    assert get_updated_price_bounds(2, 275, 100, 'content') == (101, 275)
+    assert get_updated_price_bounds(2, 275, 100, 'sad') == (100, 275)
+    assert get_updated_price_bounds(2, 275, 100, 'angry') == (2, 99)
+    assert get_updated_price_bounds(100, 100, 100, 'angry') == (100, 100)
+def test_get_updated_price_bound_arrays():
+    lows, highs, prices = np.meshgrid([2, 50, 100], [100, 275], [50, 100])
+    lows, highs, prices = lows.ravel(), highs.ravel(), prices.ravel()
+    for mood_index, mood in enumerate(MOODS):
+        assert (
+            np.column_stack(
+                get_updated_price_bound_arrays(lows, highs, prices, mood_index)).tolist()
+            == [
+                list(get_updated_price_bounds(low, high, price, mood))
+                for low, high, price in zip(lows, highs, prices)])
+def test_get_reaction_mood_indices():
+    reaction_bounds = np.array([[10, 20, 30], [100, 200, 300]])
+    prices = np.array([5, 10, 11, 20, 30, 31, 300, 150, 1000])
+    item_ids = np.array([0, 0, 0, 0, 0, 0, 1, 1, 0])
+    assert [MOODS[x] for x in get_reaction_mood_indices(item_ids, prices, reaction_bounds)] == [
+        'ecstatic', 'ecstatic', 'content', 'content', 'sad', 'angry', 'sad',
+        'content', 'angry']
+    assert len(get_reaction_mood_indices([], np.array([]), reaction_bounds)) == 0
 def test_get_thompson_competition():
     assert (
         get_thompson_competition(
@@ -130,6 +236,466 @@ def test_use_map():
             use_map(lambda x: x + 5),
             use_map(lambda x: 2 * x))
         == [12, 14, 16])
+def test_moonlighter_session_reuses_connection(tmp_path):
+    with moonlighter_session(tmp_path / 'test.sqlite') as con:
+        query_data_without_output("create table t (x integer)")
+        query_data_without_output("insert into t values(:x)", {'x': 1})
+        assert transact_w_database(lambda con, cursor: con) is con
+        assert query_data("select x from t")['x'].tolist() == [1]
+def test_moonlighter_session_propagates_errors(tmp_path):
+    with moonlighter_session(tmp_path / 'test.sqlite'):
+        try:
+            query_data_without_output("select * from missing_table")
+            raised = False
+        except Exception as e:
+            raised = 'missing_table' in str(e)
+    assert raised
+def test_moonlighter_reader_pool(tmp_path):
+    db_path = tmp_path / 'test.sqlite'
+    with moonlighter_session(db_path):
+        query_data_without_output("create table t (x integer)")
+        query_data_without_output("insert into t values(:x)", {'x': 7})
+    def read_x(pool):
+        with pooled_connection(pool):
+            return int(query_data("select x from t")['x'].values[0])
+    with moonlighter_reader_pool(db_path, size=2) as pool:
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            assert list(executor.map(lambda _: read_x(pool), range(8))) == [7] * 8
+def test_database_transaction_rolls_back_failed_tick(tmp_path):
+    with moonlighter_session(tmp_path / 'test.sqlite', journal_mode='wal', synchronous='normal'):
+        query_data_without_output("create table t (x integer)")
+        try:
+            with database_transaction():
+                query_data_without_output("insert into t values(:x)", {'x': 1})
+                query_data_without_output("insert into missing_table values(1)")
+        except Exception:
+            pass
+        with database_transaction():
+            query_data_without_output("insert into t values(:x)", {'x': 2})
+        assert query_data("select x from t")['x'].tolist() == [2]
+def test_incremental_inventory_matches_rebuild(tmp_path):
+    with moonlighter_session(tmp_path / 'test.sqlite'):
+        initialize_database()
+        add_items_2_inventory({'vine': 3, 'root': 2})
+        add_items_2_inventory({'vine': -1})
+        add_items_2_inventory({'root': -3})
+        assert get_inventory_item_count() == 2
+        assert len(get_inventory_inconsistencies()) == 0
+        query_data_without_output("update inventory set count = 10 where item = 'vine'")
+        assert get_inventory_inconsistencies()['item'].tolist() == ['vine']
+        rebuild_inventory()
+        assert len(get_inventory_inconsistencies()) == 0
+        assert get_inventory_item_count() == 2
+def test_current_price_bounds_follow_price_bound_history(tmp_path):
+    with moonlighter_session(tmp_path / 'test.sqlite'):
+        initialize_database()
+        add_items_2_inventory({'vine': 3, 'root': 1, 'iron_bar': 0})
+        initialize_price_bound_history({'2|275': ['vine', 'root', 'iron_bar']})
+        query_data_without_output(
+            "insert into price_bound_history(reaction_id, item, low, high) "
+            "values(null, 'vine', 10, 20)")
+        assert (
+            get_inventory_item_price_bounds().values.tolist()
+            == [['root', 2, 275], ['vine', 10, 20]])
+def test_migrate_database_keeps_history(tmp_path):
+    with moonlighter_session(tmp_path / 'test.sqlite'):
+        migrate_database(target_version=1)
+        query_data_without_output("insert into shelves values(0, 'vine', 3)")
+        query_data_without_output("insert into inventory_changes values('vine', 4)")
+        query_data_without_output("insert into price_bound_history values(null, 'vine', 2, 275)")
+        query_data_without_output("insert into price_bound_history values(1, 'vine', 4, 275)")
+        migrate_database()
+        assert get_schema_version() == len(SCHEMA_MIGRATIONS)
+        assert query_data("select * from shelves").values.tolist() == [[0, 'vine', 3]]
+        assert query_data("select * from inventory").values.tolist() == [['vine', 4]]
+        assert (
+            query_data("select * from current_price_bounds").values.tolist()
+            == [['vine', 4, 275]])
+        assert len(query_data("select * from price_bound_history")) == 2
+def test_failed_migration_rolls_back(tmp_path):
+    with moonlighter_session(tmp_path / 'test.sqlite'):
+        migrate_database(target_version=1)
+        query_data_without_output("insert into shelves values(0, null, null)")
+        query_data_without_output("insert into shelves values(0, null, null)")
+        query_data_without_output("create table shelves_keyed (x integer)")
+        try:
+            migrate_database()
+        except Exception:
+            pass
+        assert get_schema_version() == 3
+        assert len(query_data("select * from shelves")) == 2
+def get_stored_competition_simulation_tables(competition_storage, **simulation_kwargs):
+    initialize_simulation(
+        shelf_count=3,
+        item_counts={'gold_runes': 3, 'vine': 4, 'root': 2},
+        price_bounds={'275|3000': ['gold_runes'], '2|275': ['vine', 'root']})
+    run_simulation_ticks(
+        np.random.default_rng(5),
+        competition_storage=competition_storage,
+        **simulation_kwargs)
+    return {
+        table: query_rows(f"select rowid, * from {table} order by rowid")
+        for table in [
+            'reactions', 'price_bound_history', 'inventory_changes', 'shelf_history']}
+def get_stored_competitions():
+    return query_data("""
+        select
+            competition_ind,
+            item,
+            price_lower_bound,
+            price_upper_bound,
+            sampled_price
+        from thompson_competitions
+        order by
+            rowid""")
+def assert_reconstructs_competitions(competition_inds, full_competitions):
+    for competition_ind in competition_inds:
+        assert (
+            get_reconstructed_thompson_competition(competition_ind)
+            .reset_index(drop=True)
+            .equals(
+                full_competitions
+                [lambda x: x['competition_ind'] == competition_ind]
+                .reset_index(drop=True)))
+def test_winner_competition_storage_reconstructs_full_competitions(tmp_path):
+    with moonlighter_session(tmp_path / 'full.sqlite'):
+        full_tables = get_stored_competition_simulation_tables('full')
+        full_competitions = get_stored_competitions()
+    with moonlighter_session(tmp_path / 'winners.sqlite'):
+        assert get_stored_competition_simulation_tables('winners') == full_tables
+        assert len(query_data("select * from thompson_competitions")) == 0
+        competition_inds = query_data(
+            "select competition_ind from thompson_competition_winners"
+        )['competition_ind'].tolist()
+        assert competition_inds == sorted(full_competitions['competition_ind'].unique())
+        assert_reconstructs_competitions(competition_inds, full_competitions)
+        with pytest.raises(Exception, match=f'competition {competition_inds[-1] + 1}'):
+            get_reconstructed_thompson_competition(competition_inds[-1] + 1)
+def test_winner_competitions_are_reconstructed_after_compaction(tmp_path):
+    with moonlighter_session(tmp_path / 'full.sqlite'):
+        get_stored_competition_simulation_tables('full')
+        full_competitions = get_stored_competitions()
+        full_price_bound_history_rows = query_value("select count(*) from price_bound_history")
+    competition_inds = sorted(full_competitions['competition_ind'].unique())
+    with moonlighter_session(tmp_path / 'winners.sqlite'):
+        get_stored_competition_simulation_tables('winners', compact_every=2, retain_rows=3)
+        compact_history(retain_rows=3, bucket_size=4)
+        # Only the retained winners hold the history back
+        assert query_value("select count(*) from price_bound_history") < full_price_bound_history_rows / 2
+        assert query_value("select sum(row_count) from inventory_change_summary") > 0
+        assert_reconstructs_competitions(competition_inds[-3:], full_competitions)
+        with pytest.raises(Exception, match=f'competition {competition_inds[-4]}'):
+            get_reconstructed_thompson_competition(competition_inds[-4])
+        assert query_rows("""
+            select
+                sum(row_count),
+                sum(competitor_count)
+            from thompson_competition_winner_summary""")[0] == (
+            len(competition_inds) - 3,
+            sum(
+                (full_competitions['competition_ind'] == i).sum()
+                for i in competition_inds[:-3]))
+def test_resume_from_checkpoint_matches_uninterrupted_run(tmp_path, monkeypatch):
+    empty_shelf = moonlighter_pricing.empty_shelf
+    for simulation_kwargs in [{}, {'visits_per_tick': 2, 'competition_storage': 'winners'}]:
+        with moonlighter_session(tmp_path / 'uninterrupted.sqlite'):
+            initialize_simulation(**get_test_simulation_kwargs())
+            tick_count = run_simulation_ticks(np.random.default_rng(5), **simulation_kwargs)
+            uninterrupted_tables = get_history_tables()
+        with moonlighter_session(tmp_path / 'resumed.sqlite'):
+            initialize_simulation(**get_test_simulation_kwargs())
+            # Interrupt the run partway through a tick, after some of its rows
+            # were committed
+            calls = []
+            def interrupted_empty_shelf(shelf_id):
+                calls.append(shelf_id)
+                if len(calls) == 4:
+                    raise KeyboardInterrupt
+                empty_shelf(shelf_id=shelf_id)
+            monkeypatch.setattr(moonlighter_pricing, 'empty_shelf', interrupted_empty_shelf)
+            try:
+                run_simulation_ticks(
+                    np.random.default_rng(5), checkpoint_every=2, **simulation_kwargs)
+            except KeyboardInterrupt:
+                pass
+            monkeypatch.setattr(moonlighter_pricing, 'empty_shelf', empty_shelf)
+            assert len(calls) == 4
+            assert resume_simulation_ticks(checkpoint_every=2) == tick_count
+            assert get_history_tables() == uninterrupted_tables
+def test_resume_from_checkpoint_with_compaction_matches_uninterrupted_run(tmp_path, monkeypatch):
+    empty_shelf = moonlighter_pricing.empty_shelf
+    simulation_kwargs = {'checkpoint_every': 5, 'compact_every': 2, 'retain_rows': 1}
+    with moonlighter_session(tmp_path / 'uninterrupted.sqlite'):
+        initialize_simulation(**get_test_simulation_kwargs())
+        tick_count = run_simulation_ticks(np.random.default_rng(5), **simulation_kwargs)
+        uninterrupted_tables = get_history_tables()
+    # Interrupted ticks are preceded by compactions since the last checkpoint
+    for interrupted_call_count in [9, 17]:
+        with moonlighter_session(tmp_path / f'resumed_{interrupted_call_count}.sqlite'):
+            initialize_simulation(**get_test_simulation_kwargs())
+            calls = []
+            def interrupted_empty_shelf(shelf_id):
+                calls.append(shelf_id)
+                if len(calls) == interrupted_call_count:
+                    raise KeyboardInterrupt
+                empty_shelf(shelf_id=shelf_id)
+            monkeypatch.setattr(moonlighter_pricing, 'empty_shelf', interrupted_empty_shelf)
+            try:
+                run_simulation_ticks(np.random.default_rng(5), **simulation_kwargs)
+            except KeyboardInterrupt:
+                pass
+            monkeypatch.setattr(moonlighter_pricing, 'empty_shelf', empty_shelf)
+            assert len(calls) == interrupted_call_count
+            assert resume_simulation_ticks(**simulation_kwargs) == tick_count
+            assert len(get_inventory_inconsistencies()) == 0
+            assert get_history_tables() == uninterrupted_tables
+def test_ticks_leave_no_shelves_violating_price_bounds(tmp_path):
+    # Violations are only checked for the items a tick reacted to, which is
+    # complete as long as every tick ends without any
+    with moonlighter_session(tmp_path / 'test.sqlite'):
+        initialize_simulation(
+            shelf_count=12,
+            item_counts={'gold_runes': 10, 'vine': 10, 'root': 10},
+            price_bounds={'275|3000': ['gold_runes'], '2|275': ['vine', 'root']})
+        rng = np.random.default_rng(5)
+        fill_empty_shelves(rng)
+        replaced_ticks = 0
+        while get_inventory_item_count() or get_shelf_item_count():
+            competition_count = query_data(
+                "select count(distinct competition_ind) as n from thompson_competitions")['n'][0]
+            run_simulation_tick(rng)
+            assert get_price_bound_violating_shelf_ids() == []
+            replaced_ticks += (
+                query_data(
+                    "select count(distinct competition_ind) as n from thompson_competitions"
+                )['n'][0]
+                > competition_count + 1)
+        assert replaced_ticks > 0
+def test_run_simulation_summarises_the_run(tmp_path):
+    config = {
+        'shelf_count': 2,
+        'item_counts': {'gold_runes': 3, 'vine': 3},
+        'price_bounds': {'275|3000': ['gold_runes'], '2|275': ['vine']}}
+    summary = run_simulation(config, np.random.default_rng(5), db=tmp_path / 'test.sqlite')
+    with moonlighter_session(tmp_path / 'test.sqlite'):
+        reactions = query_rows("select item, price, mood from reactions order by rowid")
+        assert get_inventory_item_count() == 0
+    assert summary['reactions'] == len(reactions) >= summary['ticks'] > 0
+    assert summary['revenue'] == sum(price for _, price, mood in reactions if mood != 'angry')
+    assert summary['final_prices'] == {item: price for item, price, _ in reactions}
+    assert set(summary['price_bounds']) >= {'gold_runes', 'vine'}
+    assert summary['ticks_per_second'] > 0
+    # The same seed and config give the same run, in any database
+    assert (
+        run_simulation(config, np.random.default_rng(5), db=':memory:')
+        | {'seconds': None, 'ticks_per_second': None}
+        == summary | {'seconds': None, 'ticks_per_second': None})
+def test_pruned_competitions_pick_winners_like_full_ones():
+    lows = np.array([5, 7, 7, 1, 6, 2])
+    highs = np.array([9, 7, 8, 6, 6, 3])
+    rng = np.random.default_rng(3)
+    competition = get_pruned_thompson_competition(lows, highs, rng)
+    # Settled items and items that cannot reach the highest low are not sampled
+    assert competition['sampled'].tolist() == [True, False, True, False, False, False]
+    draw_count = 20000
+    pruned_winners = np.bincount(
+        [
+            get_pruned_thompson_competition(lows, highs, rng)['winner_index']
+            for _ in range(draw_count)],
+        minlength=len(lows))
+    full_winners = np.bincount(
+        [
+            get_thompson_winner_index(rng.integers(lows, highs + 1), rng)
+            for _ in range(draw_count)],
+        minlength=len(lows))
+    assert pruned_winners[3:].sum() == full_winners[3:].sum() == 0
+    assert np.abs(pruned_winners - full_winners).max() < 0.03 * draw_count
+def test_simulation_reports_convergence_ticks(tmp_path):
+    summary = run_simulation(
+        get_test_simulation_kwargs(),
+        np.random.default_rng(5),
+        db=tmp_path / 'test.sqlite',
+        competition_storage='pruned')
+    with moonlighter_session(tmp_path / 'test.sqlite'):
+        competitions = query_rows(
+            "select price_lower_bound, price_upper_bound from thompson_competitions")
+    assert competitions and all(low < high for low, high in competitions)
+    assert summary['convergence_ticks']
+    assert {
+        item
+        for item, (low, high) in summary['price_bounds'].items()
+        if low == high} == set(summary['convergence_ticks'])
+    assert all(0 < tick <= summary['ticks'] for tick in summary['convergence_ticks'].values())
+def get_analytics_tables():
+    return {
+        table: query_rows(f"select * from {table} order by rowid")
+        for table in ['reaction_price_bounds', 'inventory_snapshots']}
+def get_recomputed_analytics_tables():
+    return {
+        'reaction_price_bounds': query_rows("""
+            with price_bounds as (
+                select
+                    row_number() over(partition by shop_id, item order by rowid) as item_order,
+                    *
+                from price_bound_history)
+
+            select
+                a.rowid,
+                a.shop_id,
+                a.shelf_id,
+                a.item,
+                c.low,
+                c.high,
+                a.price,
+                a.mood,
+                b.low,
+                b.high
+            from reactions a
+            left outer join price_bounds b on
+                a.rowid = b.reaction_id
+            left outer join price_bounds c on
+                b.shop_id = c.shop_id
+                and b.item = c.item
+                and b.item_order - 1 = c.item_order
+            order by
+                a.rowid"""),
+        'inventory_snapshots': query_rows("""
+            select
+                a.rowid,
+                a.shop_id,
+                a.item,
+                sum(b.change)
+            from inventory_changes a
+            inner join inventory_changes b on
+                a.shop_id = b.shop_id
+                and a.item = b.item
+                and b.rowid <= a.rowid
+            group by
+                a.rowid
+            order by
+                a.rowid""")}
+def test_analytics_tables_follow_the_history(tmp_path):
+    with moonlighter_session(tmp_path / 'test.sqlite'):
+        initialize_simulation(**get_test_simulation_kwargs())
+        run_simulation_ticks(np.random.default_rng(5), max_ticks=10)
+        run_simulation_ticks(np.random.default_rng(6), visits_per_tick=2)
+        analytics_tables = get_analytics_tables()
+        assert len(analytics_tables['reaction_price_bounds']) > 10
+        assert all(x[-1] is not None for x in analytics_tables['reaction_price_bounds'])
+        assert analytics_tables == get_recomputed_analytics_tables()
+        # Migrating a database from before the analytics tables fills them in
+        execute_sqlite_script("""
+            drop table reaction_price_bounds;
+            drop table inventory_snapshots;
+            pragma user_version = 7;""")
+        migrate_database()
+        assert get_analytics_tables() == analytics_tables
+def test_compaction_keeps_the_run_and_its_totals(tmp_path):
+    with moonlighter_session(tmp_path / 'full.sqlite'):
+        initialize_simulation(**get_test_simulation_kwargs())
+        run_simulation_ticks(np.random.default_rng(5))
+        full_tables = get_history_tables()
+    with moonlighter_session(tmp_path / 'compacted.sqlite'):
+        initialize_simulation(**get_test_simulation_kwargs())
+        run_simulation_ticks(np.random.default_rng(5), compact_every=2, retain_rows=1)
+        compact_history(retain_rows=1, bucket_size=4)
+        tables = get_history_tables()
+        assert len(get_inventory_inconsistencies()) == 0
+        # The run itself is unchanged, down to the analytics of every reaction
+        for table in ['reactions', 'reaction_price_bounds', 'shelves', 'inventory']:
+            assert tables[table] == full_tables[table]
+        for table in ['price_bound_history', 'inventory_changes', 'thompson_competitions', 'shelf_history']:
+            assert len(tables[table]) < len(full_tables[table])
+            assert set(tables[table]) <= set(full_tables[table])
+            assert tables[table][-1] == full_tables[table][-1]
+        assert (
+            query_rows("select sum(row_count) from price_bound_history_summary")[0][0]
+            + len(tables['price_bound_history'])
+            == len(full_tables['price_bound_history']))
+        assert (
+            query_rows("""
+                select sum(row_count), sum(total_sampled_price)
+                from thompson_competition_summary""")[0]
+            == (
+                len(full_tables['thompson_competitions']) - len(tables['thompson_competitions']),
+                sum(
+                    x[5] for x in full_tables['thompson_competitions']
+                    if x not in tables['thompson_competitions'])))
+        assert (
+            query_rows("select sum(row_count), sum(fill_count) from shelf_history_summary")[0]
+            == (
+                len(full_tables['shelf_history']) - len(tables['shelf_history']),
+                sum(
+                    x[2] is not None for x in full_tables['shelf_history']
+                    if x not in tables['shelf_history'])))
+        assert query_rows("pragma auto_vacuum") == [(2,)]
+def test_profile_queries_records_helper_timings(tmp_path):
+    trace_path = tmp_path / 'trace.jsonl'
+    with moonlighter_session(tmp_path / 'test.sqlite'):
+        initialize_database()
+        with profile_queries(trace_path) as profiler:
+            add_items_2_inventory({'vine': 3, 'root': 2})
+            get_inventory_item_count()
+            get_inventory_item_count()
+    summary = get_query_profile_summary(profiler).set_index('name')
+    assert summary.loc['get_inventory_item_count', 'operation'] == 'query_value'
+    assert summary.loc['get_inventory_item_count', 'calls'] == 2
+    assert summary.loc['bulk_update_inventory_changes', 'rows'] == 2
+    # Helpers called by other helpers are reported under their own name
+    assert summary.loc['update_inventory', 'operation'] == 'execute_many_queries'
+    assert 'add_items_2_inventory' not in summary.index
+    assert (summary['p99_seconds'] > 0).all()
+    assert len(trace_path.read_text().splitlines()) == 4
+
+# Tables whose size is bounded by the catalog or shelf count; whole-shop
+# queries may walk them. History tables grow every tick and must never be
+# scanned by the simulation loop.
+SCANNABLE_TABLES = {'shelves', 'current_price_bounds'}
+def get_table_aliases(query):
+    return {
+        alias: table
+        for table, alias in re.findall(
+            r'\b(?:from|join)\s+(\w+)\s+(?:as\s+)?'
+            r'(?!where\b|on\b|order\b|group\b|having\b|union\b|limit\b|inner\b|left\b)(\w+)',
+            query,
+            flags=re.IGNORECASE)}
+def get_scanned_tables(cursor, query):
+    aliases = get_table_aliases(query)
+    return {
+        aliases.get(name, name)
+        for *_, detail in cursor.execute(f"explain query plan {query}").fetchall()
+        for name in re.findall(r'^SCAN (\w+)', detail)}
+def get_traced_simulation_queries(con, **simulation_kwargs):
+    initialize_simulation(
+        shelf_count=3,
+        item_counts={'gold_runes': 3, 'vine': 3},
+        price_bounds={'275|3000': ['gold_runes'], '2|275': ['vine']},
+        price_reaction_bounds=[
+            {'item': 'gold_runes', 'cheap_upper': 269, 'perfect_upper': 330, 'expensive_upper': 345},
+            {'item': 'vine', 'cheap_upper': 0, 'perfect_upper': 3, 'expensive_upper': 5}])
+    queries = []
+    con.set_trace_callback(queries.append)
+    run_simulation_ticks(np.random.default_rng(5), **simulation_kwargs)
+    con.set_trace_callback(None)
+    return {
+        re.sub(r"'[^']*'|\b\d+\b", '0', query): query
+        for query in queries
+        if query.strip().lower() not in ('begin', 'commit')}
+def test_simulation_queries_do_not_scan_growing_tables(tmp_path):
+    with moonlighter_session(tmp_path / 'test.sqlite') as con:
+        queries = (
+            get_traced_simulation_queries(con)
+            | get_traced_simulation_queries(con, tick_transactions=True, batch_fills=True)
+            | get_traced_simulation_queries(
+                con,
+                visits_per_tick=2,
+                competition_storage='winners'))
+        tables = set(query_data("select name from sqlite_master where type = 'table'")['name'])
+        assert len(queries) > 10
+        cursor = con.cursor()
+        for query in queries.values():
+            scanned_tables = (get_scanned_tables(cursor, query) & tables) - SCANNABLE_TABLES
+            assert not scanned_tables, (query, scanned_tables)
 
 if __name__ == '__main__':
     print(test_get_thompson_sampled_item_and_price())
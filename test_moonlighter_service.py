@@ -0,0 +1,168 @@
+import asyncio
+import json
+from moonlighter_engine import MoonlighterEngine
+from moonlighter_load_test import run_local_load_test, send_request
+from moonlighter_pricing import (
+    get_inventory_inconsistencies,
+    initialize_simulation,
+    moonlighter_session,
+    query_rows)
+from moonlighter_service import start_service, stop_service
+from test_moonlighter_engine import get_test_simulation_kwargs
+
+async def run_service_requests(db_path, requests):
+    server, writer_tasks = await start_service({'main': db_path}, port=0)
+    try:
+        reader, writer = await asyncio.open_connection(
+            '127.0.0.1', server.sockets[0].getsockname()[1])
+        responses = [
+            await send_request(reader, writer, *request)
+            for request in requests]
+        writer.close()
+        return responses
+    finally:
+        await stop_service(server, writer_tasks)
+def test_service_fills_shelves_and_records_reactions(tmp_path):
+    db_path = tmp_path / 'test.sqlite'
+    with moonlighter_session(db_path):
+        initialize_simulation(**get_test_simulation_kwargs())
+    responses = asyncio.run(run_service_requests(db_path, [
+        ('POST', '/shops/main/shelves/0/fill'),
+        ('POST', '/shops/main/shelves/0/fill'),
+        ('POST', '/shops/main/shelves/0/reactions', {'mood': 'angry'}),
+        ('POST', '/shops/main/shelves/1/reactions', {'mood': 'angry'}),
+        ('POST', '/shops/main/shelves/0/reactions', {'mood': 'bored'}),
+        ('POST', '/shops/outpost/shelves/0/fill'),
+        ('GET', '/shops/main')]))
+    assert [status for status, _ in responses] == [200, 409, 200, 409, 400, 404, 200]
+    fill, reaction, snapshot = responses[0][1], responses[2][1], responses[-1][1]
+    assert reaction['price'] == fill['price']
+    assert reaction['price_bounds'][1] == fill['price'] - 1
+    # The angry customer left the item, so it went back to the inventory
+    assert snapshot['shelves'][0] == {'shelf_id': 0, 'item': None, 'price': None}
+    assert snapshot['inventory'][fill['item']] == 3
+    assert snapshot['price_bounds'][fill['item']] == reaction['price_bounds']
+    # Every answered request was committed
+    with moonlighter_session(db_path):
+        assert query_rows("select item, price, mood from reactions") == [
+            (fill['item'], fill['price'], 'angry')]
+        assert query_rows("select item, price from shelves where id = 0") == [(None, None)]
+        assert query_rows(f"select count from inventory where item = '{fill['item']}'") == [(3,)]
+        assert len(get_inventory_inconsistencies()) == 0
+async def run_angry_reaction_on_the_cheaper_shelf(db_path):
+    server, writer_tasks = await start_service({'main': db_path}, port=0)
+    try:
+        reader, writer = await asyncio.open_connection(
+            '127.0.0.1', server.sockets[0].getsockname()[1])
+        fills = [
+            (await send_request(reader, writer, 'POST', f'/shops/main/shelves/{shelf_id}/fill'))[1]
+            for shelf_id in [0, 1]]
+        cheaper, dearer = sorted(fills, key=lambda x: x['price'])
+        reaction = await send_request(
+            reader, writer, 'POST', f"/shops/main/shelves/{cheaper['shelf_id']}/reactions",
+            {'mood': 'angry'})
+        paid = await send_request(
+            reader, writer, 'POST', f"/shops/main/shelves/{dearer['shelf_id']}/reactions",
+            {'mood': 'content'})
+        writer.close()
+        return fills, reaction, paid
+    finally:
+        await stop_service(server, writer_tasks)
+def test_service_reprices_shelves_left_outside_the_price_bounds(tmp_path):
+    db_path = tmp_path / 'test.sqlite'
+    with moonlighter_session(db_path):
+        initialize_simulation(
+            shelf_count=2,
+            item_counts={'vine': 3},
+            price_bounds={'2|275': ['vine']},
+            price_reaction_bounds=get_test_simulation_kwargs()['price_reaction_bounds'])
+    fills, (status, reaction), paid = asyncio.run(run_angry_reaction_on_the_cheaper_shelf(db_path))
+    cheaper, dearer = sorted(fills, key=lambda x: x['price'])
+    assert status == 200
+    assert cheaper['price'] < dearer['price']
+    # The dearer vine was repriced within the narrowed bounds, so a customer
+    # can pay for it
+    [replaced] = reaction['replaced_shelves']
+    assert replaced['shelf_id'] == dearer['shelf_id']
+    assert replaced['price'] <= reaction['price_bounds'][1] == cheaper['price'] - 1
+    assert paid[0] == 200
+    assert paid[1]['price'] == replaced['price']
+    with moonlighter_session(db_path):
+        assert len(get_inventory_inconsistencies()) == 0
+def test_load_test_keeps_the_database_consistent(tmp_path):
+    db_path = tmp_path / 'test.sqlite'
+    with moonlighter_session(db_path):
+        initialize_simulation(**get_test_simulation_kwargs())
+    summary = asyncio.run(run_local_load_test(db_path, clients=4, seconds=0.5))
+    assert summary['requests'] > 0
+    assert summary['errors'] == 0
+    assert set(summary['operations']) >= {'snapshot', 'fill'}
+    with moonlighter_session(db_path):
+        assert len(get_inventory_inconsistencies()) == 0
+async def send_raw_request(port, data):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(data)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    response = await reader.read()
+    writer.close()
+    return status, json.loads(response.partition(b'\r\n\r\n')[2])
+async def run_malformed_requests(db_path):
+    server, writer_tasks = await start_service({'main': db_path}, port=0)
+    try:
+        port = server.sockets[0].getsockname()[1]
+        responses = [
+            await send_raw_request(port, data)
+            for data in [
+                b'GET\r\n\r\n',
+                b'\xff /shops/main HTTP/1.1\r\n\r\n',
+                b'POST /shops/main/shelves/0/reactions HTTP/1.1\r\nContent-Length: x\r\n\r\n',
+                b'POST /shops/main/shelves/0/reactions HTTP/1.1\r\nContent-Length: -1\r\n\r\n']]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        responses += [
+            await send_request(reader, writer, 'POST', '/shops/main/shelves/0/reactions', ['angry']),
+            await send_request(reader, writer, 'GET', '/shops/main')]
+        writer.close()
+        return responses
+    finally:
+        await stop_service(server, writer_tasks)
+def test_service_answers_malformed_requests_with_bad_request(tmp_path):
+    db_path = tmp_path / 'test.sqlite'
+    with moonlighter_session(db_path):
+        initialize_simulation(**get_test_simulation_kwargs())
+    responses = asyncio.run(run_malformed_requests(db_path))
+    assert [status for status, _ in responses] == [400, 400, 400, 400, 400, 200]
+    assert all('error' in payload for _, payload in responses[:-1])
+def test_service_outlives_a_failed_reload(tmp_path, monkeypatch):
+    db_path = tmp_path / 'test.sqlite'
+    with moonlighter_session(db_path):
+        initialize_simulation(**get_test_simulation_kwargs())
+    flush, from_database = MoonlighterEngine.flush, MoonlighterEngine.from_database
+    calls = {'flush': 0, 'from_database': 0}
+    def failing_flush(self):
+        calls['flush'] += 1
+        if calls['flush'] == 1:
+            raise Exception('Flush failed')
+        return flush(self)
+    def failing_from_database(**kwargs):
+        calls['from_database'] += 1
+        if calls['from_database'] == 2:
+            raise Exception('Reload failed')
+        return from_database(**kwargs)
+    monkeypatch.setattr(MoonlighterEngine, 'flush', failing_flush)
+    monkeypatch.setattr(MoonlighterEngine, 'from_database', failing_from_database)
+    responses = asyncio.run(run_service_requests(db_path, [
+        ('POST', '/shops/main/shelves/0/fill'),
+        ('GET', '/shops/main'),
+        ('POST', '/shops/main/shelves/0/fill'),
+        ('GET', '/shops/main')]))
+    # The failed batch is answered with its error, and the next batch reloads
+    # the engine from the database before it is applied
+    assert responses[0] == (500, {'error': 'Flush failed'})
+    assert responses[1][1]['shelves'][0]['item'] is None
+    assert responses[2][0] == 200
+    assert responses[3][1]['shelves'][0]['item'] == responses[2][1]['item']
+    assert calls['from_database'] == 3
+    with moonlighter_session(db_path):
+        assert query_rows("select item, price from shelves where id = 0") == [
+            (responses[2][1]['item'], responses[2][1]['price'])]
@@ -0,0 +1,88 @@
+from collections import defaultdict
+import numpy as np
+from moonlighter_pricing import (
+    get_inventory_inconsistencies,
+    get_updated_price_bounds,
+    initialize_simulation,
+    moonlighter_session,
+    query_rows)
+from moonlighter_shops import MoonlighterShops
+from test_moonlighter_engine import get_test_simulation_kwargs
+from test_moonlighter_pricing import get_analytics_tables, get_recomputed_analytics_tables
+
+def test_shops_write_consistent_history_per_shop(tmp_path):
+    with moonlighter_session(tmp_path / 'test.sqlite'):
+        initialize_simulation(**get_test_simulation_kwargs())
+        shops = MoonlighterShops.from_database(shop_count=5, flush_every=4)
+        shops.run_simulation_ticks(np.random.default_rng(5))
+        summary = shops.get_summary()
+        assert len(get_inventory_inconsistencies()) == 0
+        assert get_analytics_tables() == get_recomputed_analytics_tables()
+        assert (
+            query_rows("select distinct shop_id from reactions order by shop_id")
+            == [(i,) for i in range(5)])
+        # Every shop sold out everything it was stocked with
+        assert query_rows("""
+            select shop_id, item
+            from inventory_changes
+            group by shop_id, item
+            having sum(change) != 0""") == []
+        assert query_rows("select * from shelves where item is not null") == []
+        revenues = defaultdict(int)
+        for shop_id, price in query_rows("""
+                select shop_id, price
+                from reactions
+                where mood != 'angry'"""):
+            revenues[shop_id] += price
+        assert [revenues[i] for i in range(5)] == summary['revenue']
+        # Replaying each shop's reactions through the scalar rules gives its
+        # bound history
+        price_bounds = {}
+        for reaction_id, shop_id, item, low, high, price, mood in query_rows("""
+                select
+                    a.reaction_id,
+                    a.shop_id,
+                    a.item,
+                    a.low,
+                    a.high,
+                    b.price,
+                    b.mood
+                from price_bound_history a
+                left outer join reactions b on
+                    a.reaction_id = b.rowid
+                order by
+                    a.rowid"""):
+            if reaction_id is not None:
+                assert (low, high) == get_updated_price_bounds(
+                    *price_bounds[shop_id, item],
+                    price=price,
+                    mood=mood)
+            price_bounds[shop_id, item] = (low, high)
+        # Each competition's highest draw is the price its winner was shelved at
+        assert sorted(query_rows("""
+            select shop_id, max(sampled_price)
+            from thompson_competitions
+            group by competition_ind""")) == sorted(query_rows("""
+            select shop_id, price
+            from shelf_history
+            where item is not null"""))
+def test_compacting_shops_keep_the_run_and_its_totals(tmp_path):
+    runs = {}
+    for name, compaction_kwargs in [('full', {}), ('compacted', {'compact_every': 3, 'retain_rows': 2})]:
+        with moonlighter_session(tmp_path / f'{name}.sqlite'):
+            initialize_simulation(**get_test_simulation_kwargs())
+            shops = MoonlighterShops.from_database(shop_count=5, flush_every=2, **compaction_kwargs)
+            shops.run_simulation_ticks(np.random.default_rng(5))
+            assert len(get_inventory_inconsistencies()) == 0
+            runs[name] = {
+                'summary': shops.get_summary(),
+                'reactions': query_rows("select * from reactions order by rowid"),
+                'price_bound_history': query_rows("select count(*) from price_bound_history")[0][0],
+                'price_bound_history_summary': query_rows(
+                    "select coalesce(sum(row_count), 0) from price_bound_history_summary")[0][0]}
+    assert runs['compacted']['summary'] == runs['full']['summary']
+    assert runs['compacted']['reactions'] == runs['full']['reactions']
+    assert runs['compacted']['price_bound_history_summary'] > 0
+    assert (
+        runs['compacted']['price_bound_history'] + runs['compacted']['price_bound_history_summary']
+        == runs['full']['price_bound_history'])